@@ -0,0 +1,178 @@
+"""Sample banks that hold all samples of a kit in a single file.
+
+Loading a kit from separate compressed files takes one request and one decode
+per sample. A bank holds the samples already decoded as 16 bit PCM, so the
+engine fetches the whole kit at once and copies the samples into audio
+buffers without decoding. A bank file consists of:
+
+  4 bytes   Magic number `JTBK`.
+  4 bytes   Format version as little endian unsigned integer.
+  4 bytes   Length of the index in bytes, a multiple of four.
+  index     JSON object, padded with spaces.
+  data      Little endian 16 bit PCM.
+
+The index holds the sample rate, the number of channels, and for every tone
+the offset into the data in samples and the number of frames. The channels
+of a sample are stored one after the other.
+
+Built banks are listed in `banks/index.json`, which `jamtyper` reads to
+resolve the bank names given to `Player(sam=...)`. Pack local WAV files into
+a bank from the repository root:
+
+  python banks.py drums C4=kick.wav D4=snare.wav --rate 22050
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import wave
+
+import numpy as np
+
+
+MAGIC = b'JTBK'
+VERSION = 1
+
+# Sample rate of banks in Hertz unless specified otherwise.
+RATE = 44100
+
+# Directory of the banks and their listing, relative to the repository root.
+DIRECTORY = 'banks'
+LISTING = 'index.json'
+
+
+def build(sources, path, rate=RATE, channels=1):
+  """Pack audio files into a sample bank.
+
+  The sources map tone names like `C4` to paths of WAV files. Samples are
+  resampled to the rate and mixed down or duplicated to the number of
+  channels. Returns the index of the bank.
+  """
+  assert channels in (1, 2), channels
+  index = dict(rate=rate, channels=channels, samples={})
+  chunks = []
+  offset = 0
+  for tone, source in sources.items():
+    data, source_rate = wav(source)
+    data = _channels(_resample(data, source_rate, rate), channels)
+    pcm = np.clip(np.round(data * 32768), -32768, 32767).astype('<i2')
+    # Channels one after the other, so that each can be copied into the audio
+    # buffer as one slice.
+    chunks.append(pcm.T.tobytes())
+    index['samples'][tone] = [offset, len(pcm)]
+    offset += pcm.size
+  header = json.dumps(index, separators=(',', ':')).encode('utf-8')
+  # The data has to start at an aligned offset to be viewed as an array of
+  # 16 bit integers in the browser.
+  header += b' ' * (-len(header) % 4)
+  with open(path, 'wb') as f:
+    f.write(MAGIC + struct.pack('<II', VERSION, len(header)))
+    f.write(header)
+    for chunk in chunks:
+      f.write(chunk)
+  return index
+
+
+def read(path):
+  """Read a sample bank.
+
+  Returns the index and a dict from tone names to arrays of samples between
+  minus one and one, with one row per channel.
+  """
+  with open(path, 'rb') as f:
+    content = f.read()
+  if content[:4] != MAGIC:
+    raise ValueError(f'Not a sample bank: {path}')
+  version, length = struct.unpack('<II', content[4:12])
+  if version != VERSION:
+    raise ValueError(f'Unsupported sample bank version {version}: {path}')
+  index = json.loads(content[12:12 + length])
+  pcm = np.frombuffer(content, '<i2', offset=12 + length) / 32768
+  samples = {}
+  for tone, (offset, frames) in index['samples'].items():
+    size = frames * index['channels']
+    samples[tone] = pcm[offset:offset + size].reshape(index['channels'], frames)
+  return index, samples
+
+
+def register(name, path, tones, root='.'):
+  """Add a bank to the listing so that players can refer to it by name."""
+  listing = os.path.join(root, DIRECTORY, LISTING)
+  banks = {}
+  if os.path.exists(listing):
+    with open(listing) as f:
+      banks = json.load(f)
+  url = os.path.relpath(path, root).replace(os.sep, '/')
+  banks[name] = dict(url=url, tones=list(tones))
+  with open(listing, 'w') as f:
+    json.dump(banks, f, indent=2, sort_keys=True)
+    f.write('\n')
+
+
+def wav(path):
+  """Read a WAV file as samples between minus one and one.
+
+  Returns an array with one column per channel and the sample rate.
+  """
+  with wave.open(path, 'rb') as f:
+    width = f.getsampwidth()
+    channels = f.getnchannels()
+    rate = f.getframerate()
+    raw = f.readframes(f.getnframes())
+  if width == 1:
+    data = (np.frombuffer(raw, np.uint8).astype(np.float64) - 128) / 128
+  elif width == 2:
+    data = np.frombuffer(raw, '<i2') / 32768
+  elif width == 4:
+    data = np.frombuffer(raw, '<i4') / 2147483648
+  else:
+    raise ValueError(f'Unsupported sample width of {width} bytes: {path}')
+  return data.reshape(-1, channels), rate
+
+
+def _resample(data, source, rate):
+  if source == rate:
+    return data
+  positions = np.arange(0, len(data) - 1, source / rate)
+  return np.stack([
+      np.interp(positions, np.arange(len(data)), column)
+      for column in data.T], axis=1)
+
+
+def _channels(data, channels):
+  if data.shape[1] == channels:
+    return data
+  if channels == 1:
+    return data.mean(axis=1, keepdims=True)
+  return np.repeat(data, channels, axis=1)
+
+
+def main(argv=None):
+  """Pack WAV files into a sample bank and list it under its name."""
+  parser = argparse.ArgumentParser(prog='banks.py', description=main.__doc__)
+  parser.add_argument('name', help='Name of the bank for Player(sam=...).')
+  parser.add_argument(
+      'samples', nargs='+', metavar='TONE=PATH',
+      help='Tone names and WAV files, for example C4=kick.wav.')
+  parser.add_argument('--rate', type=int, default=RATE)
+  parser.add_argument('--channels', type=int, choices=(1, 2), default=1)
+  args = parser.parse_args(argv)
+  sources = {}
+  for sample in args.samples:
+    tone, separator, path = sample.partition('=')
+    if not separator:
+      parser.error(f'Expected TONE=PATH instead of {sample}.')
+    sources[tone] = path
+  root = os.path.dirname(os.path.abspath(__file__))
+  path = os.path.join(root, DIRECTORY, f'{args.name}.bank')
+  index = build(sources, path, args.rate, args.channels)
+  register(args.name, path, index['samples'].keys(), root)
+  print(f'Packed {len(sources)} samples into {path} '
+        f'({os.path.getsize(path) / 2 ** 20:.1f} MB).')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
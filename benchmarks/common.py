@@ -0,0 +1,89 @@
+"""Helpers shared by the benchmarks."""
+
+import ast
+import gc
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import jamtyper
+
+
+# Seconds that every case is repeated for at least, so that fast cases get
+# enough repetitions for a stable median.
+BUDGET = 1.0
+
+
+def example():
+  """Get the example song of the editor without importing the interface."""
+  with open(os.path.join(ROOT, 'interface.py')) as f:
+    module = ast.parse(f.read())
+  for node in module.body:
+    if isinstance(node, ast.Assign) and node.targets[0].id == 'EXAMPLE_SONG':
+      return ast.literal_eval(node.value.func.value).strip('\n ')
+  raise KeyError('EXAMPLE_SONG')
+
+
+def synthetic(tracks=50, volume=None):
+  """Get a song of many tracks with changes every few bars.
+
+  With a volume, the first track changes to it at bar 32, so that songs with
+  different volumes differ in a single track.
+  """
+  lines = ['import jamtyper as jt']
+  for index in range(tracks):
+    lines.append(
+        f"p{index} = jt.Player(cho=[0,2,4,(1,3)], dur=[1/8,1/8,1/4], "
+        f"sam=jt.samples.piano, vol=0.5, pan={(index % 5 - 2) / 2})")
+    for bar in range(4, 64, 4):
+      lines.append(f'p{index}.at({bar}, vol={bar % 8 / 8}, hpf={bar * 10})')
+    lines.append(f'p{index}.at(8, every=4, over=1, lpf=2000)')
+  if volume is not None:
+    lines.append(f'p0.at(32, vol={volume})')
+  return '\n'.join(lines)
+
+
+def compile(source):
+  """Run a song and get its compiled JSON."""
+  random.seed(0)
+  jamtyper.clear()
+  exec(source, {'__name__': '__main__'})
+  return jamtyper.compile()
+
+
+def measure(setup, function, repeats=5, budget=BUDGET):
+  """Get the median time in milliseconds and the peak memory in KiB.
+
+  The setup runs before every repetition and returns the arguments of the
+  function, which is what is measured.
+  """
+  durations = []
+  enabled = gc.isenabled()
+  began = time.perf_counter()
+  while len(durations) < repeats or time.perf_counter() - began < budget:
+    args = setup() or ()
+    gc.collect()
+    # Like timeit, collections are kept out of the timing.
+    gc.disable()
+    try:
+      begin = time.perf_counter()
+      function(*args)
+      durations.append(time.perf_counter() - begin)
+    finally:
+      if enabled:
+        gc.enable()
+  args = setup() or ()
+  gc.collect()
+  tracemalloc.start()
+  try:
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return 1000 * statistics.median(durations), peak / 1024
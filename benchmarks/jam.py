@@ -0,0 +1,116 @@
+"""Measure how a jam session fans out updates to many clients.
+
+Starts the server in process and connects simulated clients. One client
+changes a single track of a synthetic song with 20 tracks again and again,
+and the others put the songs together from the batches they receive. Reports
+the latency from submitting an update until the last client has it, and the
+bytes per client and update compared to sending the whole source and song.
+Run from the repository root:
+
+  python benchmarks/jam.py
+"""
+
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import jamserver
+import wire
+from benchmarks import common
+
+
+UPDATES = 20
+
+TRACKS = 20
+
+
+async def receive(connection, kind):
+  while True:
+    message = json.loads(await connection.receive())
+    if message['type'] == kind:
+      return message
+
+
+async def follow(connection, received):
+  # Puts the songs together and records when and how many bytes arrived.
+  replica = wire.Replica()
+  while True:
+    text = await connection.receive()
+    if text is None:
+      return
+    message = json.loads(text)
+    if message['type'] == 'batch':
+      song = replica.apply(message)
+      received.append((
+          message['seq'], time.perf_counter(), len(text), song,
+          replica.source))
+
+
+async def session(clients, sources, songs):
+  server = jamserver.Server()
+  listener = await asyncio.start_server(server.handle, 'localhost', 0)
+  url = f'ws://localhost:{listener.sockets[0].getsockname()[1]}/bench'
+  editor = await jamserver.connect(url)
+  await editor.send(json.dumps(
+      dict(type='update', source=sources[0], song=songs[0])))
+  await receive(editor, 'batch')
+  connections = [await jamserver.connect(url) for _ in range(clients)]
+  received = [[] for _ in range(clients)]
+  tasks = [
+      asyncio.ensure_future(follow(*args))
+      for args in zip(connections, received)]
+  while any(not times for times in received):
+    await asyncio.sleep(0.001)
+  latencies = []
+  for seq, (source, song) in enumerate(zip(sources[1:], songs[1:]), 2):
+    begin = time.perf_counter()
+    await editor.send(json.dumps(dict(type='update', source=source, song=song)))
+    await receive(editor, 'batch')
+    while any(not times or times[-1][0] < seq for times in received):
+      await asyncio.sleep(0.001)
+    # The batch interval is part of the latency by design, so it is
+    # reported separately.
+    latencies.append(
+        max(times[-1][1] for times in received) - begin -
+        jamserver.BATCH_INTERVAL)
+  expected = wire.decode(json.loads(songs[-1]))['tracks']
+  for times in received:
+    assert wire.decode(times[-1][3])['tracks'] == expected
+    assert times[-1][4] == sources[-1]
+  for connection in connections + [editor]:
+    await connection.close()
+  await asyncio.gather(*tasks)
+  listener.close()
+  await listener.wait_closed()
+  # The first batch of every client holds the whole song.
+  sizes = [size for times in received for _, _, size, _, _ in times[1:]]
+  return latencies, statistics.mean(sizes)
+
+
+def main():
+  # Only the first track changes between updates.
+  sources = [
+      common.synthetic(TRACKS, index / UPDATES) for index in range(UPDATES + 1)]
+  songs = [common.compile(source) for source in sources]
+  full = statistics.mean(
+      len(json.dumps(dict(source=source, song=song)))
+      for source, song in zip(sources, songs))
+  print(f'Source and song {full / 1024:.1f} KiB, {UPDATES} updates of one track.')
+  print(f'  clients   p50 ms   max ms   KiB/update   ratio')
+  for clients in (8, 32, 64):
+    latencies, size = asyncio.run(session(clients, sources, songs))
+    print(
+        f'  {clients:7d} {1000 * statistics.median(latencies):8.2f} '
+        f'{1000 * max(latencies):8.2f} {size / 1024:12.2f} '
+        f'{size / full:7.1%}')
+
+
+if __name__ == '__main__':
+  main()
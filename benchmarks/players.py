@@ -0,0 +1,60 @@
+"""Measure creating players and setting their properties.
+
+Times the constructor with the defaults only, and `Player.at()` with lists
+of 10k values for numbers, chords, oscillators, and scales, which is where
+casting and validating every value dominates. Run from the repository root:
+
+  python benchmarks/players.py
+"""
+
+import os
+import random
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import jamtyper
+from benchmarks import common
+
+
+SIZE = 10000
+
+
+def cases():
+  random.seed(0)
+  numbers = [random.choice([1 / 4, 1 / 8, 1 / 16]) for _ in range(SIZE)]
+  integers = [random.randrange(1, 17) for _ in range(SIZE)]
+  chords = [
+      random.choice([0, '2#', (0, 2, 4), ('1', '-3b')]) for _ in range(SIZE)]
+  oscillators = [
+      random.choice(['sine', 'square', 'sawtooth', 'triangle'])
+      for _ in range(SIZE)]
+  scales = [
+      random.choice(list(jamtyper.scales.values())) for _ in range(SIZE)]
+  yield 'defaults only', lambda: jamtyper.Player()
+  yield '100 players', lambda: [jamtyper.Player() for _ in range(100)]
+  yield f'dur x {SIZE}', lambda: jamtyper.Player().at(0, dur=list(numbers))
+  yield f'vol x {SIZE}', lambda: jamtyper.Player().at(0, vol=list(numbers))
+  yield f'voi x {SIZE}', lambda: jamtyper.Player().at(0, voi=list(integers))
+  yield f'cho x {SIZE}', lambda: jamtyper.Player().at(0, cho=list(chords))
+  yield f'osc x {SIZE}', lambda: jamtyper.Player().at(0, osc=list(oscillators))
+  yield f'sca x {SIZE}', lambda: jamtyper.Player().at(0, sca=list(scales))
+  yield f'at x {SIZE // 10}', lambda: _changes(SIZE // 10)
+
+
+def _changes(count):
+  player = jamtyper.Player()
+  for index in range(count):
+    player.at(index, vol=index % 8 / 8, hpf=index * 10, cho=[0, (1, 3)])
+
+
+def main():
+  for name, function in cases():
+    duration, _ = common.measure(jamtyper.clear, function)
+    print(f'{name + ":":16} {duration:8.3f} ms')
+
+
+if __name__ == '__main__':
+  main()
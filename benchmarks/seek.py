@@ -0,0 +1,62 @@
+"""Benchmark seeking into a long song with a long cycled pattern.
+
+Compares the prefix sum lookup of `schedule.query()` with stepping through the
+loop note by note from the last change of the `dur` property, which is what
+the engine did before. Run from the repository root:
+
+  python benchmarks/seek.py
+"""
+
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import schedule
+from benchmarks import common
+
+
+def song(steps, seed=0):
+  rng = random.Random(seed)
+  state = dict(
+      act=[True], oct=[4], len=[1 / 8], vol=[1.0],
+      dur=[rng.choice([1 / 4, 1 / 8, 1 / 8]) for _ in range(steps)],
+      cho=[[str(rng.randint(0, 4))] for _ in range(steps)])
+  changes = [dict(start=0, stop=None, every=None, over=None, state=state)]
+  return schedule.index(changes)
+
+
+def linear(track, start, stop):
+  state, since, _, _ = schedule.state(track, start)
+  dur = state['dur']
+  notes = []
+  time = since['dur']
+  index = 0
+  while time < stop:
+    if start - schedule.EPSILON <= time:
+      note = {key: value[index % len(value)] for key, value in state.items()}
+      notes.append((time, note))
+    time += dur[index % len(dur)]
+    index += 1
+  return notes
+
+
+def main():
+  track = song(steps=1000)
+  bar = 10000
+  args = lambda: (track, bar, bar + 0.5)
+  notes = schedule.query(*args())
+  reference = linear(*args())
+  assert [round(t, 6) for t, _ in notes] == [round(t, 6) for t, _ in reference]
+  print(f'Seek to bar {bar} of a 1000 step pattern ({len(notes)} notes):')
+  fast, _ = common.measure(args, schedule.query)
+  # Stepping takes long enough to only run it a few times.
+  slow, _ = common.measure(args, linear, repeats=3, budget=0)
+  print(f'  prefix sums: {fast:8.3f} ms')
+  print(f'  stepping:    {slow:8.3f} ms')
+  print(f'  speedup:     {slow / fast:8.1f}x')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,268 @@
+"""Benchmark suite of the compile and scheduling pipeline.
+
+Runs every case several times under CPython and reports the median time,
+and the peak memory allocated while the case runs. Memory is measured in a
+separate run with tracemalloc, so that tracing doesn't slow down the timing.
+The modules fall back to CPython when the browser module is missing, so the
+cases measure the same code that runs in the editor, only without Brython.
+
+Results are compared with the baselines in `benchmarks/baseline.json`, and
+cases that take longer or allocate more than the threshold allows are
+flagged. Medians are compared rather than the fastest times, because
+the fastest time of a run depends on whether it happened to catch a quiet
+moment of the machine. Whole processes can run slower than others too, so
+baselines are the median of a few processes, and a case only regresses when
+fresh processes confirm it. Baselines depend on the machine, so store new
+ones before comparing changes on another machine. Run from the repository
+root:
+
+  python benchmarks/suite.py              Compare with the baselines.
+  python benchmarks/suite.py --save       Store the results as baselines.
+  python benchmarks/suite.py -k compile   Only run cases matching a pattern.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import jamtyper
+import schedule
+import tools
+import wire
+from benchmarks import common
+
+
+BASELINE = os.path.join(ROOT, 'benchmarks', 'baseline.json')
+
+# Relative increase of time or memory over the baseline that is flagged.
+THRESHOLD = 0.25
+
+# Times below this many milliseconds are too noisy to flag.
+NOISE = 0.05
+
+# Fresh processes that measure a case again before it is flagged as a
+# regression, or that are added to the median of a new baseline.
+RETRIES = 2
+
+
+def changes(count=500):
+  # One player with many changes of the same properties.
+  lines = [
+      'import jamtyper as jt',
+      'p = jt.Player(cho=[0,2,4], dur=1/8, sca=jt.scales.e_major)']
+  for index in range(count):
+    lines.append(
+        f'p.at({index / 4}, vol={index % 8 / 8}, cho=[{index % 7},(0,2)])')
+  return '\n'.join(lines)
+
+
+def automation(tracks=10, count=20):
+  # Periodic changes that repeat over long stretches of the song.
+  lines = ['import jamtyper as jt']
+  for index in range(tracks):
+    lines.append(f'p{index} = jt.Player(cho=[0,3,1,3], dur=[1/8,1/16])')
+    for change in range(count):
+      lines.append(
+          f'p{index}.at({change * 4}, every={16 + change}, over={8 + change % 4}, '
+          f'lpf={500 + 100 * change}, vol={change % 5 / 4})')
+  return '\n'.join(lines)
+
+
+def cases():
+  """Get the cases as tuples of name, setup, and function.
+
+  The setup runs before every repetition and returns the arguments of the
+  function, which is what is measured.
+  """
+  players = _load('players')
+  seek = _load('seek')
+  songs = dict(
+      example=common.example(), tracks=common.synthetic(),
+      changes=changes(), automation=automation())
+  for name, function in players.cases():
+    yield f'player/{name}', _clear, function
+  yield 'player/preprocess_sca', _scales, _preprocess_scales
+  for name, source in songs.items():
+    yield f'execute/{name}', _clear, lambda source=source: _execute(source)
+  for name, source in songs.items():
+    yield f'compile/{name}', lambda source=source: _run(source), jamtyper.compile
+  for name, source in songs.items():
+    data = json.loads(common.compile(source))
+    yield f'wire/decode/{name}', lambda data=data: (data,), wire.decode
+  track = seek.song(steps=1000)
+  yield 'seek/query', lambda: (track, 10000, 10000.5), schedule.query
+  data = json.loads(common.compile(songs['tracks']))
+  yield 'events/tracks', lambda: (data, 0, 16), _events
+
+
+def compare(result, baseline, threshold):
+  """Get the reasons why a result regressed from its baseline."""
+  reasons = []
+  if not baseline:
+    return reasons
+  limit = baseline['time'] * (1 + threshold)
+  if result['time'] > limit and result['time'] - baseline['time'] > NOISE:
+    reasons.append('time')
+  if result['memory'] > baseline['memory'] * (1 + threshold) + 1:
+    reasons.append('memory')
+  return reasons
+
+
+def _load(name):
+  # The benchmarks are named after the modules they measure, so they are
+  # loaded under a prefix to not shadow them.
+  path = os.path.join(ROOT, 'benchmarks', f'{name}.py')
+  spec = importlib.util.spec_from_file_location(f'benchmarks_{name}', path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def _clear():
+  random.seed(0)
+  jamtyper.clear()
+
+
+def _run(source):
+  _clear()
+  exec(source, {'__name__': '__main__'})
+
+
+def _execute(source):
+  # End to end like an update in the editor, with a fresh code cache.
+  success, output = tools.execute(source, tools.CodeCache())
+  assert success, output
+  return jamtyper.compile()
+
+
+def _scales():
+  # Scales are cached once preprocessed, which is what is measured here.
+  jamtyper._scale_cache.clear()
+  return (list(jamtyper.scales.values()),)
+
+
+def _preprocess_scales(scales):
+  for scale in scales:
+    jamtyper._preprocess_sca(scale)
+
+
+def _events(data, start, stop):
+  for _ in jamtyper.events(data, start, stop):
+    pass
+
+
+def main(argv=None):
+  """Run the benchmark suite and compare the results with the baselines."""
+  parser = argparse.ArgumentParser(prog='suite.py', description=main.__doc__)
+  parser.add_argument(
+      '-k', dest='pattern', default='',
+      help='Only run cases whose name matches the regular expression.')
+  parser.add_argument(
+      '--repeats', type=int, default=5,
+      help='Least number of repetitions of every case.')
+  parser.add_argument(
+      '--threshold', type=float, default=THRESHOLD,
+      help='Relative increase over the baseline that counts as regression.')
+  parser.add_argument(
+      '--save', action='store_true',
+      help='Store the results as the new baselines.')
+  parser.add_argument('--baseline', default=BASELINE)
+  parser.add_argument('--measure', help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+  if args.measure:
+    # Measures a single case for the process that started this one.
+    for name, setup, function in cases():
+      if name == args.measure:
+        print(json.dumps(common.measure(setup, function, args.repeats)))
+        return 0
+    raise KeyError(args.measure)
+  stored = dict(cases={})
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      stored = json.load(f)
+  machine = dict(python=platform.python_version(), machine=platform.machine())
+  if stored['cases'] and stored.get('machine') != machine:
+    print(f"Baselines are from {stored.get('machine')}, not {machine}.")
+  results = {}
+  regressions = []
+  width = 28
+  print(
+      f"{'case':<{width}} {'ms':>9} {'base':>9} {'change':>7} "
+      f"{'KiB':>9} {'base':>9} {'change':>7}")
+  for name, setup, function in cases():
+    if not re.search(args.pattern, name):
+      continue
+    duration, memory = common.measure(setup, function, args.repeats)
+    if args.save:
+      durations = [duration] + [
+          _measure_fresh(name, args.repeats) for _ in range(RETRIES)]
+      duration = statistics.median(durations)
+    results[name] = dict(time=round(duration, 4), memory=round(memory, 1))
+    baseline = stored['cases'].get(name)
+    reasons = [] if args.save else compare(
+        results[name], baseline, args.threshold)
+    for _ in range(RETRIES):
+      if 'time' not in reasons:
+        break
+      duration = min(duration, _measure_fresh(name, args.repeats))
+      results[name]['time'] = round(duration, 4)
+      reasons = compare(results[name], baseline, args.threshold)
+    if reasons:
+      regressions.append(name)
+    line = f'{name:<{width}} {duration:9.3f} '
+    if baseline:
+      line += (
+          f"{baseline['time']:9.3f} {_change(duration, baseline['time'])} "
+          f"{memory:9.1f} {baseline['memory']:9.1f} "
+          f"{_change(memory, baseline['memory'])}")
+    else:
+      line += f"{'':>9} {'':>7} {memory:9.1f}"
+    if reasons:
+      line += f"  regressed in {' and '.join(reasons)}"
+    print(line)
+  if args.save:
+    # Cases that were not run keep their baselines.
+    stored['cases'].update(results)
+    stored['machine'] = machine
+    with open(args.baseline, 'w') as f:
+      json.dump(stored, f, indent=2, sort_keys=True)
+      f.write('\n')
+    print(f'Saved {len(results)} baselines to {args.baseline}.')
+    return 0
+  if regressions:
+    print(
+        f'{len(regressions)} of {len(results)} cases regressed by more '
+        f'than {args.threshold:.0%}.')
+    return 1
+  print(f'No regressions in {len(results)} cases.')
+  return 0
+
+
+def _measure_fresh(name, repeats):
+  # Median time of a case in a new process.
+  output = subprocess.run(
+      [sys.executable, os.path.abspath(__file__), '--measure', name,
+       '--repeats', str(repeats)],
+      capture_output=True, text=True, check=True).stdout
+  return json.loads(output)[0]
+
+
+def _change(value, baseline):
+  if not baseline:
+    return f"{'':>7}"
+  return f'{(value - baseline) / baseline:+7.0%}'
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,41 @@
+"""Compare the compact wire format with the plain JSON of the track index.
+
+Reports payload size, JSON parse time, and decode time on the example song
+and on a synthetic song with 50 tracks. Run from the repository root:
+
+  python benchmarks/wire.py
+"""
+
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import wire
+from benchmarks import common
+
+
+def main():
+  for name, source in (
+      ('example', common.example()), ('50 tracks', common.synthetic())):
+    data = json.loads(common.compile(source))
+    plain = json.dumps(wire.decode(data), separators=(',', ':'))
+    compact = json.dumps(data, separators=(',', ':'))
+    print(f'{name}:')
+    print(f'  size plain:    {len(plain) / 1024:8.1f} KiB')
+    print(f'  size compact:  {len(compact) / 1024:8.1f} KiB')
+    track = data['tracks'][0]
+    for label, setup, function in (
+        ('parse plain', lambda: (plain,), json.loads),
+        ('parse compact', lambda: (compact,), json.loads),
+        ('decode track', lambda: (data, track), wire.decode_track),
+        ('decode all', lambda: (data,), wire.decode)):
+      duration, _ = common.measure(setup, function)
+      print(f'  {label + ":":14} {duration:8.3f} ms')
+
+
+if __name__ == '__main__':
+  main()
@@ -1,4 +1,101 @@
+"""Publish the app to the repository of jamtyper.github.io.
+
+Builds the site from the files tracked in this repository and publishes it to
+a checkout of the GitHub Pages repository next to this one:
+
+  python deploy.py --bundle
+
+The scripts and styles that index.html loads are renamed after the hash of
+their content, so that browsers can cache them for as long as they like, and
+the references in index.html are rewritten. Text files get precompressed
+`.gz` variants and, when the brotli module is installed, `.br` variants. The
+published files are listed with their hashes in a manifest, so that a deploy
+only copies, removes, and commits the files that changed.
+
+The checkout is cloned from the remote if it doesn't exist yet, so a deploy
+can be tried out against a local repository:
+
+  git init --bare /tmp/site.git
+  python deploy.py --remote /tmp/site.git --checkout /tmp/site
+
+With `--bundle`, the page no longer loads the full standard library of
+Brython and every module of the app from source before it starts. Instead,
+the modules that the app imports are collected with their dependencies from
+the standard library into a single `brython_modules.js`, in the same format
+that `brython-cli --modules` writes. Brython keeps the modules of the bundle
+compiled in the indexedDB of the browser until the bundle changes. The full
+standard library is still loaded after startup for the modules that songs
+import.
+"""
+
+import argparse
+import ast
+import gzip
+import hashlib
+import json
 import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import urllib.request
+
+# Brotli is optional, without it only gzip variants are written.
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+
+# Release of Brython that index.html loads.
+BRYTHON = 'https://cdnjs.cloudflare.com/ajax/libs/brython/3.9.0/'
+
+# Script of the app that Brython runs on load.
+ENTRY = 'main.py'
+
+# Name of the bundle next to index.html.
+BUNDLE = 'brython_modules.js'
+
+# Modules that songs often import, bundled so that they work before the full
+# standard library has loaded.
+SONG_MODULES = (
+    'collections', 'functools', 'itertools', 'math', 'random', 'string')
+
+# Connection assumed for the estimated fetch time of the startup report, in
+# bits per second and seconds of round trip per request.
+FETCH_BANDWIDTH = 10e6
+FETCH_LATENCY = 0.05
+
+# Checkout of the site next to this repository.
+CHECKOUT = '../jamtyper.github.io'
+
+# Manifest of the published files in the checkout.
+MANIFEST = '.deploy.json'
+
+# Files that are precompressed, and the smallest size worth compressing.
+COMPRESSED = ('.css', '.html', '.ico', '.js', '.json', '.py', '.svg', '.txt')
+COMPRESS_SIZE = 256
+
+# Number of hex digits of the hashes in asset names.
+HASH_LENGTH = 10
+
+ASSET = re.compile(r'(?:src|href)="([^":#?]+)"')
+
+STDLIB_SCRIPT = re.compile(r'<script src="[^"]*brython_stdlib[^"]*"></script>')
+
+DEFERRED_STDLIB = """<script src="{bundle}"></script>
+<script>
+  // Modules of songs that are not bundled come from the full standard
+  // library, which only loads once the app is running.
+  window.addEventListener('load', () => {{
+    const script = document.createElement('script')
+    script.src = '{stdlib}'
+    document.body.appendChild(script)
+  }})
+</script>"""
+
 
 def sh(command):
   print('')
@@ -8,17 +105,340 @@ def sh(command):
   if error:
     raise RuntimeError(f'Exit code {error}.')
 
-def cd(directory):
-  print('')
-  print('cd', directory)
+
+def build(root, directory, stdlib=None):
+  """Build the site from the files tracked in the repository.
+
+  With the URL or path of the standard library of Brython, the modules of the
+  app are bundled. Returns the manifest of the built files.
+  """
+  files = subprocess.run(
+      ['git', 'ls-files', '-z'], cwd=root, check=True,
+      capture_output=True).stdout.decode('utf-8').split('\0')
+  for name in filter(None, files):
+    target = os.path.join(directory, name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy2(os.path.join(root, name), target)
+  if stdlib:
+    bundle(directory, stdlib)
+  _hash_assets(directory)
+  manifest = {}
+  for name in _files(directory):
+    manifest[name] = _digest(os.path.join(directory, name))
+    for variant in _compress(directory, name):
+      manifest[variant] = _digest(os.path.join(directory, variant))
+  return manifest
+
+
+def publish(directory, manifest, checkout, remote=None, message='Update.'):
+  """Copy the changes of a built site into the checkout, commit, and push.
+
+  Returns the names of the copied and the removed files.
+  """
+  if not os.path.exists(checkout):
+    assert remote, f'Need a remote to clone the checkout {checkout} from.'
+    sh(f'git clone {shlex.quote(remote)} {shlex.quote(checkout)}')
+  elif _git(checkout, 'branch', '--list'):
+    sh(f'git -C {shlex.quote(checkout)} pull --ff-only')
+  path = os.path.join(checkout, MANIFEST)
+  if os.path.exists(path):
+    with open(path) as f:
+      previous = json.load(f)
+  else:
+    # Without a manifest, everything in the checkout is from an older deploy.
+    previous = {name: None for name in _files(checkout)}
+  copied = []
+  for name, digest in sorted(manifest.items()):
+    target = os.path.join(checkout, name)
+    if previous.get(name) == digest and os.path.exists(target):
+      continue
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    shutil.copy2(os.path.join(directory, name), target)
+    copied.append(name)
+  removed = sorted(set(previous) - set(manifest))
+  for name in removed:
+    if os.path.exists(os.path.join(checkout, name)):
+      os.remove(os.path.join(checkout, name))
+  with open(path, 'w') as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+    f.write('\n')
+  print(f'Copied {len(copied)}, removed {len(removed)}, and kept '
+        f'{len(manifest) - len(copied)} files.')
+  # The checkout may also hold changes of a deploy that failed to commit.
+  if not _git(checkout, 'status', '--porcelain'):
+    return copied, removed
+  sh(f'git -C {shlex.quote(checkout)} add -A')
+  sh(f'git -C {shlex.quote(checkout)} commit -m {shlex.quote(message)}')
+  sh(f'git -C {shlex.quote(checkout)} push origin HEAD')
+  return copied, removed
+
+
+def bundle(directory, stdlib):
+  """Bundle the modules of the app in a directory and load them in the page.
+
+  The standard library is the path or URL of `brython_stdlib.js`. Returns the
+  names of the bundled modules.
+  """
+  library = _read_vfs(stdlib)
+  sources, imports = _app_modules(directory)
+  modules = {}
+  for name in _closure(imports | set(SONG_MODULES), library):
+    modules[name] = library[name]
+  for name, (source, imported) in sorted(sources.items()):
+    modules[name] = ['.py', source, sorted(imported)]
+  # Brython compiles the modules again when the timestamp changes. Deriving it
+  # from the content keeps it stable for unchanged bundles, so that they are
+  # not published again.
+  digest = hashlib.sha1(json.dumps(modules, sort_keys=True).encode('utf-8'))
+  modules['$timestamp'] = int(digest.hexdigest()[:12], 16)
+  content = (
+      f'__BRYTHON__.VFS_timestamp = {modules["$timestamp"]}\n'
+      '__BRYTHON__.use_VFS = true\n'
+      f'var scripts = {json.dumps(modules)}\n'
+      '__BRYTHON__.update_VFS(scripts)\n')
+  with open(os.path.join(directory, BUNDLE), 'w', encoding='utf-8') as f:
+    f.write(content)
+  index = os.path.join(directory, 'index.html')
+  with open(index, encoding='utf-8') as f:
+    page = f.read()
+  match = STDLIB_SCRIPT.search(page)
+  assert match, 'The page does not load the standard library of Brython.'
+  stdlib_url = re.search(r'src="([^"]*)"', match.group(0)).group(1)
+  page = page.replace(match.group(0), DEFERRED_STDLIB.format(
+      bundle=BUNDLE, stdlib=stdlib_url))
+  with open(index, 'w', encoding='utf-8') as f:
+    f.write(page)
+  names = sorted(name for name in modules if name != '$timestamp')
+  _report(library, sources, names, content)
+  return names
+
+
+def _hash_assets(directory):
+  # Renames the local files that index.html loads after their content and
+  # points the page to the new names. Modules that Python imports and data
+  # that it opens keep their names, because they are looked up by name.
+  index = os.path.join(directory, 'index.html')
+  with open(index, encoding='utf-8') as f:
+    page = f.read()
+  renamed = {}
+  for name in ASSET.findall(page):
+    path = os.path.join(directory, name)
+    if name in renamed or not os.path.isfile(path):
+      continue
+    stem, extension = os.path.splitext(name)
+    renamed[name] = f'{stem}.{_digest(path)[:HASH_LENGTH]}{extension}'
+    os.rename(path, os.path.join(directory, renamed[name]))
+  page = ASSET.sub(lambda match: match.group(0).replace(
+      match.group(1), renamed.get(match.group(1), match.group(1))), page)
+  with open(index, 'w', encoding='utf-8') as f:
+    f.write(page)
+  return renamed
+
+
+def _compress(directory, name):
+  # Writes the precompressed variants of a file that are smaller than it.
+  if not name.endswith(COMPRESSED):
+    return []
+  path = os.path.join(directory, name)
+  with open(path, 'rb') as f:
+    content = f.read()
+  if len(content) < COMPRESS_SIZE:
+    return []
+  # Without a timestamp, unchanged files compress to the same bytes.
+  variants = {'.gz': gzip.compress(content, 9, mtime=0)}
+  if brotli:
+    variants['.br'] = brotli.compress(content)
+  written = []
+  for extension, compressed in variants.items():
+    if len(compressed) >= len(content):
+      continue
+    with open(path + extension, 'wb') as f:
+      f.write(compressed)
+    written.append(name + extension)
+  return written
+
+
+def _files(directory):
+  names = []
+  for parent, directories, files in os.walk(directory):
+    directories[:] = [name for name in directories if name != '.git']
+    for name in files:
+      path = os.path.relpath(os.path.join(parent, name), directory)
+      names.append(path.replace(os.sep, '/'))
+  return sorted(names)
+
+
+def _digest(path):
+  with open(path, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def _git(checkout, *args):
+  return subprocess.run(
+      ['git', '-C', checkout, *args], check=True,
+      capture_output=True).stdout.decode('utf-8').strip()
+
+
+def _read_vfs(stdlib):
+  if re.match(r'^https?://', stdlib):
+    print(f'Fetching {stdlib}')
+    with urllib.request.urlopen(stdlib) as response:
+      content = response.read().decode('utf-8')
+  else:
+    with open(stdlib, encoding='utf-8') as f:
+      content = f.read()
+  start = content.index('{')
+  stop = content.rindex('__BRYTHON__.update_VFS')
+  library = json.loads(content[start:stop])
+  library.pop('$timestamp', None)
+  return library
+
+
+def _app_modules(directory):
+  # Modules of the app that the entry script imports, directly or through
+  # other modules of the app, and the names they import from elsewhere.
+  sources = {}
+  imports = set()
+  pending = [ENTRY[:-len('.py')]]
+  while pending:
+    name = pending.pop()
+    path = os.path.join(directory, name + '.py')
+    if name in sources:
+      continue
+    with open(path, encoding='utf-8') as f:
+      source = f.read()
+    imported = _imports(source)
+    # The entry script is loaded by the page itself.
+    if name + '.py' != ENTRY:
+      sources[name] = source, imported
+    for other in imported:
+      if os.path.exists(os.path.join(directory, other + '.py')):
+        pending.append(other)
+      else:
+        imports.add(other)
+  return sources, imports
+
+
+def _imports(source, script=False):
+  names = set()
+  walk = ast.walk if script else _walk
+  for node in walk(ast.parse(source)):
+    if isinstance(node, ast.Import):
+      names.update(alias.name for alias in node.names)
+    elif isinstance(node, ast.ImportFrom) and not node.level:
+      names.add(node.module)
+      # Names imported from a package may be submodules.
+      names.update(f'{node.module}.{alias.name}' for alias in node.names)
+  return names
+
+
+def _walk(tree):
+  # Like ast.walk() but skips the code that only runs when the module is
+  # executed as a script, which often imports test modules.
+  pending = [tree]
+  while pending:
+    node = pending.pop()
+    if _is_main(node):
+      continue
+    yield node
+    pending += ast.iter_child_nodes(node)
+
+
+def _is_main(node):
+  return (
+      isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and
+      isinstance(node.test.left, ast.Name) and
+      node.test.left.id == '__name__')
+
+
+def _closure(names, library):
+  # Modules of the standard library that the names need, including their
+  # parent packages. Names that are not in the library are either attributes
+  # or built into brython.js, like the browser module.
+  needed = set()
+  pending = list(names)
+  while pending:
+    name = pending.pop()
+    if name in needed or name not in library:
+      continue
+    needed.add(name)
+    pending += _dependencies(library[name])
+    parts = name.split('.')
+    pending += ['.'.join(parts[:i]) for i in range(1, len(parts))]
+  return sorted(needed)
+
+
+def _dependencies(module):
+  # The library lists every import of a module, including the ones of the
+  # script part. Modules written in JavaScript don't list their imports.
+  if module[0] != '.py':
+    return module[2] if len(module) > 2 else []
+  try:
+    script = _imports(module[1], script=True) - _imports(module[1])
+  except SyntaxError:
+    return module[2]
+  return [name for name in module[2] if name not in script]
+
+
+def _report(library, sources, names, content):
+  # Compares what the page has to fetch before it can start, with the full
+  # standard library and the app modules fetched one by one, and with the
+  # bundle. The fetch time only follows from the compressed size and the
+  # number of requests on the connection given above. It is not a measured
+  # load time and leaves out the time Brython takes to compile the modules.
+  full = json.dumps(library)
+  before = dict(
+      modules=len(library) + len(sources), requests=1 + len(sources),
+      size=len(full.encode('utf-8')), compressed=_compressed(full))
+  for source, _ in sources.values():
+    before['size'] += len(source.encode('utf-8'))
+    before['compressed'] += _compressed(source)
+  after = dict(
+      modules=len(names), requests=1,
+      size=len(content.encode('utf-8')), compressed=_compressed(content))
   print('')
-  os.chdir(directory)
-
-cd('../jamtyper.github.io')
-sh('rm -rf *')
-sh('cp -R ../jamtyper/* .')
-# sh('cp index.html 404.html')
-sh('echo "jamtyper.com" > CNAME')
-sh('git add -A')
-sh('git commit -m "Update."')
-sh('git push')
+  print(f'{"Startup":<12}{"before":>12}{"after":>12}')
+  for label, key in [('Modules', 'modules'), ('Requests', 'requests')]:
+    print(f'{label:<12}{before[key]:>12}{after[key]:>12}')
+  for label, key in [('Size', 'size'), ('Compressed', 'compressed')]:
+    print(f'{label:<12}{before[key] / 1024:>10.0f}KB{after[key] / 1024:>10.0f}KB')
+  fetch = lambda x: (
+      8 * x['compressed'] / FETCH_BANDWIDTH + FETCH_LATENCY * x['requests'])
+  print(f'{"Fetch (est.)":<12}{fetch(before):>11.2f}s{fetch(after):>11.2f}s')
+
+
+def _compressed(text):
+  return len(gzip.compress(text.encode('utf-8')))
+
+
+def main(argv=None):
+  """Publish the app to jamtyper.github.io."""
+  parser = argparse.ArgumentParser(prog='deploy.py', description=main.__doc__)
+  parser.add_argument(
+      '--bundle', action='store_true',
+      help='Bundle the imported modules instead of loading them from source.')
+  parser.add_argument(
+      '--stdlib', default=BRYTHON + 'brython_stdlib.js',
+      help='Path or URL of brython_stdlib.js to take modules from.')
+  parser.add_argument(
+      '--checkout', default=CHECKOUT,
+      help='Checkout of the site to publish to.')
+  parser.add_argument(
+      '--remote', default=None,
+      help='Repository to clone the checkout from if it does not exist.')
+  args = parser.parse_args(argv)
+  root = os.path.dirname(os.path.abspath(__file__))
+  stdlib = args.stdlib if args.bundle else None
+  if stdlib and not re.match(r'^https?://', stdlib):
+    stdlib = os.path.abspath(stdlib)
+  revision = _git(root, 'rev-parse', '--short', 'HEAD')
+  with tempfile.TemporaryDirectory() as directory:
+    manifest = build(root, directory, stdlib)
+    publish(
+        directory, manifest, os.path.join(root, args.checkout), args.remote,
+        f'Update to {revision}.')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
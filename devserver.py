@@ -0,0 +1,147 @@
+"""Local development server with a stand-in for the song database.
+
+Serves the files of the repository and answers the subset of the Firebase
+Realtime Database REST API that the interface uses under `/db/`. Records can
+only be created, like with the rules of the real database in the README.
+Start the server and point the database setting to it:
+
+  python devserver.py --port 8000
+  {"database": "http://localhost:8000/db/songs/data"}
+
+Records are kept in memory, or in a JSON file if one is given.
+"""
+
+import argparse
+import functools
+import http.server
+import json
+import os
+import secrets
+import threading
+import time
+
+
+PREFIX = '/db/'
+
+# Characters of the push keys of Firebase, ordered like their code points so
+# that keys sort by creation time.
+ALPHABET = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+class Database:
+
+  def __init__(self, path=None):
+    self._path = path
+    self._lock = threading.Lock()
+    self._records = {}
+    if path and os.path.exists(path):
+      with open(path) as f:
+        self._records = json.load(f)
+
+  def get(self, key):
+    with self._lock:
+      return self._records.get(key)
+
+  def create(self, key, value):
+    """Store a record and get whether the key was still free."""
+    with self._lock:
+      if key in self._records:
+        return False
+      self._records[key] = value
+      if self._path:
+        with open(self._path, 'w') as f:
+          json.dump(self._records, f)
+      return True
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+
+  def __init__(self, *args, database, **kwargs):
+    self._database = database
+    super().__init__(*args, **kwargs)
+
+  def end_headers(self):
+    self.send_header('Access-Control-Allow-Origin', '*')
+    self.send_header('Access-Control-Allow-Methods', 'GET, POST, PUT')
+    self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+    super().end_headers()
+
+  def do_OPTIONS(self):
+    self.send_response(204)
+    self.end_headers()
+
+  def do_GET(self):
+    key = self._key()
+    if key is None:
+      return super().do_GET()
+    self._reply(200, self._database.get(key))
+
+  def do_POST(self):
+    key = self._key()
+    if key is None:
+      return self._reply(404, {'error': 'Not found.'})
+    name = _push_key()
+    self._database.create(f'{key}/{name}', self._body())
+    self._reply(200, {'name': name})
+
+  def do_PUT(self):
+    key = self._key()
+    if key is None:
+      return self._reply(404, {'error': 'Not found.'})
+    value = self._body()
+    if not self._database.create(key, value):
+      return self._reply(401, {'error': 'Permission denied'})
+    self._reply(200, value)
+
+  def _key(self):
+    path = self.path.split('?')[0]
+    if not path.startswith(PREFIX) or not path.endswith('.json'):
+      return None
+    return path[len(PREFIX):-len('.json')].strip('/')
+
+  def _body(self):
+    length = int(self.headers.get('Content-Length', 0))
+    return json.loads(self.rfile.read(length) or 'null')
+
+  def _reply(self, status, value):
+    content = json.dumps(value).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+
+def _push_key():
+  stamp = int(time.time() * 1000)
+  chars = []
+  for _ in range(8):
+    chars.append(ALPHABET[stamp % 64])
+    stamp //= 64
+  chars.reverse()
+  chars += [secrets.choice(ALPHABET) for _ in range(12)]
+  return ''.join(chars)
+
+
+def main(argv=None):
+  """Serve the app and a local song database."""
+  parser = argparse.ArgumentParser(prog='devserver.py', description=main.__doc__)
+  parser.add_argument('--port', type=int, default=8000)
+  parser.add_argument(
+      '--data', default=None,
+      help='JSON file to keep the records in, defaults to memory only.')
+  args = parser.parse_args(argv)
+  root = os.path.dirname(os.path.abspath(__file__))
+  handler = functools.partial(
+      Handler, database=Database(args.data), directory=root)
+  server = http.server.ThreadingHTTPServer(('localhost', args.port), handler)
+  print(f'Serving on http://localhost:{args.port}/')
+  print(f'Database at http://localhost:{args.port}{PREFIX}songs/data')
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -13,10 +13,12 @@ class Editor:
         inputStyle='textarea', lineWrapping=True))
     self.bind_key('Tab', self._tab)
     self.bind_key('Ctrl-/', lambda: self._cm.execCommand('toggleComment'))
+    # Fires once per operation, even if it changed several places.
+    self._cm.on('changes', lambda *_: self._changed())
     self.set_settings(**kwargs)
 
   def on(self, event, callback):
-    assert event in ('error',)
+    assert event in ('error', 'change')
     if event not in self._listeners:
       self._listeners[event] = []
     self._listeners[event].append(callback)
@@ -52,6 +54,10 @@ class Editor:
     for callback in self._listeners['error']:
       callback(error)
 
+  def _changed(self):
+    for callback in self._listeners.get('change', []):
+      callback()
+
   def _tab(self):
     if self._cm.somethingSelected():
       self._cm.indentSelection('add')
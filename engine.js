@@ -37,10 +37,6 @@ function sorted(arr) {
   return arr.sort((a, b) => a - b)
 }
 
-function jsonEqual(a, b) {
-  return JSON.stringify(a) === JSON.stringify(b)
-}
-
 function sum(coll) {
   return coll.reduce((a, b) => a + b, 0)
 }
@@ -49,10 +45,111 @@ function modulo(value, size) {
   return ((value % size) + size) % size
 }
 
+function cycle(value, index) {
+  // Values of properties are lists that are cycled through or compiled
+  // patterns. Mirrors schedule.cycle() in Python.
+  if (Array.isArray(value))
+    return value[index % value.length]
+  if (value['length'] !== null)
+    index %= value['length']
+  return value['items'][expandPattern(value['pattern'], index)]
+}
+
+function cycleItems(value) {
+  return Array.isArray(value) ? value : value['items']
+}
+
+function cycleLength(value) {
+  return Array.isArray(value) ? value.length : value['length']
+}
+
+function expandPattern(descriptor, step) {
+  // Mirrors patterns.expand() in Python.
+  switch (descriptor[0]) {
+    case 'seq': {
+      const [_, base, count] = descriptor
+      return base + step % count
+    }
+    case 'rand': {
+      // Songs saved before the length was part of the descriptor never
+      // repeat.
+      const [_, base, count, seed, length] = descriptor
+      if (length != null)
+        step %= length
+      return base + patternHash(seed, step) % count
+    }
+    case 'euclid': {
+      const [_, base, hits, steps, rotate] = descriptor
+      const position = (step + rotate) % steps
+      return base + (position * hits % steps < hits ? 1 : 0)
+    }
+    case 'rep': {
+      const [_, child, times] = descriptor
+      return expandPattern(child, Math.floor(step / times))
+    }
+    case 'cat': {
+      const [_, children, lengths] = descriptor
+      step %= sum(lengths)
+      for (let [child, length] of zip(children, lengths)) {
+        if (step < length)
+          return expandPattern(child, step)
+        step -= length
+      }
+    }
+    case 'mix': {
+      const [_, children] = descriptor
+      return expandPattern(children[step % children.length], Math.floor(step / children.length))
+    }
+  }
+  throw new Error(`Unknown pattern ${descriptor[0]}.`)
+}
+
+function patternHash(seed, step) {
+  // 32 bit integer hash that matches patterns._hash() in Python.
+  let x = (Math.imul(seed, 0x9E3779B1) + Math.imul(step, 0x85EBCA77)) >>> 0
+  x = (x ^ (x >>> 16)) >>> 0
+  x = Math.imul(x, 0x7FEB352D) >>> 0
+  x = (x ^ (x >>> 15)) >>> 0
+  x = Math.imul(x, 0x846CA68B) >>> 0
+  x = (x ^ (x >>> 16)) >>> 0
+  return x
+}
+
+function bisectLeft(arr, value) {
+  // Index of the first element that is not smaller than the value.
+  let lo = 0, hi = arr.length
+  while (lo < hi) {
+    const mid = (lo + hi) >> 1
+    if (arr[mid] < value) lo = mid + 1
+    else hi = mid
+  }
+  return lo
+}
+
+function bisectRight(arr, value) {
+  // Index of the first element that is larger than the value.
+  let lo = 0, hi = arr.length
+  while (lo < hi) {
+    const mid = (lo + hi) >> 1
+    if (arr[mid] <= value) lo = mid + 1
+    else hi = mid
+  }
+  return lo
+}
+
 /*****************************************************************************/
 // Sound helpers
 /*****************************************************************************/
 
+const MIDI_FREQUENCIES = [...Array(128).keys()].map(
+    midi => 440 * 2 ** ((midi - 69) / 12))
+
+function midiToFrequency(midi) {
+  if (0 <= midi && midi < MIDI_FREQUENCIES.length)
+    return MIDI_FREQUENCIES[midi]
+  return 440 * 2 ** ((midi - 69) / 12)
+}
+
 function ratioToDecibels(ratio) {
   return 10 * Math.log10(ratio)
 }
@@ -66,71 +163,375 @@ function disconnectOutputs(audioNode) {
     audioNode.disconnect(i)
 }
 
+const JAMTYPER_BANK_MAGIC = 'JTBK'
+const JAMTYPER_BANK_VERSION = 1
+
+function readBank(data) {
+  // Parses a sample bank written by banks.py into its index and the PCM data.
+  // Typed arrays use the byte order of the platform, which is little endian
+  // like the file in all browsers.
+  const view = new DataView(data)
+  const magic = String.fromCharCode(...new Uint8Array(data, 0, 4))
+  if (magic != JAMTYPER_BANK_MAGIC)
+    throw new Error('Not a sample bank.')
+  const version = view.getUint32(4, true)
+  if (version != JAMTYPER_BANK_VERSION)
+    throw new Error(`Unsupported sample bank version ${version}.`)
+  const length = view.getUint32(8, true)
+  const bank = JSON.parse(new TextDecoder().decode(new Uint8Array(data, 12, length)))
+  bank.pcm = new Int16Array(data, 12 + length)
+  return bank
+}
+
+function bankBuffer(bank, note) {
+  // Copies a sample of a bank into an audio buffer. The channels of a sample
+  // are stored one after the other.
+  if (!bank['samples'].hasOwnProperty(note))
+    throw new Error(`Sample bank has no tone ${note}.`)
+  const [offset, frames] = bank['samples'][note]
+  const buffer = tone.context.createBuffer(bank['channels'], frames, bank['rate'])
+  for (let channel = 0; channel < bank['channels']; channel++) {
+    const data = buffer.getChannelData(channel)
+    const start = offset + channel * frames
+    for (let i = 0; i < frames; i++)
+      data[i] = bank.pcm[start + i] / 32768
+  }
+  return buffer
+}
+
+/*****************************************************************************/
+// Songs
+/*****************************************************************************/
+
+const JAMTYPER_WIRE_VERSION = 2
+
+
+class Song {
+
+  // A song compiled by jamtyper.compile(). Tracks in the compact wire format
+  // are decoded the first time the scheduler needs them. The decoding mirrors
+  // wire.decode_track() in Python.
+
+  constructor(data) {
+    this.bpm = data['bpm']
+    this.volume = data['volume']
+    this.version = data['version'] || 1
+    if (this.version != 1 && this.version != JAMTYPER_WIRE_VERSION)
+      throw new Error(`Unsupported song format version ${this.version}.`)
+    this._data = data
+    this._tracks = data['tracks'].map(() => null)
+    this._defaults = null
+  }
+
+  get length() {
+    return this._tracks.length
+  }
+
+  hash(track) {
+    return this._data['tracks'][track]['hash']
+  }
+
+  track(track) {
+    if (this._tracks[track] === null) {
+      const data = this._data['tracks'][track]
+      this._tracks[track] = this.version == 1 ? data : this._decode(data)
+    }
+    return this._tracks[track]
+  }
+
+  samples() {
+    // Collects the sample URLs of all tracks without decoding them.
+    const sams = []
+    if (this.version == 1) {
+      for (let index of this._data['tracks'])
+        for (let state of index['states'].concat(index['periodic'].map(change => change['state'])))
+          if (state.hasOwnProperty('sam'))
+            sams.push(...cycleItems(state['sam']))
+    } else {
+      const key = this._data['keys'].indexOf('sam')
+      const ids = [this._data['defaults'][key]]
+      for (let index of this._data['tracks'])
+        for (let pairs of index['states'].concat(index['periodic']['state']))
+          for (let i = 0; i < pairs.length; i += 2)
+            if (pairs[i] == key && pairs[i + 1] !== null)
+              ids.push(pairs[i + 1])
+      for (let id of new Set(ids))
+        sams.push(...cycleItems(this._data['values'][id]))
+    }
+    return [...new Set(sams.flatMap(sam => Object.values(sam)))]
+  }
+
+  _decode(encoded) {
+    const keys = this._data['keys']
+    const values = this._data['values']
+    if (this._defaults === null) {
+      this._defaults = {}
+      for (let [key, value] of zip(keys, this._data['defaults']))
+        this._defaults[key] = values[value]
+    }
+    const states = encoded['states'].map(pairs => {
+      const state = Object.assign({}, this._defaults)
+      for (let i = 0; i < pairs.length; i += 2) {
+        if (pairs[i + 1] === null)
+          delete state[keys[pairs[i]]]
+        else
+          state[keys[pairs[i]]] = values[pairs[i + 1]]
+      }
+      return state
+    })
+    const since = []
+    let current = {}
+    for (let pairs of encoded['since']) {
+      current = Object.assign({}, current)
+      for (let i = 0; i < pairs.length; i += 2) {
+        if (pairs[i + 1] === null)
+          delete current[keys[pairs[i]]]
+        else
+          current[keys[pairs[i]]] = pairs[i + 1]
+      }
+      since.push(current)
+    }
+    const columns = encoded['periodic']
+    const periodic = columns['start'].map((start, i) => {
+      const state = {}
+      const pairs = columns['state'][i]
+      for (let j = 0; j < pairs.length; j += 2)
+        state[keys[pairs[j]]] = values[pairs[j + 1]]
+      return {
+        start: start, stop: columns['stop'][i], every: columns['every'][i],
+        over: columns['over'][i], state: state}
+    })
+    const lanes = {}
+    for (let [key, times, laneValues] of encoded['lanes'])
+      lanes[keys[key]] = {times: times, values: laneValues}
+    return prepareTrack({
+      hash: encoded['hash'],
+      times: encoded['times'],
+      states: states,
+      since: since,
+      layers: encoded['layers'].map(layers => layers.map(
+          ([ident, layer]) => [ident, layer.map(key => keys[key])])),
+      periodic: periodic,
+      lanes: lanes,
+    })
+  }
+}
+
+
+function prepareTrack(track) {
+  // Adds the prefix sums of the durations and the cycled keys of the states.
+  // Mirrors schedule.prepare() in Python.
+  const steps = state => {
+    if (!state.hasOwnProperty('dur'))
+      return null
+    const offsets = []
+    let total = 0
+    for (let index = 0; index < cycleLength(state['dur']); index++) {
+      offsets.push(total)
+      total += cycle(state['dur'], index)
+    }
+    return {offsets: offsets, total: total}
+  }
+  const cycled = state => Object.keys(state).filter(key => cycleLength(state[key]) !== 1)
+  track['steps'] = track['states'].map(steps)
+  track['cycled'] = track['states'].map(cycled)
+  for (let change of track['periodic']) {
+    change['steps'] = steps(change['state'])
+    change['cycled'] = cycled(change['state'])
+  }
+  return track
+}
+
+
 /*****************************************************************************/
 // Sound engine
 /*****************************************************************************/
 
-const JAMTYPER_LOOK_AHEAD = 0.5
+// Length of the windows the scheduler queries in bars and the look-ahead of
+// the audio context in seconds. The look-ahead grows when ticks are late.
+const JAMTYPER_MODES = {
+  live: {window: 1 / 16, latency: 0.05},
+  playback: {window: 0.5, latency: 0.5},
+}
+const JAMTYPER_MAX_LATENCY = 1.0
+const JAMTYPER_JITTER_TICKS = 16
+const JAMTYPER_VOICES = 32
+const JAMTYPER_SAMPLE_MEMORY = 256 * 2 ** 20
+const JAMTYPER_EPSILON = 1e-6
+const JAMTYPER_STATS_TICKS = 120
+
+function stepTime(since, offsets, total, index) {
+  // Computing the time from the index avoids accumulating rounding errors.
+  const completed = Math.floor(index / offsets.length)
+  return since + completed * total + offsets[index - completed * offsets.length]
+}
 
 
 class Engine {
 
   constructor() {
-    this.time = 0
+    this._time = 0
     this._song = null
     this._instruments = new Map()
-    this._sample_cache = new Map()
+    this.pool = new VoicePool(JAMTYPER_VOICES)
+    this.samples = new SampleCache(JAMTYPER_SAMPLE_MEMORY)
+    this.ticks = new TickStats(JAMTYPER_STATS_TICKS)
+    // Events on the transport that didn't fire yet, by id with their time in
+    // the song, and the song and transport time of the last tick.
+    this._queued = new Map()
+    this._mark = null
+    // Audio time of the tick that is being processed, while it is.
+    this._pulse = null
+    this._repeat = null
+    this._jitter = []
+    this._resumed = true
+    this._late = 0
+    this._dropped = 0
     // tone.context.latencyHint = 'playback'
-    tone.context.lookAhead = 0.5
     tone.Transport.cancel()
     this._loop = this._loop.bind(this)
-    tone.Transport.scheduleRepeat(
-      this._loop, JAMTYPER_LOOK_AHEAD + ':0:0')
+    this.setLookAhead('playback')
+  }
+
+  get time() {
+    return this._time
+  }
+
+  set time(time) {
+    // Seeking drops everything that was queued for the previous position.
+    this._cancel(-Infinity)
+    this._mark = null
+    this._resumed = true
+    this._time = time
+  }
+
+  setLookAhead(mode) {
+    // Live mode queries short windows and keeps the latency low, so that
+    // edits are heard quickly. Playback mode queries long windows and wakes
+    // up less often.
+    if (!(mode in JAMTYPER_MODES))
+      throw new Error(`Unknown look-ahead mode '${mode}'.`)
+    this._mode = mode
+    this._window = JAMTYPER_MODES[mode].window
+    this._jitter = []
+    this._resumed = true
+    tone.context.lookAhead = JAMTYPER_MODES[mode].latency
+    if (this._repeat !== null)
+      tone.Transport.clear(this._repeat)
+    // Continue right where the windows of the previous mode ended.
+    const start = this._mark ? this._transportTime(this._time) : 0
+    this._repeat = tone.Transport.scheduleRepeat(
+      this._loop, this._window + ':0:0', start)
   }
 
   playing() {
     return tone.Transport.state == 'started'
   }
 
+  position() {
+    // Time in the song that is heard right now, or null after seeking until
+    // the next tick. The time above runs ahead of it by up to a window and the
+    // latency.
+    if (!this._mark)
+      return null
+    if (!this.playing())
+      return this._time
+    return this._songTime(tone.Transport.getSecondsAtTime(tone.context.currentTime))
+  }
+
+  get latency() {
+    // Seconds from scheduling a tick until it is heard.
+    return tone.context.lookAhead
+  }
+
+  stats() {
+    return {
+      instruments: this._instruments.size,
+      voices: this.pool.stats(),
+      samples: this.samples.stats(),
+      ticks: this.ticks.summary(),
+    }
+  }
+
   update(definition) {
-    const song = JSON.parse(definition)
-    const tracks = uniq(song['changes'].map(change => change['track']))
-    const old = new Map(this._instruments)
+    const song = new Song(JSON.parse(definition))
     setTimeout(() => {
+      const old = new Map(this._instruments)
+      const previous = this._song
       this._song = song
-      // Load sample files. Later, we can have this function block until they
-      // are loaded, so they song does not start early.
-      for (let change of song['changes']) {
-        if (change['state'].hasOwnProperty('sam')) {
-          for (let sam of change['state']['sam']) {
-            for (let [key, url] of Object.entries(sam)) {
-              if (!this._sample_cache.has(url)) {
-                let buffer = new tone.ToneAudioBuffer(url)
-                buffer.url = url
-                this._sample_cache.set(url, buffer)
-              }
-              let buffer = this._sample_cache.get(url)
-              change['state']['sam'][key] = buffer
-      }}}}
-      console.log('Updated song.')
-      // Replace the sound instruments.
-      this._instruments = new Map(tracks.map(track => [track, new Instrument()]))
-      tone.Transport.bpm.value = song['bpm']
-      tone.Destination.volume.value = ratioToDecibels(song['volume'])
+      // Start decoding the samples of the song right away. They are kept in
+      // the cache while the song uses them, and samples of earlier songs are
+      // only evicted when the cache runs out of memory.
+      this.samples.pin(song.samples())
+      // Keep the instruments of tracks whose definition didn't change, even
+      // when they moved to a different position, and only build new ones for
+      // tracks that were added or modified.
+      const unchanged = new Map()
+      for (let [track, instrument] of old.entries()) {
+        const hash = previous.hash(track)
+        if (!unchanged.has(hash))
+          unchanged.set(hash, [])
+        unchanged.get(hash).push(instrument)
+      }
+      this._instruments = new Map()
+      for (let track = 0; track < song.length; track++) {
+        const reusable = unchanged.get(song.hash(track)) || []
+        const instrument = reusable.length ? reusable.shift() : new Instrument(this.pool, this.samples)
+        this._instruments.set(track, instrument)
+      }
+      const removed = [...unchanged.values()].flat()
+      const kept = old.size - removed.length
+      console.log(
+          `Updated song: kept ${kept}, built ${song.length - kept}, ` +
+          `removed ${removed.length} tracks.`)
+      tone.Transport.bpm.value = song.bpm
+      tone.Destination.volume.value = ratioToDecibels(song.volume)
+      this._reschedule()
       setTimeout(() => {
-        for (let instrument of old.values())
+        for (let instrument of removed)
           instrument.close()
       }, 5000)
     }, 0)
   }
 
+  prepare(bars, timeout) {
+    // Waits until the samples of the next bars are decoded, but no longer
+    // than the timeout in milliseconds. Resolves with the number of samples
+    // needed and how many of them are still missing. The audio context is
+    // started here because it has to happen in response to the user.
+    tone.start()
+    const urls = new Set()
+    if (this._song !== null) {
+      for (let track of this._instruments.keys())
+        for (let [_, state] of this._query(track, this._time, this._time + bars))
+          for (let url of Object.values(state['sam']))
+            urls.add(url)
+    }
+    const began = performance.now()
+    const report = () => ({
+      samples: urls.size,
+      missing: [...urls].filter(url => !this.samples.loaded(url)).length,
+      waited: performance.now() - began,
+    })
+    let timer = null
+    return Promise.race([
+      this.samples.load([...urls]),
+      new Promise(resolve => timer = setTimeout(resolve, timeout)),
+    ]).then(() => {
+      clearTimeout(timer)
+      return report()
+    })
+  }
+
   toggle() {
     tone.start()
+    this._resumed = true
     tone.Transport.toggle('+0.01')
   }
 
   play() {
     tone.start()
+    this._resumed = true
     tone.Transport.start('+0.01')
   }
 
@@ -140,96 +541,303 @@ class Engine {
   }
 
   _loop(pulse) {
+    const began = performance.now()
+    // How far ahead of the audio clock this tick schedules. When it gets
+    // close to zero, notes come late.
+    const slack = pulse - tone.context.currentTime
+    // The first tick after starting, seeking, or changing the mode comes
+    // early or late by design, so it says nothing about the jitter.
+    if (!this._resumed)
+      this._adapt(slack)
+    this._resumed = false
+    this._mark = [this._time, tone.Transport.getSecondsAtTime(pulse)]
+    this._pulse = pulse
+    const [querying, events] = this._schedule(this._time, this._time + this._window)
+    this._pulse = null
+    this._time += this._window
+    this.ticks.record({
+      query: querying,
+      total: performance.now() - began,
+      events: events,
+      slack: slack,
+      late: this._late,
+      dropped: this._dropped,
+      instruments: this._instruments.size,
+      synths: this.pool.size,
+      lookAhead: tone.context.lookAhead,
+    })
+    this._late = 0
+    this._dropped = 0
+  }
+
+  _schedule(start, stop) {
+    // Queues the automation and notes of all tracks within a time frame on
+    // the transport, so that they can be cancelled until they fire. Returns
+    // the time spent querying and the number of notes.
+    let querying = 0
+    let events = 0
     for (let [track, instrument] of this._instruments.entries()) {
-      const events = this._query(track, this.time, this.time + JAMTYPER_LOOK_AHEAD)
-      for (let [time, state] of events) {
-        const offset = tone.Transport.toSeconds((time - this.time) + ':0:0')
-        instrument.call(pulse + offset, state)
+      // Effect automation and notes are handed to the instrument in time
+      // order, with automation first when both happen at the same time.
+      const queried = performance.now()
+      const points = this._get_automation(track, start, stop)
+      const notes = this._query(track, start, stop)
+      querying += performance.now() - queried
+      const automate = ([time, values]) => this._queue(
+        time, pulse => instrument.automate(pulse, values))
+      let point = 0
+      for (let [time, state] of notes) {
+        for (; point < points.length && points[point][0] <= time; point++)
+          automate(points[point])
+        this._queue(time, pulse => {
+          if (pulse < tone.context.currentTime)
+            this._late += 1
+          if (!instrument.call(pulse, state))
+            this._dropped += 1
+        })
+        events += 1
       }
+      for (; point < points.length; point++)
+        automate(points[point])
+    }
+    return [querying, events]
+  }
+
+  _queue(time, callback) {
+    // Tone only fires the events that were on the transport when the tick
+    // began, so events at the start of the window of this tick would never
+    // fire. They are handed to the instrument right away instead, which
+    // is how every note on the grid of the live mode is played.
+    if (this._pulse !== null && time <= this._mark[0] + JAMTYPER_EPSILON) {
+      callback(this._pulse)
+      return
     }
-    this.time += JAMTYPER_LOOK_AHEAD
+    const id = tone.Transport.scheduleOnce(pulse => {
+      this._queued.delete(id)
+      callback(pulse)
+    }, this._transportTime(time))
+    this._queued.set(id, time)
+  }
+
+  _cancel(time) {
+    // Removes the queued events at or after a time in the song.
+    for (let [id, queued] of this._queued.entries()) {
+      if (queued >= time - JAMTYPER_EPSILON) {
+        tone.Transport.clear(id)
+        this._queued.delete(id)
+      }
+    }
+  }
+
+  _reschedule() {
+    // Queues the rest of the scheduled time frame again from the new song,
+    // starting at the first time whose events can't have fired yet.
+    if (!this._mark)
+      return
+    const horizon = tone.Transport.getSecondsAtTime(
+      tone.context.currentTime + tone.context.lookAhead +
+      tone.context.updateInterval)
+    const effective = Math.min(Math.max(this._songTime(horizon), this._mark[0]), this._time)
+    this._cancel(effective)
+    if (effective < this._time)
+      this._schedule(effective, this._time)
+  }
+
+  _adapt(slack) {
+    // Tone wakes the scheduler up one look-ahead before the pulse. When the
+    // main thread is busy, it wakes up late and the slack shrinks by that
+    // jitter. The look-ahead is kept at twice the worst recent jitter, but
+    // never below the latency of the mode.
+    this._jitter.push(tone.context.lookAhead - slack)
+    if (this._jitter.length > JAMTYPER_JITTER_TICKS)
+      this._jitter.shift()
+    const latency = JAMTYPER_MODES[this._mode].latency
+    tone.context.lookAhead = Math.min(
+      Math.max(latency, 2 * Math.max(...this._jitter)), JAMTYPER_MAX_LATENCY)
+  }
+
+  _transportTime(time) {
+    // Transport time in seconds of a time in the song, relative to the last
+    // tick.
+    const [songTime, transportTime] = this._mark || [this._time, tone.Transport.seconds]
+    return transportTime + tone.Transport.toSeconds((time - songTime) + ':0:0')
+  }
+
+  _songTime(transportTime) {
+    const [songTime, markTime] = this._mark
+    return songTime + (transportTime - markTime) / tone.Transport.toSeconds('1:0:0')
   }
 
   _query(track, start, stop) {
     // Returns the sound events that occur within a time frame. We traverse the
     // time frame in non-overlapping intervals. When an interval contains a
     // note, it is added to the result list. The interval boundaries are
-    // initialized to the times of state changes. For each interval, we step
-    // through the active loop to find any notes inside the interval.
+    // initialized to the times of state changes. For each interval, we find
+    // the first note of the active loop by binary search in the prefix sums
+    // of its durations and step from there. Mirrors schedule.query().
     const events = []
     const times = uniq([start, stop].concat(this._get_events(track, start, stop)))
     for (let [lhs, rhs] of zip(slice(times, 0, -1), slice(times, 1, null))) {
-      const [state, since] = this._get_state(track, lhs)
-      const dur = Array.isArray(state['dur']) ? state['dur'] : [state['dur']]
-      // To compute the loop index, we see how many notes have been played
-      // since the duration property was changed the last time.
-      let completed = Math.floor((start - since['dur']) / sum(dur))
-      let time = since['dur'] + completed * sum(dur)
-      let index = completed * dur.length
-      while (time < rhs) {
-        // console.log(time, rhs)
-        if (lhs - 1e-6 <= time && time < rhs) {
-          let prepared = Object.assign({}, state)
-          // for (let [key, value] of Object.entries(prepared))
-          //   if (Array.isArray(value))
-          //     prepared[key] = value[index % value.length]
-          for (let [key, value] of Object.entries(prepared))
-            prepared[key] = value[index % value.length]
-          if (prepared['act'] && prepared['cho'] && prepared['cho'].length > 0)
-            events.push([time, prepared])
-        }
-        time += dur[index % dur.length]
+      const [state, since, steps, cycled] = this._get_state(track, lhs)
+      if (!steps || steps['total'] <= 0)
+        continue
+      const offsets = steps['offsets']
+      const total = steps['total']
+      // Notes share the values that don't cycle and only set the others.
+      const base = {}
+      for (let [key, value] of Object.entries(state))
+        base[key] = cycle(value, 0)
+      const elapsed = lhs - JAMTYPER_EPSILON - since['dur']
+      const completed = Math.floor(elapsed / total)
+      let index = completed * offsets.length + bisectLeft(offsets, elapsed - completed * total)
+      let time = stepTime(since['dur'], offsets, total, index)
+      while (time < rhs - JAMTYPER_EPSILON) {
+        const prepared = Object.create(base)
+        for (let key of cycled)
+          prepared[key] = cycle(state[key], index)
+        if (prepared['act'] && prepared['cho'] && prepared['cho'].length > 0)
+          events.push([time, prepared])
         index += 1
+        time = stepTime(since['dur'], offsets, total, index)
       }
     }
     return events
   }
 
+  _get_automation(track, start, stop) {
+    // Mirrors schedule.automation() in Python.
+    const lanes = this._song.track(track)['lanes']
+    const points = new Map([[start, {}]])
+    for (let [key, lane] of Object.entries(lanes)) {
+      const lhs = bisectRight(lane['times'], start)
+      if (lhs)
+        points.get(start)[key] = lane['values'][lhs - 1]
+      const rhs = bisectLeft(lane['times'], stop)
+      for (let i = lhs; i < rhs; i++) {
+        if (!points.has(lane['times'][i]))
+          points.set(lane['times'][i], {})
+        points.get(lane['times'][i])[key] = lane['values'][i]
+      }
+    }
+    return [...points.entries()].sort((a, b) => a[0] - b[0])
+  }
+
   _get_events(track, start, stop) {
-    const events = []
-    for (let change of this._song['changes']) {
-      if (change['track'] != track)
+    // Mirrors schedule.events() in Python. The breakpoints of the track are
+    // sorted, so we only look at the ones inside the time frame and at the
+    // periodic changes of the segments that overlap it.
+    const index = this._song.track(track)
+    const times = index['times']
+    const lhs = bisectLeft(times, start)
+    const rhs = bisectLeft(times, stop)
+    const events = times.slice(lhs, rhs)
+    const first = Math.max(lhs - 1, 0)
+    const idents = new Set()
+    for (let layers of index['layers'].slice(first, Math.max(rhs, first + 1)))
+      for (let [ident, _] of layers)
+        idents.add(ident)
+    for (let ident of idents) {
+      const change = index['periodic'][ident]
+      const begin = Math.max(start, change['start'])
+      const end = change['stop'] === null ? stop : Math.min(stop, change['stop'])
+      if (begin >= end)
         continue
-      if (start <= change['start'] && change['start'] < stop)
-        events.push(change['start'])
-      if (change['stop'] !== null && start <= change['stop'] && change['stop'] < stop)
-        events.push(change['stop'])
-      if (change['every']) {
-        // Step through the period to find all state changes.
-        let time = start - (start - change['start']) % change['every']
-        while (time < stop) {
-          if (start <= time && time < stop)
-            events.push(time)
-          if (start <= time + change['over'] && time + change['over'] < stop)
-            events.push(time + change['over'])
-          time += change['every']
-        }
+      // Jump directly to the first period that can contribute a time.
+      const period = Math.max(Math.floor((begin - change['start']) / change['every']) - 1, 0)
+      let time = change['start'] + period * change['every']
+      while (time < end) {
+        if (begin <= time && time < end)
+          events.push(time)
+        if (begin <= time + change['over'] && time + change['over'] < end)
+          events.push(time + change['over'])
+        time += change['every']
       }
     }
     return events
   }
 
   _get_state(track, time) {
-    let state = {}
-    let since = {}
-    for (let change of this._song['changes']) {
-      if (change['track'] != track)
+    // Mirrors schedule.state() in Python.
+    const index = this._song.track(track)
+    const segment = bisectRight(index['times'], time) - 1
+    if (segment < 0)
+      return [{}, {}, null, []]
+    const state = Object.assign({}, index['states'][segment])
+    const since = Object.assign({}, index['since'][segment])
+    let steps = index['steps'][segment]
+    let cycled = index['cycled'][segment]
+    for (let [ident, keys] of index['layers'][segment]) {
+      const change = index['periodic'][ident]
+      if ((time - change['start']) % change['every'] >= change['over'])
         continue
-      if (time < change['start'])
-        continue
-      if (change['stop'] !== null && time >= change['stop'])
-        continue
-      if (change['every'] !== null) {
-        const over = change['over'] === null ? change['every'] : change['over']
-        if ((time - change['start']) % change['every'] >= over)
-          continue
-      }
-      for (let key in change['state']) {
+      for (let key of keys) {
         state[key] = change['state'][key]
         since[key] = change['start']
       }
+      if (keys.includes('dur'))
+        steps = change['steps']
+      cycled = cycled.filter(key => !keys.includes(key)).concat(
+          change['cycled'].filter(key => keys.includes(key)))
     }
-    return [state, since]
+    return [state, since, steps, cycled]
+  }
+}
+
+
+class TickStats {
+
+  // Measurements of the most recent ticks of the scheduler, to find out why
+  // notes come late or drop out. Times are in milliseconds and the slack is
+  // in seconds.
+
+  constructor(size) {
+    this.size = size
+    this._ticks = []
+  }
+
+  record(tick) {
+    this._ticks.push(tick)
+    if (this._ticks.length > this.size)
+      this._ticks.shift()
+  }
+
+  summary() {
+    const ticks = this._ticks
+    const last = ticks.length ? ticks[ticks.length - 1] : {}
+    const output = {
+      ticks: ticks.length,
+      late: sum(ticks.map(tick => tick.late)),
+      dropped: sum(ticks.map(tick => tick.dropped)),
+      instruments: last.instruments || 0,
+      synths: last.synths || 0,
+      lookAhead: last.lookAhead || 0,
+    }
+    for (let key of ['query', 'total', 'events', 'slack'])
+      output[key] = distribution(ticks.map(tick => tick[key]))
+    return output
+  }
+}
+
+
+function distribution(values, bins = 8) {
+  // Summary statistics and a histogram of equally wide bins.
+  if (!values.length)
+    return null
+  const ordered = sorted([...values])
+  const quantile = q => ordered[Math.min(Math.floor(q * ordered.length), ordered.length - 1)]
+  const min = ordered[0]
+  const max = ordered[ordered.length - 1]
+  const width = (max - min) / bins || 1
+  const counts = new Array(bins).fill(0)
+  for (let value of ordered)
+    counts[Math.min(Math.floor((value - min) / width), bins - 1)] += 1
+  return {
+    mean: sum(ordered) / ordered.length,
+    min: min,
+    p50: quantile(0.5),
+    p95: quantile(0.95),
+    max: max,
+    histogram: {start: min, width: width, counts: counts},
   }
 }
 
@@ -241,40 +849,54 @@ class Engine {
 
 class Instrument {
 
-  constructor() {
-    this._synths = {}
-    this._samplers = {}
+  constructor(pool, samples) {
+    this.id = Instrument._count = (Instrument._count || 0) + 1
+    this._pool = pool
+    this._samples = samples
     this._effects = new EffectChain()
     this._effects.output.connect(tone.Destination)
+    // Whether the sample maps of the notes are empty, which means they are
+    // played by a synth. Notes of the same state share their sample maps, so
+    // this is only worked out when the state changes.
+    this._synths = new WeakMap()
+  }
+
+  automate(pulse, values) {
+    this._effects.automate(pulse, values)
   }
 
   call(pulse, state) {
     this._effects.call(pulse, state)
     const tones = []
-    for (let index of state['cho'])
-      tones.push(this._scale(index, state['oct'], state['sca']))
+    for (let [degree, shift] of state['cho'])
+      tones.push(this._scale(degree, shift, state['oct'], state['sca']))
+    const sam = state['sam']
+    if (!this._synths.has(sam))
+      this._synths.set(sam, Object.keys(sam).length == 0)
     let inst = null
-    if (jsonEqual(state['sam'], {})) {
+    if (this._synths.get(sam)) {
       inst = this._get_synth(state)
     } else {
       inst = this._get_sampler(state)
-      if (!inst.loaded) {
-        console.log('Skipping samples that are still being loaded.')
-        return
-      }
+      if (!inst || !inst.loaded)
+        return false
     }
     inst.triggerAttackRelease(tones, state['len'] + ':0:0', pulse)
+    return true
   }
 
   _get_synth(state) {
     const props = ['osc', 'atk', 'dec', 'sus', 'rel', 'har', 'voi', 'spr']
     const key = props.map(key => state[key]).join(',')
-    if (!this._synths.hasOwnProperty(key)) {
-      this._synths[key] = new tone.PolySynth()
+    return this._pool.get(this, 'synth', key, () => {
+      const synth = new tone.PolySynth()
+      synth.connect(this._effects.input)
+      return synth
+    }, synth => {
       let type = state['osc']
       if (state['voi'] > 1) type = 'fat' + type
       if (state['har'] > 0) type = type + state['har'].toString()
-      this._synths[key].set({
+      synth.set({
         oscillator: {
           type: type,
           count: state['voi'],
@@ -287,50 +909,281 @@ class Instrument {
           release: state['rel'],
         }
       })
-      this._synths[key].connect(this._effects.input)
-    }
-    return this._synths[key]
+    })
   }
 
   _get_sampler(state) {
+    // Samplers are only built from decoded buffers of the cache, so that they
+    // don't fetch the files again. Returns null until they are decoded.
+    const buffers = this._samples.buffers(state['sam'])
+    if (buffers === null)
+      return null
     const samHash = Object.keys(state['sam']).sort().map(
         k => `'${k}':'${state['sam'][k]}'`).join(',')
-    const key = [state['atk'], state['rel'], samHash]
-    if (!this._samplers.hasOwnProperty(key)) {
+    const key = [state['atk'], state['rel']].join(',')
+    // Samplers can only be reconfigured into samplers of the same samples.
+    return this._pool.get(this, 'sampler:' + samHash, key, () => {
       // TODO: Attack doesn't seem to be applied.
+      const sampler = new tone.Sampler({urls: buffers})
+      sampler.connect(this._effects.input)
+      return sampler
+    }, sampler => {
+      sampler.set({attack: state['atk'], release: state['rel']})
+    })
+  }
+
+  _scale(degree, shift, octave, scale) {
+    // The scale holds MIDI numbers and the chord holds pairs of scale degree
+    // and semitone shift, both resolved by jamtyper.compile(). The octave is
+    // determined by the oct property of the state and by how much the degree
+    // is out of range of the scale.
+    const wrapOct = Math.floor(degree / scale.length)
+    const midi = scale[modulo(degree, scale.length)] + 12 * (octave + wrapOct) + shift
+    return midiToFrequency(midi)
+  }
+
+  close() {
+    this._pool.release(this)
+    this._effects.close()
+  }
+}
+
+
+class VoicePool {
+
+  // Synths and samplers of all instruments of the engine. When the pool is
+  // full, an idle node of the same instrument and family is reconfigured for
+  // the new parameters. Otherwise, the least recently used node is disposed.
 
-      // const urls = {}
-      // for (const key of Object.keys(state['sam']))
-      //   urls[key] = new tone.ToneAudioBuffer(state['sam'][key])
+  constructor(limit) {
+    this.limit = limit
+    this.created = 0
+    this.reconfigured = 0
+    this.evictions = 0
+    this._entries = new Map()
+  }
+
+  get size() {
+    return this._entries.size
+  }
 
-      this._samplers[key] = new tone.Sampler({
-          urls: state['sam'], attack: state['atk'], release: state['rel']})
-      this._samplers[key].connect(this._effects.input)
+  get(owner, family, key, create, configure) {
+    const id = [owner.id, family, key].join('|')
+    let entry = this._entries.get(id)
+    if (entry) {
+      // Map iteration follows insertion order, so moving the entry to the end
+      // keeps the least recently used entry first.
+      this._entries.delete(id)
+      this._entries.set(id, entry)
+      return entry.node
     }
-    return this._samplers[key]
+    if (this._entries.size >= this.limit)
+      entry = this._reusable(owner, family)
+    if (entry) {
+      this._entries.delete(entry.id)
+      this.reconfigured += 1
+    } else {
+      this._evict(this.limit - 1)
+      entry = {owner: owner, family: family, node: create()}
+      this.created += 1
+    }
+    entry.id = id
+    configure(entry.node)
+    this._entries.set(id, entry)
+    return entry.node
   }
 
-  _scale(index, octave, scale) {
-    const match = index.match(/^(-?[0-9]+)([#]*)([b]*)$/)
-    const baseIndex = parseInt(match[1])
-    const semitones = match[2].length - match[3].length
-    const note = scale[modulo(baseIndex, scale.length)]
-    if (!(typeof note === 'string'))
-      return note
-    const [baseNote, baseOct] = slice(note.match(/^(.*)(-?[0-9])$/), 1)
-    // The octave is determined by the base octave in the sacle, the oct
-    // property of the state, and by how much the note index is out of range.
-    const wrapOct = Math.floor(parseFloat((baseIndex) / scale.length))
-    octave = parseInt(baseOct) + octave + wrapOct
-    return tone.Frequency(baseNote + octave.toString()).transpose(semitones)
+  resize(limit) {
+    this.limit = limit
+    this._evict(limit)
   }
 
-  close() {
-    for (let synth in this._synths)
-      (synth.close === 'function') && synth.close()
-    for (let sampler in this._samplers)
-      (sampler.close === 'function') && sampler.close()
-    this._effects.close()  // This was commented out before?
+  release(owner) {
+    for (let [id, entry] of this._entries.entries()) {
+      if (entry.owner !== owner)
+        continue
+      entry.node.dispose()
+      this._entries.delete(id)
+    }
+  }
+
+  stats() {
+    return {
+      size: this.size,
+      limit: this.limit,
+      created: this.created,
+      reconfigured: this.reconfigured,
+      evictions: this.evictions,
+    }
+  }
+
+  _reusable(owner, family) {
+    for (let entry of this._entries.values()) {
+      if (entry.owner !== owner || entry.family !== family)
+        continue
+      if (entry.node.activeVoices)
+        continue
+      return entry
+    }
+    return null
+  }
+
+  _evict(limit) {
+    for (let [id, entry] of this._entries.entries()) {
+      if (this._entries.size <= Math.max(limit, 0))
+        break
+      entry.node.dispose()
+      this._entries.delete(id)
+      this.evictions += 1
+    }
+  }
+}
+
+
+class SampleCache {
+
+  // Decoded sample buffers by URL. Decoded audio takes much more memory than
+  // the files, so the cache keeps the total size of the buffers within a
+  // budget in bytes and disposes the least recently used ones beyond it. The
+  // samples of the current song are pinned and never evicted. Samples that
+  // are fetched count as misses, and samples of a new song that are already
+  // cached count as hits. Looking up the buffers of a note counts neither.
+
+  constructor(limit) {
+    this.limit = limit
+    this.bytes = 0
+    this.hits = 0
+    this.misses = 0
+    this.evictions = 0
+    this.failures = 0
+    this._entries = new Map()
+    this._pinned = new Set()
+    this._banks = new Map()
+    this._times = []
+  }
+
+  get size() {
+    return this._entries.size
+  }
+
+  pin(urls) {
+    this._pinned = new Set(urls)
+    for (let url of urls) {
+      if (this._entries.has(url))
+        this.hits += 1
+      this._entry(url)
+    }
+    this._evict()
+  }
+
+  load(urls) {
+    // Resolves once all of the samples are decoded or failed to load.
+    return Promise.all(urls.map(url => this._entry(url).promise))
+  }
+
+  loaded(url) {
+    const entry = this._entries.get(url)
+    return Boolean(entry) && entry.buffer.loaded
+  }
+
+  buffers(sam) {
+    // Maps the tones of a sampler to decoded buffers, or returns null and
+    // starts loading when some of them are not decoded yet.
+    const buffers = {}
+    let missing = false
+    for (let [note, url] of Object.entries(sam)) {
+      const entry = this._entry(url)
+      missing = missing || entry.bytes === null
+      buffers[note] = entry.buffer
+    }
+    return missing ? null : buffers
+  }
+
+  resize(limit) {
+    this.limit = limit
+    this._evict()
+  }
+
+  stats() {
+    return {
+      size: this.size,
+      bytes: this.bytes,
+      limit: this.limit,
+      hits: this.hits,
+      misses: this.misses,
+      evictions: this.evictions,
+      failures: this.failures,
+      load: this._times.length ? distribution(this._times) : null,
+    }
+  }
+
+  _entry(url) {
+    let entry = this._entries.get(url)
+    if (entry) {
+      // Moving the entry to the end keeps the least recently used entry
+      // first, like in the voice pool.
+      this._entries.delete(url)
+      this._entries.set(url, entry)
+      return entry
+    }
+    const began = performance.now()
+    this.misses += 1
+    entry = {bytes: null, buffer: new tone.ToneAudioBuffer()}
+    entry.promise = this._decode(url).then(buffer => {
+      entry.buffer.set(buffer)
+      entry.bytes = 4 * buffer.length * buffer.numberOfChannels
+      this.bytes += entry.bytes
+      this._times.push(performance.now() - began)
+      if (this._times.length > JAMTYPER_STATS_TICKS)
+        this._times.shift()
+      this._evict()
+      return true
+    }, error => {
+      // Failed samples stay in the cache so that they aren't fetched again
+      // for every note.
+      console.error(`Failed to load sample ${url}:`, error)
+      this.failures += 1
+      return false
+    })
+    this._entries.set(url, entry)
+    return entry
+  }
+
+  _decode(url) {
+    // Samples of banks are addressed by the URL of the bank with the tone as
+    // fragment. All samples of a bank are copied out of a single request
+    // instead of fetching and decoding every file.
+    const [file, note] = url.split('#')
+    if (note === undefined || !file.endsWith('.bank'))
+      return tone.ToneAudioBuffer.load(url)
+    if (!this._banks.has(file)) {
+      const bank = fetch(file).then(response => {
+        if (!response.ok)
+          throw new Error(`${response.status} ${response.statusText}`)
+        return response.arrayBuffer()
+      }).then(readBank)
+      // The bank is only kept while it loads, the buffers hold the samples.
+      const forget = () => this._banks.delete(file)
+      bank.then(forget, forget)
+      this._banks.set(file, bank)
+    }
+    return this._banks.get(file).then(bank => bankBuffer(bank, note))
+  }
+
+  _evict() {
+    for (let [url, entry] of this._entries.entries()) {
+      if (this.bytes <= this.limit)
+        break
+      // Buffers that are still decoding can't be disposed yet.
+      if (this._pinned.has(url) || entry.bytes === null)
+        continue
+      // Samplers built from the buffer keep their own reference to the audio
+      // data, so they keep working until they are disposed themselves.
+      entry.buffer.dispose()
+      this._entries.delete(url)
+      this.bytes -= entry.bytes
+      this.evictions += 1
+    }
   }
 }
 
@@ -353,23 +1206,42 @@ class EffectChain {
       new Compressor(),
     ]
     for (let [index, effect] of enumerate(this._chain))
-      this._chain[index] = new AutoDisconnect(new AutoSkip(effect))
+      this._chain[index] = new AutoDisconnect(effect)
     for (let [lhs, rhs] of zip(slice(this._chain, null, -1), slice(this._chain, 1, null)))
       lhs.output.connect(rhs.input)
     this.input = this._chain[0].input
     this.output = this._chain[this._chain.length - 1].output
+    // Parameters whose automation lane is empty because their value changes
+    // between notes. Only these are read from the notes.
+    this._dynamic = new Set()
   }
 
   defaults() {
     const defaults = {}
     for (let effect of this._chain)
-      defaults.update(effect.defaults)
+      Object.assign(defaults, effect.defaults())
     return defaults
   }
 
+  automate(pulse, values) {
+    for (let [key, value] of Object.entries(values)) {
+      if (value === null)
+        this._dynamic.add(key)
+      else
+        this._dynamic.delete(key)
+    }
+    for (let effect of this._chain)
+      effect.call(pulse, values)
+  }
+
   call(pulse, state) {
+    if (!this._dynamic.size)
+      return
+    const values = {}
+    for (let key of this._dynamic)
+      values[key] = state[key]
     for (let effect of this._chain)
-      effect.call(pulse, state)
+      effect.call(pulse, values)
   }
 
   close() {
@@ -381,6 +1253,9 @@ class EffectChain {
 
 class AutoDisconnect {
 
+  // Keeps the effect out of the audio graph while all of its parameters are
+  // at their defaults and only forwards parameters that changed.
+
   constructor(effect) {
     this.input = new tone.Gain()
     this.output = new tone.Gain()
@@ -389,14 +1264,38 @@ class AutoDisconnect {
     this._effect.output.connect(this.output)
     this.timeout = null
     this._was_needed = false
+    this._defaults = this._effect.defaults()
+    this._values = Object.assign({}, this._defaults)
+    this._dynamic = new Set()
   }
 
   defaults() {
     return this._effect.defaults()
   }
 
-  call(pulse, state) {
-    const now_needed = this._needed(state)
+  call(pulse, values) {
+    let changed = false
+    for (let key in this._values) {
+      const value = values[key]
+      if (value === undefined)
+        continue
+      if (value === null) {
+        if (!this._dynamic.has(key)) {
+          this._dynamic.add(key)
+          changed = true
+        }
+        continue
+      }
+      if (this._dynamic.delete(key))
+        changed = true
+      if (value !== this._values[key]) {
+        this._values[key] = value
+        changed = true
+      }
+    }
+    if (!changed)
+      return
+    const now_needed = this._needed()
     if (!this._was_needed && !now_needed)
       return
     if (this._was_needed && !now_needed)
@@ -408,7 +1307,7 @@ class AutoDisconnect {
       this.input.disconnect().connect(this._effect.input)
     }
     this._was_needed = now_needed
-    this._effect.call(pulse, state)
+    this._effect.call(pulse, Object.assign({}, this._values))
   }
 
   close() {
@@ -417,42 +1316,18 @@ class AutoDisconnect {
     this._effect.close()
   }
 
-  _needed(state) {
-    for (let [key, value] of Object.entries(this._effect.defaults()))
-      if (state[key] != value)
+  _needed() {
+    // An effect with a parameter that changes between notes is never idle.
+    if (this._dynamic.size)
+      return true
+    for (let [key, value] of Object.entries(this._defaults))
+      if (this._values[key] != value)
         return true
     return false
   }
 }
 
 
-class AutoSkip {
-
-  constructor(effect) {
-    this._effect = effect
-    this.input = this._effect.input
-    this.output = this._effect.output
-    this._last = this._effect.defaults()
-  }
-
-  defaults() {
-    return this._effect.defaults()
-  }
-
-  call(pulse, state) {
-    state = Object.fromEntries(Object.keys(this._last).map(key => [key, state[key]]))
-    if (jsonEqual(Object.entries(state), Object.entries(this._last)))
-      return
-    this._last = state
-    this._effect.call(pulse, state)
-  }
-
-  close() {
-    this._effect.close()
-  }
-}
-
-
 class Volume {
 
   constructor() {
@@ -598,8 +1473,8 @@ class Delay {
   }
 
   call(pulse, state) {
-    this._delay.delayTime.setValueAtTime(state['dly'])
-    this._gain.gain.setValueAtTime(state['dly'] && 0.5)
+    this._delay.delayTime.setValueAtTime(state['dly'], pulse)
+    this._gain.gain.setValueAtTime(state['dly'] && 0.5, pulse)
   }
 
   close() {
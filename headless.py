@@ -0,0 +1,86 @@
+"""Compile a directory of songs under CPython, without a browser.
+
+Runs every song like the editor does and writes the compiled song next to it
+or into another directory, and reports how long running and compiling took,
+the size of the song, and the error of songs that failed. Songs are compiled
+in parallel by a pool of processes. Run from the repository root:
+
+  python -m jamtyper songs/ --out build/
+  python headless.py songs/ --out build/
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import time
+
+import jamtyper
+import tools
+
+
+def main(argv=None):
+  """Compile a directory of songs into JSON files."""
+  parser = argparse.ArgumentParser(
+      prog='python -m jamtyper', description=main.__doc__)
+  parser.add_argument('source', help='Directory of song sources (*.py).')
+  parser.add_argument(
+      '--out', default=None,
+      help='Directory for the compiled songs, defaults to the source.')
+  parser.add_argument(
+      '--jobs', type=int, default=os.cpu_count() or 1,
+      help='Number of songs compiled in parallel.')
+  args = parser.parse_args(argv)
+  out = args.out or args.source
+  os.makedirs(out, exist_ok=True)
+  paths = sorted(
+      os.path.join(args.source, name) for name in os.listdir(args.source)
+      if name.endswith('.py'))
+  if args.jobs > 1 and len(paths) > 1:
+    with concurrent.futures.ProcessPoolExecutor(args.jobs) as pool:
+      reports = list(pool.map(_compile_file, paths, [out] * len(paths)))
+  else:
+    reports = [_compile_file(path, out) for path in paths]
+  width = max([len(report['name']) for report in reports] + [4])
+  print(f"{'song':<{width}}  {'exec':>9}  {'compile':>9}  {'size':>9}  status")
+  for report in reports:
+    if report['error']:
+      print(f"{report['name']:<{width}}  {'':>9}  {'':>9}  {'':>9}  "
+            f"{report['error']}")
+      continue
+    print(
+        f"{report['name']:<{width}}  {report['exec']:7.1f}ms  "
+        f"{report['compile']:7.1f}ms  {report['size'] / 1024:6.1f}KiB  ok")
+  failed = sum(bool(report['error']) for report in reports)
+  print(f'Compiled {len(reports) - failed} songs, {failed} failed.')
+  return int(bool(failed))
+
+
+def _compile_file(path, out):
+  name = os.path.splitext(os.path.basename(path))[0]
+  report = dict(name=name, exec=None, compile=None, size=None, error=None)
+  with open(path) as f:
+    source = f.read()
+  jamtyper.clear()
+  start = time.perf_counter()
+  success, output = tools.execute(source)
+  report['exec'] = 1000 * (time.perf_counter() - start)
+  if not success:
+    lines = output.strip().splitlines()
+    report['error'] = lines[-1] if lines else 'Failed.'
+    return report
+  start = time.perf_counter()
+  try:
+    song = jamtyper.compile()
+  except Exception as e:
+    report['error'] = f'{type(e).__name__}: {e}'
+    return report
+  report['compile'] = 1000 * (time.perf_counter() - start)
+  report['size'] = len(song)
+  with open(os.path.join(out, name + '.json'), 'w') as f:
+    f.write(song)
+  return report
+
+
+if __name__ == '__main__':
+  sys.exit(main())
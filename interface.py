@@ -4,14 +4,25 @@ import random
 from browser import document
 from browser import window
 
+import jam
 import jamtyper
 import tools
+import wire
 
 
 DATABASE_URL = 'https://jamtyper-969f2-default-rtdb.firebaseio.com/songs/data'
 
+# Milliseconds to wait for the samples of the first bars before playing.
+PREFETCH_TIMEOUT = 3000
+
+# Milliseconds that typing has to pause before an automatic update.
+AUTOUPDATE_DELAY = 500
+
+# Bars that playback may drift from the clock of a jam session before it
+# seeks to catch up.
+JAM_TOLERANCE = 1 / 16
+
 EXAMPLE_SONG = """
-import random
 import jamtyper as jt
 
 jt.settings(bpm=120, volume=1.0)
@@ -31,8 +42,8 @@ lead = jt.Player(
 lead.at(24, vol=0)
 
 rando = jt.Player(
-  cho=[random.randint(0, 4) for _ in range(100)],
-  dur=[random.choice([1/4,1/8,1/8]) for _ in range(100)],
+  cho=jt.rand(range(5), 100),
+  dur=jt.rand([1/4,1/8,1/8], 100),
   sca=jt.scales.e_major_penta, vol=0.3, hpf=1000)
 rando.at(24, vol=0.6, hpf=0)
 """.strip('\n ')
@@ -50,8 +61,34 @@ class Interface:
     self._editor = editor
     self._logger = logger
     self._actions = tools.Actions(self._editor)
+    self._code = tools.CodeCache()
+    self._output = tools.Console(sel('#output pre'))
+    # Source and compiled song of the last successful update.
+    self._source = None
+    self._song = None
+    # Connection to a jam session and the source that the editor held when
+    # it was last in sync with the session.
+    self._jam = None
+    self._synced = None
+    # Updates are numbered, so that an automatic update that finishes late
+    # never replaces the song of a newer one.
+    self._background = tools.Background()
+    self._debounce = None
+    self._generation = 0
+    self._compiled = 0
     self._bind_ux_events()
     self._engine = window.Engine.new()
+    jamtyper.attach(self._engine)
+    self._settings.bind(
+        'voices', lambda x: self._engine.pool.resize(x), now=True)
+    self._settings.bind(
+        'memory', lambda x: self._engine.samples.resize(x * 2 ** 20), now=True)
+    self._settings.bind(
+        'lookahead', lambda x: self._engine.setLookAhead(x), now=True)
+    self._settings.bind('database', self._open_database, now=True)
+    self._settings.bind('lines', self._output.resize, now=True)
+    self._settings.bind('stats', self._toggle_stats, now=True)
+    self._settings.bind('jam', self._join, now=True)
     self._time(0)
     window.setInterval(self._tick, 100)
     self._animate_background()
@@ -63,6 +100,7 @@ class Interface:
 
   def _bind_ux_events(self):
     self._editor.on('error', self._logger.error)
+    self._editor.on('change', self._edited)
     self._actions.add('New', self._new, '#new')
     self._actions.add('Save', self._save, '#save')
     self._actions.add('Settings', self._settings_popup, '#settings')
@@ -86,11 +124,18 @@ class Interface:
   def _load(self):
     self._logger.clear()
     key = window.location.hash.strip('#')
+    # Saved records never change, so a cached record can be opened right away
+    # and is only replaced if the database holds a different one.
+    cached = self._songs.get(key)
+    if cached:
+      self._open(cached)
     def callback(data):
       # window.console.log(data)
-      self._editor.set_text(data['content'])
-      self._update()
-    window.fetch(DATABASE_URL + f'/{key}.json', {
+      record = _record(data)
+      self._songs.put(key, record)
+      if not cached or cached['hash'] != record['hash']:
+        self._open(record)
+    window.fetch(self._settings['database'] + f'/{key}.json', {
         'method': 'GET',
         'mode': 'cors',
     }) \
@@ -98,60 +143,301 @@ class Interface:
         .then(callback) \
         .catch(self._logger.error)
 
+  def _open_database(self, url):
+    # Records are cached separately for every database.
+    self._songs = tools.SongCache(window.localStorage, prefix=f'songs:{url}')
+
+  def _open(self, record):
+    self._editor.set_text(record['content'])
+    # Records that were saved with a compiled song of the current format can
+    # play right away. The source is still executed in the background to
+    # check that it compiles to the same song. Older records only hold the
+    # source.
+    song = record.get('song')
+    if song and record.get('version') == wire.VERSION:
+      self._engine.update(song)
+      self._verify(record['content'], song)
+    else:
+      self._update()
+
+  def _verify(self, source, song):
+    # Compiles the source in slices between frames like the auto-update, so
+    # that the song that just started playing doesn't stutter.
+    self._background.cancel()
+    window.clearTimeout(self._debounce)
+    self._generation += 1
+    generation = self._generation
+    start = window.performance.now()
+    console = tools.Console()
+    def done(result):
+      success, compiled = result
+      self._output.clear()
+      self._output.write(console.getvalue())
+      output = self._output.getvalue()
+      sel('#output').style.display = ['none', 'flex'][int(bool(output.strip()))]
+      if not success:
+        return
+      self._apply(source, compiled, generation, start)
+      if compiled != song:
+        self._logger.info(
+            'The saved song sounds different with the current version of '
+            'JamTyper and was updated.')
+    self._background.start(self._autoupdate_steps(source, console), done)
+
   def _save(self):
     self._logger.clear()
+    content = self._editor.get_text()
+    record = {
+        'content': content,
+        'hash': tools.content_hash(content),
+        'version': wire.VERSION,
+    }
+    song = self._song if content == self._source else None
+    if song is None:
+      self._background.cancel()
+      window.clearTimeout(self._debounce)
+      self._generation += 1
+      generation = self._generation
+      start = window.performance.now()
+      jamtyper.clear()
+      # The output is not shown, but a console keeps it from growing.
+      if tools.execute(content, self._code, tools.Console())[0]:
+        song = jamtyper.compile()
+        # The pending auto-update would compile the same text again, so the
+        # song is played from here instead.
+        if self._settings['autoupdate']:
+          self._apply(content, song, generation, start)
+    if song is not None:
+      # Stored as a string, because the database doesn't allow some of the
+      # characters of sample names in keys.
+      record['song'] = song
+    # Saving the same song again links to the existing record.
+    saved = self._songs.find(record['hash'])
+    if saved and self._songs.get(saved) == record:
+      self._saved(saved)
+      return
     def callback(data):
       # window.console.log(data)
-      window.location.hash = data['name']
-      sel('#editor textarea').focus()
-      url = 'https://jamtyper.com/#' + data['name']
-      self._logger.info(MESSAGE_SAVED.format(url))
-    window.fetch(DATABASE_URL + '.json', {
+      self._songs.put(data['name'], record)
+      self._saved(data['name'])
+    window.fetch(self._settings['database'] + '.json', {
         'method': 'POST',
         'mode': 'cors',
-        'body': window.JSON.stringify({'content': self._editor.get_text()}),
+        'body': window.JSON.stringify(record),
     }) \
         .then(lambda resp: resp.json()) \
         .then(callback) \
         .catch(self._logger.error)
 
+  def _saved(self, key):
+    window.location.hash = key
+    sel('#editor textarea').focus()
+    url = 'https://jamtyper.com/#' + key
+    self._logger.info(MESSAGE_SAVED.format(url))
+
   def _update(self):
     sel('#editor textarea').focus()
+    self._background.cancel()
+    self._generation += 1
+    start = window.performance.now()
     jamtyper.clear()
-    success, output = tools.execute(self._editor.get_text())
+    source = self._editor.get_text()
+    self._output.clear()
+    success, output = tools.execute(source, self._code, self._output)
+    if self._settings['timings']:
+      report = self._code.report
+      blocks = report['hits'] + report['misses']
+      self._output.append(
+          f"Compiled {report['misses']} of {blocks} blocks in "
+          f"{report['compile']:.1f}ms and ran them in {report['run']:.1f}ms.")
+      output = self._output.getvalue()
     if success:
       sel('#flash').classList.add('success')
       window.setTimeout(lambda: sel('#flash').classList.remove('success'), 200)
-      song = jamtyper.compile()
-      self._engine.update(song)
+      self._apply(source, jamtyper.compile(), self._generation, start)
     else:
       sel('#flash').classList.add('error')
       window.setTimeout(lambda: sel('#flash').classList.remove('error'), 200)
-    sel('#output pre').textContent = output
     sel('#output').style.display = ['none', 'flex'][int(bool(output.strip()))]
-    sel('#output pre').scrollTop = sel('#output pre').scrollHeight
+
+  def _apply(self, source, song, generation, start):
+    # Plays a compiled song unless a newer one is already playing.
+    if generation <= self._compiled:
+      return
+    self._compiled = generation
+    self._source, self._song = source, song
+    self._engine.update(song)
+    if self._jam:
+      self._jam.update(source, song)
+      self._synced = source
+    sel('#latency').textContent = (
+        f'compiled in {window.performance.now() - start:.0f} ms')
+
+  def _edited(self):
+    # Work on an older version of the source is dropped right away.
+    self._background.cancel()
+    window.clearTimeout(self._debounce)
+    if self._settings['autoupdate']:
+      self._debounce = window.setTimeout(self._autoupdate, AUTOUPDATE_DELAY)
+
+  def _autoupdate(self):
+    source = self._editor.get_text()
+    if source == self._source:
+      return
+    self._generation += 1
+    generation = self._generation
+    start = window.performance.now()
+    # The output only replaces the shown one if the update succeeds, so
+    # errors of unfinished lines don't flicker while typing.
+    console = tools.Console()
+    def done(result):
+      success, song = result
+      if not success:
+        return
+      self._output.clear()
+      self._output.write(console.getvalue())
+      self._apply(source, song, generation, start)
+      output = self._output.getvalue()
+      sel('#output').style.display = ['none', 'flex'][int(bool(output.strip()))]
+    self._background.start(self._autoupdate_steps(source, console), done)
+
+  def _autoupdate_steps(self, source, console):
+    jamtyper.clear()
+    for result in tools.execute_steps(source, self._code, console):
+      if result is None:
+        yield None
+    if not result[0]:
+      yield False, None
+      return
+    for song in jamtyper.compile_steps():
+      if song is None:
+        yield None
+    yield True, song
 
   def _time(self, time=None):
     sel('#editor textarea').focus()
     if time is None:
       time = sel('#time').value
+    if self._jam and self._jam.connected:
+      self._jam.seek(round(float(time), 2))
+      return
     self._engine.time = round(float(time), 2)
     sel('#time').value = f'{self._engine.time:.2f}'
 
   def _tick(self):
     if sel('#time') != document.activeElement:
       sel('#time').value = f'{self._engine.time:.2f}'
+    if self._settings['stats']:
+      self._show_stats()
+    if self._jam and self._engine.playing():
+      self._follow()
+
+  def _toggle_stats(self, show):
+    sel('#stats').style.display = ['none', 'inline'][int(bool(show))]
+
+  def _show_stats(self):
+    stats = jamtyper.stats()['ticks']
+    if not stats['ticks']:
+      sel('#stats').textContent = 'No ticks yet'
+      return
+    query, slack = stats['query'], stats['slack']
+    sel('#stats').textContent = (
+        f"query {query['p50']:.1f}/{query['p95']:.1f}ms "
+        f"slack {1000 * slack['min']:.0f}ms "
+        f"ahead {1000 * stats['lookAhead']:.0f}ms "
+        f"notes {stats['events']['max']:.0f} "
+        f"late {stats['late']} dropped {stats['dropped']} "
+        f"inst {stats['instruments']} synths {stats['synths']}")
 
   def _play(self):
     sel('#editor textarea').focus()
-    if self._engine.playing():
+    # In a jam session, the session starts and stops everyone.
+    if self._jam and self._jam.connected:
+      if 'pause' in sel('#play').classList:
+        self._jam.pause()
+      else:
+        self._jam.play()
+      return
+    # While the samples are loading, the button already shows pause.
+    if self._engine.playing() or 'pause' in sel('#play').classList:
       self._engine.pause()
       sel('#play').classList.remove('pause')
       sel('#play').classList.add('play')
     else:
-      self._engine.play()
       sel('#play').classList.remove('play')
       sel('#play').classList.add('pause')
+      self._engine.prepare(self._settings['prefetch'], PREFETCH_TIMEOUT) \
+          .then(self._start)
+
+  def _start(self, report):
+    # The button may have been pressed again while the samples were loading.
+    if 'pause' not in sel('#play').classList or self._engine.playing():
+      return
+    if self._jam and self._jam.clock:
+      self._engine.time = self._jam.now(self._engine.latency)
+    self._engine.play()
+    if not report.samples:
+      return
+    samples = jamtyper.stats()['samples']
+    requests = samples['hits'] + samples['misses']
+    message = (
+        f'Waited {report.waited:.0f} ms for {report.samples} samples, '
+        f'{samples["size"]} cached in {samples["bytes"] / 2 ** 20:.1f} MB, '
+        f'{100 * samples["hits"] / max(requests, 1):.0f}% hits')
+    if samples['load']:
+      message += f', load time {samples["load"]["p50"]:.0f} ms median'
+    if report.missing:
+      message += f', started without {report.missing} samples'
+    self._logger.info(message + '.')
+
+  def _join(self, url):
+    if self._jam:
+      self._jam.close()
+    self._jam = None
+    self._synced = None
+    if url:
+      self._jam = jam.Jam(
+          url, self._receive_song, self._receive_transport, self._logger)
+
+  def _receive_song(self, source, song, own):
+    if own:
+      return
+    self._source, self._song = source, song
+    self._engine.update(song)
+    # Edits that were not submitted yet are kept.
+    if self._synced is None or self._editor.get_text() == self._synced:
+      self._editor.set_text(source)
+      self._synced = source
+    else:
+      self._logger.info(
+          'The song of the jam session changed. Your edits are kept, '
+          'update to share them.')
+
+  def _receive_transport(self, clock):
+    loading = 'pause' in sel('#play').classList
+    if clock['playing'] and not loading:
+      sel('#play').classList.remove('play')
+      sel('#play').classList.add('pause')
+      self._engine.prepare(self._settings['prefetch'], PREFETCH_TIMEOUT) \
+          .then(self._start)
+    elif not clock['playing']:
+      if loading:
+        self._engine.pause()
+        sel('#play').classList.remove('pause')
+        sel('#play').classList.add('play')
+      self._engine.time = clock['time']
+      sel('#time').value = f'{self._engine.time:.2f}'
+    elif self._engine.playing():
+      self._follow()
+
+  def _follow(self):
+    # Seeks when playback drifted from the clock of the session. Seeking
+    # takes effect with the next tick, which is heard after the latency.
+    position = self._engine.position()
+    if position is None or self._jam.clock is None:
+      return
+    if abs(position - self._jam.now()) > JAM_TOLERANCE:
+      self._engine.time = self._jam.now(self._engine.latency)
 
   def _settings_popup(self):
     if 'active' not in sel('#settings').classList:
@@ -181,6 +467,19 @@ class Interface:
     sel('body').style.background = f'hsl({h},{s}%,50%)'
 
 
+def _record(data):
+  # Saved record as a dict. Records of older versions only hold the source,
+  # and songs that don't belong to the source are dropped.
+  record = {'content': data['content']}
+  record['hash'] = tools.content_hash(record['content'])
+  if getattr(data, 'hash', None) == record['hash']:
+    for key in ('song', 'version'):
+      value = getattr(data, key, None)
+      if value is not None:
+        record[key] = value
+  return record
+
+
 def sel(selector, all=False):
   elements = document.select(selector)
   assert len(elements) == 1 or all, (selector, elements)
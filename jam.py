@@ -0,0 +1,120 @@
+"""Client of the jam sessions served by `jamserver.py`."""
+
+import json
+
+from browser import window
+
+import wire
+
+
+# Milliseconds between pings that estimate the offset of the server clock.
+PING_INTERVAL = 5000
+
+# Milliseconds to wait before connecting again after losing the connection.
+RECONNECT_DELAY = 2000
+
+
+class Jam:
+
+  # Connection to a jam session. Songs that arrive are put together from the
+  # batches and handed to the song callback with the source, and whether they
+  # came from this client. The transport callback receives the shared clock.
+
+  def __init__(self, url, on_song, on_transport, logger):
+    self.url = url
+    self.client = None
+    self.clock = None
+    self._on_song = on_song
+    self._on_transport = on_transport
+    self._logger = logger
+    self._replica = wire.Replica()
+    # Offset of the server clock from the local one in seconds, taken from
+    # the ping with the shortest round trip, which bounds its error best.
+    self._offset = 0
+    self._round_trip = float('inf')
+    self._socket = None
+    self._closed = False
+    self._pings = window.setInterval(self._ping, PING_INTERVAL)
+    self._connect()
+
+  @property
+  def connected(self):
+    return self._socket is not None and self._socket.readyState == 1
+
+  def close(self):
+    self._closed = True
+    window.clearInterval(self._pings)
+    if self._socket is not None:
+      self._socket.close()
+
+  def update(self, source, song):
+    """Submit the compiled song of the source to the session."""
+    self._send(type='update', source=source, song=song)
+
+  def play(self):
+    self._send(type='play')
+
+  def pause(self):
+    self._send(type='pause')
+
+  def seek(self, time):
+    self._send(type='seek', time=time)
+
+  def now(self, ahead=0):
+    """Time of the session in bars, optionally some seconds from now."""
+    clock = self.clock
+    if clock is None:
+      return None
+    if not clock['playing']:
+      return clock['time']
+    at = self._local() + self._offset + ahead
+    return clock['time'] + (at - clock['at']) * clock['bpm'] / 240
+
+  def _connect(self):
+    self._socket = window.WebSocket.new(self.url)
+    self._socket.addEventListener('open', lambda *_: self._opened())
+    self._socket.addEventListener('message', self._receive)
+    self._socket.addEventListener('close', lambda *_: self._lost())
+
+  def _opened(self):
+    self._logger.info(f'Joined the jam session at {self.url}.')
+    self._ping()
+
+  def _lost(self):
+    self._socket = None
+    if self._closed:
+      return
+    self._logger.error(f'Lost the jam session at {self.url}, reconnecting.')
+    window.setTimeout(self._connect, RECONNECT_DELAY)
+
+  def _send(self, **message):
+    if self.connected:
+      self._socket.send(json.dumps(message))
+
+  def _ping(self):
+    self._send(type='ping', sent=self._local())
+
+  def _receive(self, event):
+    message = json.loads(event.data)
+    kind = message['type']
+    if kind == 'welcome':
+      self.client = message['client']
+    elif kind == 'batch':
+      song = self._replica.apply(message)
+      self._on_song(
+          self._replica.source, json.dumps(song),
+          message['origin'] == self.client)
+    elif kind == 'transport':
+      self.clock = message
+      self._on_transport(message)
+    elif kind == 'error':
+      self._logger.error(f"The jam session rejected a message: {message['message']}")
+    elif kind == 'pong':
+      local = self._local()
+      round_trip = local - message['sent']
+      if round_trip < self._round_trip:
+        self._round_trip = round_trip
+        self._offset = message['now'] + round_trip / 2 - local
+
+  def _local(self):
+    return window.performance.now() / 1000
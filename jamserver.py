@@ -0,0 +1,454 @@
+"""Local server for live jam sessions with several players.
+
+Clients join a session over a WebSocket, where the path of the URL names the
+session. The server holds the authoritative source and compiled song of each
+session. Clients compile the source in their editor and submit both, so the
+server never runs code of the players. Start the server and point the jam
+setting of every player to the same session:
+
+  python jamserver.py --port 8765
+  {"jam": "ws://localhost:8765/friends"}
+
+Updates are not sent out one by one. They are collected for a few
+milliseconds, so updates in quick succession are coalesced and only the
+latest one is sent. A batch only holds the tracks that clients don't know
+yet. Tracks are encoded with a table of values that is shared by all batches
+of the session, so unchanged tracks and values never have to be sent again.
+Messages are JSON objects with a type:
+
+  welcome    Sent to a joining client with its id.
+  batch      Settings of the song, the order of the tracks by hash, the
+             tracks and values that are new, and the edit of the source as
+             the start and stop of the replaced text and the new text. With
+             reset, the client drops what it knows and gets the whole
+             source.
+  transport  Shared clock of the session: whether it plays, the time in bars
+             and the server time in seconds it refers to, and the tempo.
+  pong       Answer to a ping, used by clients to estimate the offset of the
+             server clock.
+  error      Why a message of the client was rejected. The connection stays
+             open.
+
+Clients send the types update with source and song, play, pause, seek with a
+time, and ping with the time it was sent at.
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+import sys
+import time
+
+import wire
+
+
+# Seconds that updates are collected before they are sent out together.
+BATCH_INTERVAL = 0.05
+
+# Objects the value table of a session refers to before it starts over and
+# sends all tracks again.
+TABLE_LIMIT = 2 ** 16
+
+# Largest message accepted from a client in bytes.
+MESSAGE_LIMIT = 2 ** 24
+
+# Fields of the compiled songs that updates carry.
+SONG_FIELDS = ('bpm', 'keys', 'values', 'defaults', 'tracks')
+
+# Key of the WebSocket handshake, see RFC 6455.
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+TEXT, BINARY, CLOSE, PING, PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+
+
+class Connection:
+
+  # Minimal WebSocket connection with text messages. Fragmented messages are
+  # joined and pings are answered. Frames that clients send are masked.
+
+  def __init__(self, reader, writer, client=False):
+    self.reader = reader
+    self.writer = writer
+    self._client = client
+
+  async def receive(self):
+    """Get the next text message or None when the connection closed."""
+    message = b''
+    while True:
+      try:
+        final, opcode, payload = await self._frame()
+      except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+      if opcode == CLOSE:
+        await self.close()
+        return None
+      if opcode == PING:
+        self.writer.write(_frame(PONG, payload, self._client))
+        continue
+      if opcode == PONG:
+        continue
+      message += payload
+      if len(message) > MESSAGE_LIMIT:
+        await self.close()
+        return None
+      if final:
+        return message.decode('utf-8')
+
+  async def send(self, text):
+    await self.write(_frame(TEXT, text.encode('utf-8'), self._client))
+
+  async def write(self, frame):
+    # Frames can be encoded once and written to many connections.
+    try:
+      self.writer.write(frame)
+      await self.writer.drain()
+    except ConnectionError:
+      pass
+
+  async def close(self):
+    try:
+      self.writer.write(_frame(CLOSE, b'', self._client))
+      self.writer.close()
+      await self.writer.wait_closed()
+    except ConnectionError:
+      pass
+
+  async def _frame(self):
+    first, second = await self.reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+      length, = struct.unpack('>H', await self.reader.readexactly(2))
+    elif length == 127:
+      length, = struct.unpack('>Q', await self.reader.readexactly(8))
+    if length > MESSAGE_LIMIT:
+      raise ConnectionError('Message too large.')
+    mask = await self.reader.readexactly(4) if second & 0x80 else None
+    payload = await self.reader.readexactly(length)
+    if mask:
+      payload = _mask(payload, mask)
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+class Clock:
+
+  # Transport of a session. The time in bars is stored for a point in time
+  # of the server, so that everyone can compute the current time from it.
+
+  def __init__(self):
+    self.playing = False
+    self.time = 0.0
+    self.at = time.monotonic()
+    self.bpm = 120
+
+  def now(self, at=None):
+    """Get the time of the song in bars."""
+    at = time.monotonic() if at is None else at
+    if not self.playing:
+      return self.time
+    return self.time + (at - self.at) * self.bpm / 240
+
+  def set(self, playing=None, time_=None, bpm=None):
+    at = time.monotonic()
+    self.time = self.now(at) if time_ is None else time_
+    self.at = at
+    if playing is not None:
+      self.playing = playing
+    if bpm is not None:
+      self.bpm = bpm
+
+  def message(self):
+    return dict(
+        type='transport', playing=self.playing, time=self.time, at=self.at,
+        bpm=self.bpm)
+
+
+class Session:
+
+  def __init__(self, name):
+    self.name = name
+    self.clients = {}
+    self.source = None
+    self.song = None
+    self._edit = None
+    self.clock = Clock()
+    self.seq = 0
+    self._encoder = None
+    self._defaults = None
+    self._order = []
+    self._new = []
+    self._tracks = {}
+    self._sent = 0
+    self._pending = None
+    self._flush = None
+
+  async def join(self, client, connection):
+    self.clients[client] = connection
+    await connection.send(json.dumps(dict(type='welcome', client=client)))
+    if self._encoder is not None:
+      await connection.send(json.dumps(self._batch(None, reset=True)))
+    await connection.send(json.dumps(self.clock.message()))
+
+  def leave(self, client):
+    self.clients.pop(client, None)
+
+  def submit(self, client, source, song):
+    """Take an update of the song and send it out with the next batch."""
+    if isinstance(song, str):
+      song = json.loads(song)
+    if not isinstance(song, dict):
+      raise ValueError('Songs must be JSON objects.')
+    if song.get('version') != wire.VERSION:
+      raise ValueError(f'Unsupported song format version {song.get("version")}.')
+    missing = [field for field in SONG_FIELDS if field not in song]
+    if missing:
+      raise ValueError(f"Song lacks {', '.join(missing)}.")
+    if not isinstance(source, str):
+      raise ValueError('Sources must be strings.')
+    if not isinstance(song['bpm'], (int, float)) or song['bpm'] <= 0:
+      raise ValueError(f"Invalid tempo {song['bpm']}.")
+    # Tracks are decoded before the update is taken, so that a broken song
+    # is rejected here and never reaches the state of the session.
+    try:
+      tracks = [
+          (str(track['hash']), wire.decode_track(song, track))
+          for track in song['tracks']]
+    except (KeyError, IndexError, TypeError, ValueError, AttributeError) as e:
+      raise ValueError(f'Song has malformed tracks: {type(e).__name__} {e}.')
+    self._pending = client, source, song, tracks
+    if self._flush is None:
+      self._flush = asyncio.get_running_loop().call_later(
+          BATCH_INTERVAL, lambda: asyncio.ensure_future(self.flush()))
+
+  async def flush(self):
+    """Send the latest update to all clients."""
+    self._flush = None
+    if self._pending is None:
+      return
+    client, source, song, tracks = self._pending
+    self._pending = None
+    try:
+      reset = self._apply(song, tracks)
+    except Exception as e:
+      # Updates are checked when they are submitted, so this is a bug. The
+      # table starts over with the next update, so that clients that join
+      # until then don't get tracks it doesn't hold.
+      print(f'Dropped an update of session {self.name}: {e!r}', file=sys.stderr)
+      self._encoder = None
+      self._order = []
+      self._tracks = {}
+      if client in self.clients:
+        await self.clients[client].send(json.dumps(dict(
+            type='error', message=f'The update failed: {type(e).__name__}.')))
+      return
+    self._edit = _splice(self.source or '', source)
+    self.source = source
+    self.seq += 1
+    if song['bpm'] != self.clock.bpm:
+      self.clock.set(bpm=song['bpm'])
+      await self.broadcast(self.clock.message())
+    await self.broadcast(self._batch(client, reset))
+
+  async def transport(self, playing=None, time_=None):
+    self.clock.set(playing, time_)
+    await self.broadcast(self.clock.message())
+
+  async def broadcast(self, message):
+    frame = _frame(TEXT, json.dumps(message).encode('utf-8'))
+    await asyncio.gather(*[
+        connection.write(frame) for connection in list(self.clients.values())])
+
+  def _apply(self, song, tracks):
+    # Encodes the decoded tracks that are new into the shared table. Returns
+    # whether the table started over.
+    keys = song['keys']
+    values = song['values']
+    defaults = {key: values[value] for key, value in zip(keys, song['defaults'])}
+    reset = (
+        self._encoder is None or self._encoder.keys != keys or
+        self._defaults != defaults or self._encoder.size > TABLE_LIMIT)
+    if reset:
+      self._encoder = wire.Encoder(keys, defaults)
+      self._defaults = defaults
+      self._tracks = {}
+    self._sent = len(self._encoder.values) if not reset else 0
+    self._order = [hash_ for hash_, _ in tracks]
+    self._new = []
+    for hash_, track in tracks:
+      if hash_ in self._tracks:
+        continue
+      self._tracks[hash_] = self._encoder.track(track)
+      self._new.append(hash_)
+    self.song = {
+        key: value for key, value in song.items()
+        if key not in ('tracks', 'values', 'keys', 'defaults')}
+    return reset
+
+  def _batch(self, origin, reset):
+    # A reset sends everything the current song needs.
+    offset = 0 if reset else self._sent
+    hashes = self._order if reset else self._new
+    message = dict(
+        type='batch', seq=self.seq, origin=origin, reset=reset,
+        edit=[0, 0, self.source] if reset else self._edit,
+        song=self.song, order=self._order,
+        offset=offset, values=self._encoder.values[offset:],
+        tracks={hash_: self._tracks[hash_] for hash_ in hashes})
+    if reset:
+      message.update(keys=self._encoder.keys, defaults=self._encoder.defaults)
+    return message
+
+
+class Server:
+
+  def __init__(self):
+    self.sessions = {}
+    self._count = 0
+
+  async def handle(self, reader, writer):
+    path = await _accept(reader, writer)
+    if path is None:
+      return
+    connection = Connection(reader, writer)
+    session = self.sessions.setdefault(path, Session(path))
+    self._count += 1
+    client = self._count
+    await session.join(client, connection)
+    try:
+      while True:
+        text = await connection.receive()
+        if text is None:
+          break
+        try:
+          await self._dispatch(session, client, connection, json.loads(text))
+        except (ValueError, KeyError, TypeError) as e:
+          # A bad message only affects itself, so the client is told why and
+          # can keep playing.
+          reason = f'Message lacks {e}.' if isinstance(e, KeyError) else str(e)
+          await connection.send(json.dumps(dict(type='error', message=reason)))
+    finally:
+      session.leave(client)
+      if not session.clients and session.source is None:
+        self.sessions.pop(path, None)
+
+  async def _dispatch(self, session, client, connection, message):
+    if not isinstance(message, dict):
+      raise ValueError('Messages must be JSON objects.')
+    kind = message.get('type')
+    if kind == 'update':
+      session.submit(client, message['source'], message['song'])
+    elif kind == 'play':
+      await session.transport(playing=True)
+    elif kind == 'pause':
+      await session.transport(playing=False)
+    elif kind == 'seek':
+      await session.transport(time_=float(message['time']))
+    elif kind == 'ping':
+      await connection.send(json.dumps(dict(
+          type='pong', sent=message['sent'], now=time.monotonic())))
+    else:
+      raise ValueError(f'Unknown message type {kind}.')
+
+
+async def connect(url):
+  """Open a WebSocket connection as a client, for scripts and benchmarks."""
+  host, _, path = url.split('://', 1)[1].partition('/')
+  host, _, port = host.partition(':')
+  reader, writer = await asyncio.open_connection(host, int(port or 80))
+  key = base64.b64encode(os.urandom(16)).decode('ascii')
+  writer.write((
+      f'GET /{path} HTTP/1.1\r\nHost: {host}\r\nUpgrade: websocket\r\n'
+      f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n'
+      'Sec-WebSocket-Version: 13\r\n\r\n').encode('ascii'))
+  headers = await reader.readuntil(b'\r\n\r\n')
+  if not headers.startswith(b'HTTP/1.1 101'):
+    raise ConnectionError(headers.split(b'\r\n')[0].decode('ascii'))
+  return Connection(reader, writer, client=True)
+
+
+async def _accept(reader, writer):
+  # Answers the handshake of a WebSocket and returns the path of the session.
+  try:
+    request = await reader.readuntil(b'\r\n\r\n')
+  except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+    writer.close()
+    return None
+  lines = request.decode('latin-1').split('\r\n')
+  headers = {}
+  for line in lines[1:]:
+    name, _, value = line.partition(':')
+    headers[name.strip().lower()] = value.strip()
+  key = headers.get('sec-websocket-key')
+  if headers.get('upgrade', '').lower() != 'websocket' or not key:
+    writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+    writer.close()
+    return None
+  digest = hashlib.sha1((key + WEBSOCKET_GUID).encode('ascii')).digest()
+  writer.write((
+      'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+      'Connection: Upgrade\r\n'
+      f'Sec-WebSocket-Accept: {base64.b64encode(digest).decode("ascii")}\r\n'
+      '\r\n').encode('ascii'))
+  return lines[0].split(' ')[1].split('?')[0]
+
+
+def _splice(old, new):
+  # Edits in the editor are usually in one place, so everything but the
+  # common prefix and suffix is sent.
+  start = 0
+  limit = min(len(old), len(new))
+  while start < limit and old[start] == new[start]:
+    start += 1
+  end = 0
+  while end < limit - start and old[-end - 1] == new[-end - 1]:
+    end += 1
+  return [start, len(old) - end, new[start:len(new) - end]]
+
+
+def _frame(opcode, payload, masked=False):
+  header = bytes([0x80 | opcode])
+  bit = 0x80 if masked else 0
+  if len(payload) < 126:
+    header += bytes([bit | len(payload)])
+  elif len(payload) < 2 ** 16:
+    header += bytes([bit | 126]) + struct.pack('>H', len(payload))
+  else:
+    header += bytes([bit | 127]) + struct.pack('>Q', len(payload))
+  if masked:
+    mask = os.urandom(4)
+    return header + mask + _mask(payload, mask)
+  return header + payload
+
+
+def _mask(payload, mask):
+  # XOR of the payload with the repeated mask, computed on integers because
+  # that is much faster than byte by byte.
+  repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+  value = int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')
+  return value.to_bytes(len(payload), 'big')
+
+
+def main(argv=None):
+  """Serve jam sessions over WebSockets."""
+  parser = argparse.ArgumentParser(prog='jamserver.py', description=main.__doc__)
+  parser.add_argument('--host', default='localhost')
+  parser.add_argument('--port', type=int, default=8765)
+  args = parser.parse_args(argv)
+  server = Server()
+  async def serve():
+    listener = await asyncio.start_server(server.handle, args.host, args.port)
+    print(f'Serving jam sessions on ws://{args.host}:{args.port}/<session>')
+    async with listener:
+      await listener.serve_forever()
+  try:
+    asyncio.run(serve())
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1,6 +1,22 @@
+import collections
+import hashlib
+import heapq
 import json
-from browser import window
+import os
 import re
+import sys
+
+# The browser module only exists under Brython. Without it, songs can still be
+# compiled under CPython, for example with `python -m jamtyper`.
+try:
+  from browser import window
+except ImportError:
+  window = None
+
+import schedule
+import wire
+from patterns import Pattern, seq, rand, euclid, rep, cat, mix
+import patterns
 
 
 class AttrDict(dict):
@@ -8,9 +24,16 @@ class AttrDict(dict):
   __getattr__ = dict.__getitem__
 
 
-with open('scales.json') as f:
+# Brython fetches files relative to the page instead of the module.
+ROOT = '' if window else os.path.dirname(os.path.abspath(__file__))
+
+with open(os.path.join(ROOT, 'scales.json')) as f:
   scales = AttrDict({k: tuple(v) for k, v in json.load(f).items()})
 
+# Sample banks built with banks.py, by name.
+with open(os.path.join(ROOT, 'banks', 'index.json')) as f:
+  banks = AttrDict(json.load(f))
+
 
 samples = AttrDict(
     drums={
@@ -40,8 +63,13 @@ samples = AttrDict(
 
 
 DEFAULTS = dict(bpm=120, volume=1.0)
+# Parameters of the effects in the EffectChain of engine.js, which get
+# automation lanes. The reverb, bit crusher, and equalizer are not in the
+# chain, so their parameters are left out.
+EFFECTS = ('vol', 'dly', 'cpr', 'pan', 'hpf', 'lpf')
 SETTINGS = DEFAULTS.copy()
 players = []
+engine = None
 
 
 def clear():
@@ -50,6 +78,7 @@ def clear():
   players.clear()
   SETTINGS.clear()
   SETTINGS.update(DEFAULTS)
+  patterns.reset()
 
 
 def settings(**kwargs):
@@ -64,20 +93,156 @@ def settings(**kwargs):
   SETTINGS.update(kwargs)
 
 
+def attach(engine_):
+  """Set the engine that plays the songs, which `stats()` reports on."""
+  global engine
+  engine = engine_
+
+
+def stats():
+  """Get statistics of the engine over the most recent scheduler ticks.
+
+  Reports the distributions of the query time and the total time of a tick in
+  milliseconds, the number of notes per tick, and the slack in seconds by
+  which the tick was ahead of the audio clock, as well as the number of late
+  and dropped notes and the current number of instruments and synths. Also
+  reports the size of the sample cache, its hits and misses, and the
+  distribution of the load times of samples. Returns None when no engine is
+  attached, for example under CPython.
+  """
+  if engine is None:
+    return None
+  return json.loads(window.JSON.stringify(engine.stats()))
+
+
 def compile():
   """Get the song definition in JSON format."""
-  global players, SETTINGS
-  changes = []
-  for index, player in enumerate(players):
-    for change in player.changes:
-      change = change.copy()
-      change['track'] = index
-      changes.append(change)
-  song = dict(changes=changes, **SETTINGS)
-  song = window.JSON.stringify(song)
+  for song in compile_steps():
+    pass
   return song
 
 
+def compile_steps():
+  """Compile the song in steps, see compile().
+
+  Yields None after indexing each player and the song definition last.
+  """
+  tracks = []
+  for player in players:
+    track = schedule.index(
+        [_resolve(change) for change in player.changes], lanes=EFFECTS)
+    # The engine keeps the instruments of tracks whose hash didn't change.
+    track['hash'] = _hash(track)
+    tracks.append(track)
+    yield None
+  song = dict(tracks=tracks, **SETTINGS)
+  defaults = _resolve(dict(state=_DEFAULT_STATE))['state']
+  song = wire.encode(song, list(Player.defaults), defaults)
+  yield _dumps(song)
+
+
+def events(song, start, stop):
+  """Generate the notes of a compiled song within [start, stop) lazily.
+
+  The song is the output of `compile()`, either as JSON or parsed. Yields the
+  time in bars, the index of the track, and the state of every note in the
+  order they are played. The scheduler is queried one bar at a time, so long
+  songs can be streamed with constant memory.
+  """
+  if isinstance(song, str):
+    song = json.loads(song)
+  tracks = [
+      _track_events(song, index, start, stop)
+      for index in range(len(song['tracks']))]
+  yield from heapq.merge(*tracks, key=lambda event: event[:2])
+
+
+def _track_events(song, index, start, stop):
+  if song.get('version', 1) == 1:
+    track = song['tracks'][index]
+  else:
+    track = wire.decode_track(song, song['tracks'][index])
+  bar = 0
+  while start + bar < stop:
+    lhs = start + bar
+    rhs = min(start + bar + 1, stop)
+    for time, note in schedule.query(track, lhs, rhs):
+      yield time, index, note
+    bar += 1
+
+
+def _dumps(value):
+  # The JSON implementation of the browser is a lot faster than the one of
+  # Brython.
+  if window:
+    return window.JSON.stringify(value)
+  return json.dumps(value, separators=(',', ':'))
+
+
+def _hash(track):
+  content = _dumps(track)
+  return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
+NOTES = re.compile(r'^([A-G])([#b]*)(-?[0-9]+)$')
+DEGREES = re.compile(r'^(-?[0-9]+)([#]*)([b]*)$')
+OCTAVE = re.compile(r'(.*)(-?[0-9]+)')
+OSCILLATORS = frozenset(('sine', 'square', 'sawtooth', 'triangle'))
+# Note names in the order that scales ascend in, starting a new octave when a
+# note is not higher than the one before.
+SCALE_NOTES = {
+    note: index for index, note in enumerate([
+        'Cb', 'C', 'C#', 'Db', 'D', 'D#', 'Eb', 'E', 'E#', 'Fb', 'F',
+        'F#', 'Gb', 'G', 'G#', 'Ab', 'A', 'A#', 'Bb', 'B', 'B#'])}
+PITCHES = dict(C=0, D=2, E=4, F=5, G=7, A=9, B=11)
+_midi_cache = {}
+_degree_cache = {}
+_scale_cache = {}
+
+
+def _resolve(change):
+  # Turn note names of scales into MIDI numbers and chord indices into pairs
+  # of scale degree and semitone shift, so the engine doesn't need to parse
+  # strings for every note it plays. Patterns are replaced by their
+  # descriptors.
+  state = change['state'].copy()
+  if 'sca' in state:
+    state['sca'] = _map(state['sca'], lambda sca: [_midi(x) for x in sca])
+  if 'cho' in state:
+    state['cho'] = _map(state['cho'], lambda cho: [_degree(x) for x in cho])
+  for key, value in state.items():
+    if isinstance(value, Pattern):
+      state[key] = value.compile()
+  return dict(change, state=state)
+
+
+def _map(value, function):
+  # Apply a function to every value of a property, which is either a list or
+  # a pattern.
+  if isinstance(value, Pattern):
+    return value.map(function)
+  return [function(item) for item in value]
+
+
+def _items(value):
+  return value.items if isinstance(value, Pattern) else value
+
+
+def _midi(note):
+  if note not in _midi_cache:
+    letter, accidentals, octave = NOTES.match(note).groups()
+    shift = accidentals.count('#') - accidentals.count('b')
+    _midi_cache[note] = 12 * (int(octave) + 1) + PITCHES[letter] + shift
+  return _midi_cache[note]
+
+
+def _degree(index):
+  if index not in _degree_cache:
+    degree, sharps, flats = DEGREES.match(index).groups()
+    _degree_cache[index] = [int(degree), len(sharps) - len(flats)]
+  return _degree_cache[index]
+
+
 class Player:
 
   # All properties also support lists of values that will be cycled between.
@@ -92,7 +257,7 @@ class Player:
       'len': 1 / 8,            # Length each note will be played for.
 
       # Instrument.
-      'sam': {},               # Map from tones to sample URLs.
+      'sam': {},               # Map from tones to sample URLs or bank name.
       'osc': 'triangle',       # Oscillator base shape for synth.
       'har': 0,                # Harmonies added to the base shape.
       'voi': 1,                # Number of voices for synth.
@@ -119,97 +284,157 @@ class Player:
   def __init__(self, **kwargs):
     global players
     players.append(self)
-    self.changes = []
-    self.at(0, **self.defaults)
+    # The defaults are preprocessed once when the module is imported. Their
+    # values are never modified, so all players share them.
+    self.changes = [dict(
+        start=0, stop=None, every=None, over=None,
+        state=dict(_DEFAULT_STATE))]
     self.at(0, **kwargs)
 
   def at(self, start, stop=None, every=None, over=None, **kwargs):
-    self._preprocess_state(kwargs)
+    _preprocess_state(kwargs)
     self._validate_state(kwargs)
     self.changes.append(dict(
         start=start, stop=stop, every=every, over=over, state=kwargs))
 
-  def _preprocess_state(self, state):
-    # for key, value in state.items():
-    #   if not isinstance(value, list):
-    #     state[key] = [value]
+  def _validate_state(self, state):
     for key, value in state.items():
-      assert key in self.defaults, key
-      default = self.defaults[key]
-      # Turn everything into a list for unified processing.
-      if not isinstance(value, list):
-        value = [value]
-      # value = value.copy() if isinstance(value, list) else [value]
-      for index, item in enumerate(value):
-        if isinstance(default, tuple):
-          # Auto-wrap tuple attributes if given only one element.
-          item = item if isinstance(item, tuple) else (item,)
-          # Tuple attributes require deep type casting.
-          item = [type(default[0])(x) for x in item]
-        else:
-          item = type(default)(item)
-        value[index] = item
-      state[key] = value
-    # Property-specific preprocessing.
-    if 'sam' in state:
-      state['sam'] = [self._preprocess_sam(x) for x in state['sam']]
-    if 'sca' in state:
-      state['sca'] = [self._preprocess_sca(x) for x in state['sca']]
-
-  def _preprocess_sam(self, sam):
-    if isinstance(sam, dict):
-      return sam
-    if isinstance(sam, tuple):
-      notes = 'CDEFGAB'
-      output = {}
-      for url in sam:
-        tone = notes[len(sam) % len(notes)] + str(4 + len(sam) // len(notes))
-        output[tone] = url
-        return output
-      raise TypeError
-
-  def _preprocess_sca(self, sca):
-    output = []
-    octave = 0
-    last = None
-    notes = [
-        'Cb', 'C', 'C#', 'Db', 'D', 'D#', 'Eb', 'E', 'E#', 'Fb', 'F',
-        'F#', 'Gb', 'G', 'G#', 'Ab', 'A', 'A#', 'Bb', 'B', 'B#']
-    for note in sca:
-      if any(str(x) in note for x in range(10)):
-        groups = re.match(r'(.*)(-?[0-9]+)', note).groups()
-        note = groups[0]
-        octave = int(groups[1])
-      else:
-        if last and notes.index(note) <= notes.index(last):
-          octave += 1
-      output.append(f'{note}{octave}')
-      last = note
-    return tuple(output)
+      if key == 'dur' and isinstance(value, Pattern):
+        assert value.length is not None, 'Durations need a finite pattern.'
+      check = _SCHEMA[key].check
+      if check:
+        check(_items(value))
 
-  def _validate_state(self, state):
-    for key in state.keys():
-      for single_value in state[key]:
-        self._validate_state_variable(key, single_value)
-
-  def _validate_state_variable(self, key, value):
-    if key == 'cho':
-      for index in value:
-        assert re.search('^(-?[0-9]+)([#]*)([b]*)$', index)
-    if key == 'sam':
-      assert all(isinstance(key, str) for key in value.keys())
-      assert all(isinstance(value, str) for value in value.values())
-    if key == 'osc':
-      assert value in ('sine', 'square', 'sawtooth', 'triangle')
-    if key == 'har':
-      assert 0 <= value <= 32
-    if key == 'spr':
-      assert 0.01 <= value <= 1
-    if key == 'voi':
-      assert 1 <= value <= 16
-    if key in ['atk', 'dec', 'rel']:
-      assert 0.001 <= value <= 10
-    if key == 'sus':
-      assert 0 <= value
-    # if key == 'spe':
-      # assert value in (-1, 1)
+
+_Property = collections.namedtuple('_Property', 'cast cast_all check')
+
+
+def _preprocess_state(state):
+  for key, value in state.items():
+    assert key in _SCHEMA, key
+    prop = _SCHEMA[key]
+    if isinstance(value, Pattern):
+      state[key] = value.map(prop.cast)
+      continue
+    # Turn everything into a list for unified processing.
+    state[key] = prop.cast_all(value if isinstance(value, list) else [value])
+  # Property-specific preprocessing.
+  if 'sam' in state:
+    state['sam'] = _map(state['sam'], _preprocess_sam)
+  if 'sca' in state:
+    state['sca'] = _map(state['sca'], _preprocess_sca)
+
+
+def _preprocess_sam(sam):
+  if isinstance(sam, dict):
+    return sam
+  if isinstance(sam, str):
+    # Samples of a bank are addressed by the URL of the bank with the tone
+    # as fragment, which the engine loads with a single request.
+    assert sam in banks, f'Unknown sample bank: {sam}'
+    bank = banks[sam]
+    return {tone: f"{bank['url']}#{tone}" for tone in bank['tones']}
+  if isinstance(sam, tuple):
+    notes = 'CDEFGAB'
+    output = {}
+    for url in sam:
+      tone = notes[len(sam) % len(notes)] + str(4 + len(sam) // len(notes))
+      output[tone] = url
+      return output
+    raise TypeError
+
+
+def _preprocess_sca(sca):
+  # Songs use few distinct scales, usually the predefined ones.
+  key = tuple(sca)
+  if key in _scale_cache:
+    return _scale_cache[key]
+  output = []
+  octave = 0
+  last = None
+  for note in key:
+    match = OCTAVE.match(note)
+    if match:
+      note = match.group(1)
+      octave = int(match.group(2))
+    else:
+      if last and _scale_index(note) <= _scale_index(last):
+        octave += 1
+    output.append(f'{note}{octave}')
+    # Notes are resolved to MIDI numbers when the song is compiled.
+    assert NOTES.match(output[-1]), f'Unknown note in scale: {note}'
+    last = note
+  _scale_cache[key] = tuple(output)
+  return _scale_cache[key]
+
+
+def _schema(defaults):
+  # Compiles how the values of every property are cast to the type of its
+  # default and validated, so that setting a property doesn't need to
+  # inspect the default again for every value.
+  schema = {}
+  for key, default in defaults.items():
+    if isinstance(default, tuple):
+      kind = type(default[0])
+      # Auto-wrap tuple attributes if given only one element. Tuple
+      # attributes require deep type casting.
+      cast = lambda item, kind=kind: (
+          list(map(kind, item)) if isinstance(item, tuple) else [kind(item)])
+      cast_all = lambda items, cast=cast: [cast(item) for item in items]
+    elif isinstance(default, dict):
+      # Names of sample banks are resolved by _preprocess_sam().
+      cast = lambda item: item if isinstance(item, str) else dict(item)
+      cast_all = lambda items, cast=cast: [cast(item) for item in items]
+    else:
+      cast = type(default)
+      cast_all = lambda items, cast=cast: list(map(cast, items))
+    schema[key] = _Property(cast, cast_all, _CHECKS.get(key))
+  return schema
+
+
+def _check_cho(chords):
+  # Chords repeat the same few indices, and indices that were parsed before
+  # are valid.
+  indices = {index for chord in chords for index in chord}
+  match = DEGREES.match
+  assert all(index in _degree_cache or match(index) for index in indices)
+
+
+def _check_sam(sams):
+  assert all(
+      isinstance(tone, str) and isinstance(url, str)
+      for sam in sams for tone, url in sam.items())
+
+
+def _check_osc(oscillators):
+  assert OSCILLATORS.issuperset(oscillators)
+
+
+def _between(low, high=float('inf')):
+  def check(values):
+    assert all(low <= value <= high for value in values)
+  return check
+
+
+def _scale_index(note):
+  assert note in SCALE_NOTES, f'Unknown note in scale: {note}'
+  return SCALE_NOTES[note]
+
+
+_CHECKS = dict(
+    cho=_check_cho, sam=_check_sam, osc=_check_osc, har=_between(0, 32),
+    spr=_between(0.01, 1), voi=_between(1, 16), atk=_between(0.001, 10),
+    dec=_between(0.001, 10), rel=_between(0.001, 10), sus=_between(0))
+
+# Casters and validators of every property, and the preprocessed defaults that
+# the first change of every player holds.
+_SCHEMA = _schema(Player.defaults)
+_DEFAULT_STATE = dict(Player.defaults)
+_preprocess_state(_DEFAULT_STATE)
+
+
+if __name__ == '__main__':
+  # The command line lives in its own module, so that bundling the app for
+  # the browser doesn't pull in argparse and the process pool.
+  import headless
+  sys.exit(headless.main())
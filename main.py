@@ -8,6 +8,16 @@ import tools
 def main():
   settings = tools.Settings(
       vim=False,
+      voices=32,
+      memory=256,
+      prefetch=2,
+      lookahead='playback',
+      timings=False,
+      autoupdate=False,
+      lines=1000,
+      stats=False,
+      database=interface.DATABASE_URL,
+      jam='',
   )
 
   editor_ = editor.Editor(document.select('#editor')[0])
@@ -0,0 +1,162 @@
+"""Export of compiled songs as Standard MIDI Files.
+
+Writes a file of format 1 with a tempo track followed by one track per player.
+Tracks are written one after the other while the notes are streamed from
+`jamtyper.events()`, and the length of each track chunk is filled in once the
+track is done, so hours of a song can be exported with constant memory. Only
+the notes that are still held are kept around to schedule their note offs.
+
+Players map to MIDI channels in order, wrapping around after 16. Velocities
+follow the volume of the notes, and changes in panning are sent as control
+changes. Run from the repository root:
+
+  python midi.py song.json song.mid --bars 32
+"""
+
+import argparse
+import heapq
+import json
+import struct
+import sys
+
+import jamtyper
+import schedule
+
+
+# Ticks per quarter note.
+PPQ = 480
+
+# Velocity of notes with a volume of one.
+VELOCITY = 100
+
+# Controller number of the panning.
+PAN = 10
+
+
+def write(song, path, bars, start=0, ppq=PPQ):
+  """Write bars of a compiled song into a Standard MIDI File.
+
+  The song is the output of `jamtyper.compile()`, either as JSON or parsed.
+  Returns the number of notes written.
+  """
+  if isinstance(song, str):
+    song = json.loads(song)
+  count = 0
+  with open(path, 'wb') as f:
+    f.write(b'MThd' + struct.pack('>IHHH', 6, 1, len(song['tracks']) + 1, ppq))
+    with _Chunk(f) as chunk:
+      chunk.meta(0, 0x51, round(60e6 / song['bpm']).to_bytes(3, 'big'))
+      chunk.meta(0, 0x58, bytes([4, 2, 24, 8]))
+      chunk.meta(_ticks(bars, ppq), 0x2F, b'')
+    for index in range(len(song['tracks'])):
+      with _Chunk(f) as chunk:
+        count += _write_track(chunk, song, index, start, bars, ppq)
+  return count
+
+
+def _write_track(chunk, song, index, start, bars, ppq):
+  channel = index % 16
+  chunk.meta(0, 0x03, f'Track {index + 1}'.encode('utf-8'))
+  # Note offs of the notes that are still held, and how many notes hold each
+  # pitch, so that overlapping notes of the same pitch don't cut each other.
+  pending = []
+  held = {}
+  pan = None
+  count = 0
+  notes = jamtyper.events(
+      dict(song, tracks=[song['tracks'][index]]), start, start + bars)
+  for time, _, note in notes:
+    tick = _ticks(time - start, ppq)
+    while pending and pending[0][0] <= tick:
+      _release(chunk, channel, held, *heapq.heappop(pending))
+    # A velocity of zero would be read as a note off, so muted notes are left
+    # out.
+    velocity = min(round(VELOCITY * note['vol']), 127)
+    if velocity <= 0:
+      continue
+    if note['pan'] != pan:
+      pan = note['pan']
+      value = min(max(round(64 + 63.5 * pan), 0), 127)
+      chunk.event(tick, bytes([0xB0 | channel, PAN, value]))
+    release = tick + max(_ticks(note['len'], ppq), 1)
+    for pitch in schedule.pitches(note):
+      if not 0 <= pitch < 128:
+        continue
+      chunk.event(tick, bytes([0x90 | channel, pitch, velocity]))
+      held[pitch] = held.get(pitch, 0) + 1
+      heapq.heappush(pending, (release, pitch))
+    count += 1
+  while pending:
+    _release(chunk, channel, held, *heapq.heappop(pending))
+  chunk.meta(max(chunk.tick, _ticks(bars, ppq)), 0x2F, b'')
+  return count
+
+
+def _release(chunk, channel, held, tick, pitch):
+  held[pitch] -= 1
+  if not held[pitch]:
+    chunk.event(tick, bytes([0x80 | channel, pitch, 0]))
+
+
+class _Chunk:
+
+  # Track chunk that is written to the file as events come in. The length in
+  # the header is patched when the chunk is closed.
+
+  def __init__(self, f):
+    self.tick = 0
+    self._file = f
+
+  def __enter__(self):
+    self._file.write(b'MTrk\0\0\0\0')
+    self._begin = self._file.tell()
+    return self
+
+  def __exit__(self, *exc_info):
+    end = self._file.tell()
+    self._file.seek(self._begin - 4)
+    self._file.write(struct.pack('>I', end - self._begin))
+    self._file.seek(end)
+
+  def event(self, tick, data):
+    assert tick >= self.tick, (tick, self.tick)
+    self._file.write(_varlen(tick - self.tick) + data)
+    self.tick = tick
+
+  def meta(self, tick, kind, data):
+    self.event(tick, bytes([0xFF, kind]) + _varlen(len(data)) + data)
+
+
+def _varlen(value):
+  output = [value & 0x7F]
+  value >>= 7
+  while value:
+    output.append(0x80 | (value & 0x7F))
+    value >>= 7
+  return bytes(reversed(output))
+
+
+def _ticks(time, ppq):
+  # Times are in bars of four quarter notes.
+  return round(time * 4 * ppq)
+
+
+def main(argv=None):
+  """Export a compiled song as a Standard MIDI File."""
+  parser = argparse.ArgumentParser(prog='midi.py', description=main.__doc__)
+  parser.add_argument('song', help='Compiled song (*.json).')
+  parser.add_argument('out', help='Path of the MIDI file to write.')
+  parser.add_argument(
+      '--bars', type=float, required=True, help='Number of bars to export.')
+  parser.add_argument(
+      '--start', type=float, default=0, help='Bar to start exporting at.')
+  args = parser.parse_args(argv)
+  with open(args.song) as f:
+    song = f.read()
+  count = write(song, args.out, args.bars, args.start)
+  print(f'Exported {count} notes of {args.bars:g} bars.')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,271 @@
+"""Lazy patterns of values for player properties.
+
+Properties of players cycle through lists of values, one per step. Long lists
+like random melodies have to be built, type cast, validated, and serialized in
+full and change on every update. Patterns describe such sequences instead.
+They hold a short table of items and compile to a small descriptor that maps
+any step index to an item, which the engine evaluates on demand.
+
+Descriptors are nested lists that return an index into the item table:
+
+  ['seq', base, count]                  Cycle through items in order.
+  ['rand', base, count, seed, length]   Pick a random item per step.
+  ['euclid', base, hits, steps, shift]  Euclidean rhythm of two items.
+  ['rep', child, times]                 Repeat every step of the child.
+  ['cat', children, lengths]            Play the children after each other.
+  ['mix', children]                     Interleave the steps of the children.
+
+The function `expand()` is the reference for `expandPattern()` in engine.js.
+Random patterns use an integer hash of the seed and step so that both produce
+the same values and the same song always sounds the same.
+"""
+
+import math
+
+
+_seeds = [0]
+
+
+def reset():
+  """Restart the default seeds so that recompiling a song is deterministic."""
+  _seeds[0] = 0
+
+
+class Pattern:
+
+  # Every kind of pattern defines map(function) to get a pattern of the same
+  # shape with every item transformed, describe(base) to get the descriptor
+  # with item indices starting at the base, and _leaves() to get the patterns
+  # that hold the items in the order of the item table.
+
+  # Number of steps before the pattern repeats, or None if it never does.
+  length = None
+
+  def __len__(self):
+    if self.length is None:
+      raise TypeError('Endless patterns have no length.')
+    return self.length
+
+  def __iter__(self):
+    for step in range(len(self)):
+      yield self[step]
+
+  def __getitem__(self, step):
+    return self.items[expand(self.describe(), step)]
+
+  def __repr__(self):
+    return f'{type(self).__name__}({self.describe()})'
+
+  @property
+  def items(self):
+    """Table of all values the pattern can produce."""
+    return [item for leaf in self._leaves() for item in leaf._items]
+
+  def compile(self):
+    """Get the JSON representation of the pattern used by the engine."""
+    return dict(items=self.items, pattern=self.describe(), length=self.length)
+
+
+class _Leaf(Pattern):
+
+  def map(self, function):
+    other = object.__new__(type(self))
+    other.__dict__.update(self.__dict__)
+    other._items = [function(item) for item in self._items]
+    return other
+
+  def _leaves(self):
+    return [self]
+
+
+class _Seq(_Leaf):
+
+  def __init__(self, items):
+    self._items = list(items)
+    assert self._items, 'Patterns need at least one item.'
+    self.length = len(self._items)
+
+  def describe(self, base=0):
+    return ['seq', base, len(self._items)]
+
+
+class _Rand(_Leaf):
+
+  def __init__(self, items, length, seed):
+    self._items = list(items)
+    assert self._items, 'Patterns need at least one item.'
+    assert length is None or length >= 1, length
+    self.length = length
+    self._seed = int(seed) & 0xFFFFFFFF
+
+  def describe(self, base=0):
+    return ['rand', base, len(self._items), self._seed, self.length]
+
+
+class _Euclid(_Leaf):
+
+  def __init__(self, hits, steps, rotate, off, on):
+    assert 0 <= hits <= steps and steps >= 1, (hits, steps)
+    self._items = [off, on]
+    self._hits = int(hits)
+    self._steps = int(steps)
+    self._rotate = int(rotate)
+    self.length = self._steps
+
+  def describe(self, base=0):
+    return ['euclid', base, self._hits, self._steps, self._rotate]
+
+
+class _Rep(Pattern):
+
+  def __init__(self, child, times):
+    assert times >= 1, times
+    self._child = child
+    self._times = int(times)
+    if child.length is not None:
+      self.length = child.length * self._times
+
+  def map(self, function):
+    return _Rep(self._child.map(function), self._times)
+
+  def describe(self, base=0):
+    return ['rep', self._child.describe(base), self._times]
+
+  def _leaves(self):
+    return self._child._leaves()
+
+
+class _Cat(Pattern):
+
+  def __init__(self, children):
+    assert children, 'Patterns need at least one item.'
+    for child in children:
+      assert child.length is not None, 'Can only concatenate finite patterns.'
+    self._children = children
+    self.length = sum(child.length for child in children)
+
+  def map(self, function):
+    return _Cat([child.map(function) for child in self._children])
+
+  def describe(self, base=0):
+    children = []
+    for child in self._children:
+      children.append(child.describe(base))
+      base += len(child.items)
+    return ['cat', children, [child.length for child in self._children]]
+
+  def _leaves(self):
+    return [leaf for child in self._children for leaf in child._leaves()]
+
+
+class _Mix(_Cat):
+
+  def __init__(self, children):
+    assert children, 'Patterns need at least one item.'
+    self._children = children
+    lengths = [child.length for child in children]
+    if None not in lengths:
+      self.length = len(children) * _lcm(lengths)
+
+  def map(self, function):
+    return _Mix([child.map(function) for child in self._children])
+
+  def describe(self, base=0):
+    return ['mix', super().describe(base)[1]]
+
+
+def seq(start, stop=None, step=1):
+  """Cycle through a range of numbers, like `range()`."""
+  if stop is None:
+    start, stop = 0, start
+  return _Seq(range(start, stop, step))
+
+
+def rand(items, length=None, seed=None):
+  """Pick a random item for every step.
+
+  The pattern repeats after `length` steps or never if it is None. Without a
+  seed, the patterns of a song are numbered in the order they are created.
+  """
+  if seed is None:
+    seed = _seeds[0]
+    _seeds[0] += 1
+  return _Rand(items, length, seed)
+
+
+def euclid(hits, steps, rotate=0, off=0, on=1):
+  """Spread a number of hits as evenly as possible over the steps."""
+  return _Euclid(hits, steps, rotate, off, on)
+
+
+def rep(pattern, times):
+  """Repeat every step of the pattern a number of times."""
+  return _Rep(_pattern(pattern), times)
+
+
+def cat(*patterns):
+  """Play the patterns after each other."""
+  return _Cat([_pattern(pattern) for pattern in patterns])
+
+
+def mix(*patterns):
+  """Interleave the steps of the patterns."""
+  return _Mix([_pattern(pattern) for pattern in patterns])
+
+
+def expand(descriptor, step):
+  """Get the item index of a pattern descriptor at a step."""
+  kind = descriptor[0]
+  if kind == 'seq':
+    _, base, count = descriptor
+    return base + step % count
+  if kind == 'rand':
+    # Songs saved before the length was part of the descriptor never repeat.
+    _, base, count, seed, length = (descriptor + [None])[:5]
+    if length is not None:
+      step %= length
+    return base + _hash(seed, step) % count
+  if kind == 'euclid':
+    _, base, hits, steps, rotate = descriptor
+    position = (step + rotate) % steps
+    return base + int(position * hits % steps < hits)
+  if kind == 'rep':
+    _, child, times = descriptor
+    return expand(child, step // times)
+  if kind == 'cat':
+    _, children, lengths = descriptor
+    step %= sum(lengths)
+    for child, length in zip(children, lengths):
+      if step < length:
+        return expand(child, step)
+      step -= length
+  if kind == 'mix':
+    _, children = descriptor
+    return expand(children[step % len(children)], step // len(children))
+  raise ValueError(descriptor)
+
+
+def _pattern(value):
+  if isinstance(value, Pattern):
+    return value
+  if isinstance(value, (list, tuple, range)):
+    return _Seq(value)
+  return _Seq([value])
+
+
+def _hash(seed, step):
+  # 32 bit integer hash that engine.js computes with Math.imul.
+  x = (seed * 0x9E3779B1 + step * 0x85EBCA77) & 0xFFFFFFFF
+  x ^= x >> 16
+  x = (x * 0x7FEB352D) & 0xFFFFFFFF
+  x ^= x >> 15
+  x = (x * 0x846CA68B) & 0xFFFFFFFF
+  x ^= x >> 16
+  return x
+
+
+def _lcm(numbers):
+  result = 1
+  for number in numbers:
+    result = result * number // math.gcd(result, number)
+  return result
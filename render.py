@@ -0,0 +1,385 @@
+"""Offline rendering of compiled songs into WAV files.
+
+Renders the output of `jamtyper.compile()` under CPython with NumPy, without
+a browser. Synths are rendered as banks of oscillators with one row per tone
+of the chord and detuned voice, shaped by an ADSR envelope. Filters, delay,
+volume, and panning are applied per note with the parameters the note was
+triggered with. Since these effects are linear, this matches applying them to
+the mixed track as long as their parameters don't change while a note rings.
+
+Tracks are rendered in parallel by a pool of processes and mixed together.
+The song is rendered in chunks of a few bars that are written to the file as
+they are done, so memory stays flat for long songs. A chunk renders every
+note that is still ringing within it, including notes that started up to
+`TAIL` bars before it.
+
+The compressor, reverb, bit crusher, and equalizer are not rendered. Samples
+are only played when their URL points to a local WAV file or a local sample
+bank, other samplers are skipped. Run from the repository root:
+
+  python render.py song.json song.wav --bars 32
+"""
+
+import argparse
+import concurrent.futures
+import functools
+import json
+import math
+import os
+import re
+import sys
+import time
+import wave
+
+import numpy as np
+
+import banks
+import schedule
+import wire
+
+
+# Sample rate of the output in Hertz.
+RATE = 44100
+
+# Number of bars rendered at once.
+CHUNK = 4
+
+# Number of bars before a chunk in which ringing notes may have started.
+TAIL = 4
+
+# Slopes of the filters in the engine are -48 dB per octave, which are four
+# second order sections.
+FILTER_SECTIONS = 4
+
+# Gain of the delayed signal, see the Delay effect in engine.js.
+DELAY_GAIN = 0.5
+
+# Envelopes decay exponentially and reach this ratio of the way to the target
+# at the end of the decay or release time.
+ENVELOPE_RATIO = math.exp(-5)
+
+_NOTE = re.compile(r'^([A-Ga-g])([#b]?)(-?[0-9]+)$')
+_STEPS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+# Decoded song and settings of the current process, see `_setup()`.
+_context = {}
+
+
+def render(
+    song, path, bars, start=0, rate=RATE, jobs=None, chunk=CHUNK,
+    root='.'):
+  """Render bars of a compiled song into a stereo 16 bit WAV file.
+
+  The song is the JSON string or parsed data returned by `jamtyper.compile()`.
+  Relative sample URLs are resolved against the root directory. Returns a
+  report of the rendered duration and the peak level before clipping.
+  """
+  if isinstance(song, str):
+    song = json.loads(song)
+  song = wire.decode(song)
+  jobs = jobs or os.cpu_count() or 1
+  bar = 240 / song['bpm']
+  stop = start + bars
+  tracks = list(range(len(song['tracks'])))
+  _setup(song, rate, root)
+  pool = None
+  if jobs > 1 and len(tracks) > 1:
+    pool = concurrent.futures.ProcessPoolExecutor(
+        min(jobs, len(tracks)), initializer=_setup,
+        initargs=(song, rate, root))
+  peak = 0.0
+  try:
+    with wave.open(path, 'wb') as f:
+      f.setnchannels(2)
+      f.setsampwidth(2)
+      f.setframerate(rate)
+      lhs = start
+      while lhs < stop:
+        rhs = min(lhs + chunk, stop)
+        count = len(tracks)
+        parts = (pool.map if pool else map)(
+            _render_track, tracks, [lhs] * count, [rhs] * count)
+        frames = _frame(rhs, bar, rate) - _frame(lhs, bar, rate)
+        mix = np.zeros((2, frames), np.float32)
+        for part in parts:
+          mix += part
+        mix *= song['volume']
+        if frames:
+          peak = max(peak, float(np.abs(mix).max()))
+        f.writeframes(_pcm(mix))
+        lhs = rhs
+  finally:
+    if pool:
+      pool.shutdown()
+  return dict(seconds=bars * bar, tracks=len(tracks), peak=peak)
+
+
+def _setup(song, rate, root):
+  _context.clear()
+  _context.update(song=song, rate=rate, root=root, bar=240 / song['bpm'])
+  _voice.cache_clear()
+  _sample.cache_clear()
+
+
+def _render_track(index, lhs, rhs):
+  track = _context['song']['tracks'][index]
+  rate, bar = _context['rate'], _context['bar']
+  begin = _frame(lhs, bar, rate)
+  output = np.zeros((2, _frame(rhs, bar, rate) - begin), np.float32)
+  for time, note in schedule.query(track, max(lhs - TAIL, 0), rhs):
+    offset = _frame(time, bar, rate) - begin
+    if offset >= output.shape[1]:
+      continue
+    voice = _voice(*_parameters(note))
+    if voice is None or offset + len(voice) <= 0:
+      continue
+    lo = max(offset, 0)
+    hi = min(offset + len(voice), output.shape[1])
+    angle = (note['pan'] + 1) * math.pi / 4
+    gains = np.array([[math.cos(angle)], [math.sin(angle)]], np.float32)
+    output[:, lo:hi] += note['vol'] * gains * voice[lo - offset:hi - offset]
+  return output
+
+
+def _parameters(note):
+  # Hashable parameters of a note that determine its sound, so that repeated
+  # notes are only synthesized once.
+  tones = tuple(schedule.pitches(note))
+  length = note['len'] * _context['bar']
+  effects = (note['hpf'], note['lpf'], note['dly'])
+  if note['sam']:
+    samples = tuple(sorted(note['sam'].items()))
+    return tones, length, ('sam', samples, note['atk'], note['rel']), effects
+  synth = tuple(note[key] for key in (
+      'osc', 'har', 'voi', 'spr', 'atk', 'dec', 'sus', 'rel'))
+  return tones, length, ('osc',) + synth, effects
+
+
+@functools.lru_cache(maxsize=64)
+def _voice(tones, length, instrument, effects):
+  rate = _context['rate']
+  if instrument[0] == 'sam':
+    _, samples, attack, release = instrument
+    signal = _sampler(tones, length, dict(samples), attack, release, rate)
+    if signal is None:
+      return None
+  else:
+    osc, har, voi, spr, atk, dec, sus, rel = instrument[1:]
+    frames = int(round((length + rel) * rate))
+    signal = _oscillators(tones, osc, har, voi, spr, frames, rate)
+    signal *= _envelope(frames, length, atk, dec, sus, rel, rate)
+  hpf, lpf, dly = effects
+  signal = _filter(signal, hpf, lpf, rate)
+  if dly:
+    shift = int(round(dly * rate))
+    signal = np.concatenate([signal, np.zeros(shift, signal.dtype)])
+    signal[shift:] += DELAY_GAIN * signal[:len(signal) - shift]
+  return signal.astype(np.float32)
+
+
+def _oscillators(tones, osc, har, voi, spr, frames, rate):
+  # One row per tone and voice. Voices are detuned evenly across the spread,
+  # which is given in semitones like the fat oscillators of Tone.js.
+  detune = np.linspace(-50 * spr, 50 * spr, voi) if voi > 1 else np.zeros(1)
+  freqs = np.outer(_frequency(np.array(tones)), 2 ** (detune / 1200))
+  phase = freqs.reshape(-1, 1) * (np.arange(frames) / rate)
+  if har > 0:
+    # Additive synthesis of the first partials, as in the oscillator types of
+    # Tone.js that end in a number.
+    signal = np.zeros_like(phase)
+    for partial in range(1, har + 1):
+      amplitude = _partial(osc, partial)
+      if amplitude:
+        signal += amplitude * np.sin(2 * np.pi * partial * phase)
+  else:
+    signal = _shape(osc, phase)
+  return signal.sum(axis=0) / voi
+
+
+def _shape(osc, phase):
+  if osc == 'sine':
+    return np.sin(2 * np.pi * phase)
+  if osc == 'square':
+    return np.where(phase % 1 < 0.5, 1.0, -1.0)
+  if osc == 'sawtooth':
+    return 2 * ((phase + 0.5) % 1) - 1
+  if osc == 'triangle':
+    return 2 * np.abs(2 * ((phase - 0.25) % 1) - 1) - 1
+  raise ValueError(osc)
+
+
+def _partial(osc, n):
+  if osc == 'sine':
+    return float(n == 1)
+  if osc == 'square':
+    return 4 / (n * np.pi) if n % 2 else 0
+  if osc == 'sawtooth':
+    return 2 / (n * np.pi) * (-1) ** (n + 1)
+  if osc == 'triangle':
+    return 8 / (n * np.pi) ** 2 * (-1) ** ((n - 1) // 2) if n % 2 else 0
+  raise ValueError(osc)
+
+
+def _envelope(frames, length, attack, decay, sustain, release, rate):
+  # Linear attack, exponential decay to the sustain level, and exponential
+  # release from whatever level was reached when the note is let go.
+  t = np.arange(frames) / rate
+  level = sustain + (1 - sustain) * ENVELOPE_RATIO ** ((t - attack) / decay)
+  level = np.where(t < attack, t / attack, level)
+  if length < attack:
+    held = length / attack
+  else:
+    held = level[min(int(length * rate), frames - 1)]
+  released = held * ENVELOPE_RATIO ** ((t - length) / release)
+  return np.where(t < length, level, released)
+
+
+def _filter(signal, hpf, lpf, rate):
+  # Applies the frequency response of the biquad sections in the frequency
+  # domain. The signal is padded so that the ringing of the filters doesn't
+  # wrap around.
+  nyquist = rate / 2
+  if hpf <= 0 and lpf >= nyquist:
+    return signal
+  size = 1 << int(len(signal) + rate // 20).bit_length()
+  spectrum = np.fft.rfft(signal, size)
+  z = np.exp(-1j * np.linspace(0, np.pi, len(spectrum)))
+  if hpf > 0:
+    spectrum *= _biquad('highpass', min(hpf, nyquist * 0.99), rate, z)
+  if lpf < nyquist:
+    spectrum *= _biquad('lowpass', max(lpf, 1), rate, z)
+  return np.fft.irfft(spectrum, size)[:len(signal)]
+
+
+def _biquad(kind, cutoff, rate, z):
+  # Butterworth section from the Audio EQ Cookbook evaluated at z^-1.
+  w = 2 * np.pi * cutoff / rate
+  alpha = np.sin(w) / np.sqrt(2)
+  cos = np.cos(w)
+  if kind == 'lowpass':
+    b = np.array([1 - cos, 2 * (1 - cos), 1 - cos]) / 2
+  else:
+    b = np.array([1 + cos, -2 * (1 + cos), 1 + cos]) / 2
+  a = np.array([1 + alpha, -2 * cos, 1 - alpha])
+  response = (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+  return response ** FILTER_SECTIONS
+
+
+def _sampler(tones, length, samples, attack, release, rate):
+  # Plays the sample closest to each tone, pitched by resampling, like the
+  # samplers of Tone.js.
+  loaded = {}
+  for name, url in samples.items():
+    data = _sample(url, rate)
+    if data is not None:
+      loaded[_midi(name)] = data
+  if not loaded:
+    return None
+  frames = int(round((length + release) * rate))
+  signal = np.zeros(frames)
+  t = np.arange(frames) / rate
+  attack = max(attack, 1 / rate)
+  held = min(length / attack, 1.0)
+  envelope = np.where(
+      t < length, np.minimum(t / attack, 1.0),
+      held * ENVELOPE_RATIO ** ((t - length) / release))
+  for tone in tones:
+    nearest = min(loaded, key=lambda midi: abs(midi - tone))
+    data = loaded[nearest]
+    speed = 2 ** ((tone - nearest) / 12)
+    positions = np.arange(frames) * speed
+    positions = positions[positions < len(data) - 1]
+    signal[:len(positions)] += np.interp(
+        positions, np.arange(len(data)), data)
+  return signal * envelope
+
+
+@functools.lru_cache(maxsize=None)
+def _sample(url, rate):
+  # Samples of banks are addressed by the URL of the bank and the tone.
+  name, _, tone = url.partition('#')
+  path = os.path.join(_context['root'], name)
+  if not os.path.exists(path):
+    data = None
+  elif name.lower().endswith('.wav'):
+    data, source = banks.wav(path)
+    data = data.mean(axis=1)
+  elif name.endswith('.bank'):
+    index, samples = _bank(path)
+    data = samples[tone].mean(axis=0) if tone in samples else None
+    source = index['rate']
+  else:
+    data = None
+  if data is None:
+    print(f'Skipping sample that is not a local WAV file or bank: {url}',
+          file=sys.stderr)
+    return None
+  if source != rate:
+    positions = np.arange(0, len(data) - 1, source / rate)
+    data = np.interp(positions, np.arange(len(data)), data)
+  return data
+
+
+@functools.lru_cache(maxsize=None)
+def _bank(path):
+  return banks.read(path)
+
+
+def _midi(name):
+  match = _NOTE.match(name)
+  if not match:
+    raise ValueError(f'Not a note name: {name}')
+  letter, accidental, octave = match.groups()
+  shift = {'#': 1, 'b': -1}.get(accidental, 0)
+  return 12 * (int(octave) + 1) + _STEPS[letter.upper()] + shift
+
+
+def _frequency(midi):
+  return 440 * 2 ** ((midi - 69) / 12)
+
+
+def _frame(time, bar, rate):
+  return int(round(time * bar * rate))
+
+
+def _pcm(signal):
+  # Interleaves the channels into little endian 16 bit integers.
+  clipped = np.clip(signal, -1, 1)
+  return (clipped.T * 32767).astype('<i2').tobytes()
+
+
+def main(argv=None):
+  """Render a compiled song into a WAV file."""
+  parser = argparse.ArgumentParser(prog='render.py', description=main.__doc__)
+  parser.add_argument('song', help='Compiled song (*.json).')
+  parser.add_argument('out', help='Path of the WAV file to write.')
+  parser.add_argument(
+      '--bars', type=float, required=True, help='Number of bars to render.')
+  parser.add_argument(
+      '--start', type=float, default=0, help='Bar to start rendering at.')
+  parser.add_argument(
+      '--rate', type=int, default=RATE, help='Sample rate in Hertz.')
+  parser.add_argument(
+      '--jobs', type=int, default=os.cpu_count() or 1,
+      help='Number of tracks rendered in parallel.')
+  parser.add_argument(
+      '--root', default=None,
+      help='Directory of relative sample URLs, defaults to the song.')
+  args = parser.parse_args(argv)
+  with open(args.song) as f:
+    song = f.read()
+  root = args.root or os.path.dirname(os.path.abspath(args.song))
+  begin = time.perf_counter()
+  report = render(
+      song, args.out, args.bars, args.start, args.rate, args.jobs, root=root)
+  duration = time.perf_counter() - begin
+  print(
+      f"Rendered {report['seconds']:.1f}s of {report['tracks']} tracks in "
+      f"{duration:.1f}s, peak level {report['peak']:.2f}.")
+  if report['peak'] > 1:
+    print('The output was clipped, consider lowering the song volume.')
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,274 @@
+"""Time index of the changes of a player.
+
+The engine needs the effective state of a track at arbitrary times. Instead of
+replaying all changes of the song for every query, the changes of each track
+are compiled into sorted breakpoints with the state that is in effect between
+them. Changes that repeat with `every` and `over` can't be expanded into
+breakpoints because they never end, so each segment keeps a short list of
+the periodic changes that may apply within it and their phase is checked by
+formula.
+
+Stepping through the notes of a loop is sped up in the same way. Each state
+carries the prefix sums of its `dur` list, so the first note inside a time
+frame is found by binary search, and the list of keys that actually cycle
+between values, so a note only reads the keys that can differ between notes.
+
+Effect parameters get sparse automation lanes that only list the times at
+which their value changes. Between those times the engine leaves effects
+alone instead of comparing their parameters for every note. Where a value
+cycles between notes or is set by a periodic change, the lane holds `None`
+and the value is taken from the notes.
+
+This module has no browser dependencies so the index can be built and
+queried under CPython as well. The functions `state()` and `events()` are the
+reference for the lookups implemented in `engine.js`.
+"""
+
+import bisect
+import math
+
+import patterns
+
+
+# Tolerance for notes that fall on the boundary of a time frame.
+EPSILON = 1e-6
+
+
+def index(changes, lanes=()):
+  """Compile the changes of a player into a time index.
+
+  The keys listed in `lanes` get automation lanes in the index.
+  """
+  static = []
+  periodic = []
+  for order, change in enumerate(changes):
+    (periodic if change['every'] else static).append((order, change))
+  times = set()
+  for _, change in static + periodic:
+    times.add(change['start'])
+    if change['stop'] is not None:
+      times.add(change['stop'])
+  times = sorted(times)
+  track = dict(
+      times=times, states=[], since=[], layers=[],
+      periodic=[_periodic(change) for _, change in periodic])
+  for time in times:
+    active = [
+        (order, change) for order, change in static
+        if _covers(change, time)]
+    state, since = {}, {}
+    for _, change in active:
+      for key, value in change['state'].items():
+        state[key] = value
+        since[key] = change['start']
+    # A periodic change only sets the keys that no later static change
+    # overrides, because changes are applied in the order they were defined.
+    layers = []
+    for ident, (order, change) in enumerate(periodic):
+      if not _covers(change, time):
+        continue
+      masked = set()
+      for other, static_change in active:
+        if other > order:
+          masked.update(static_change['state'].keys())
+      keys = [key for key in change['state'] if key not in masked]
+      if keys:
+        layers.append([ident, keys])
+    track['states'].append(state)
+    track['since'].append(since)
+    track['layers'].append(layers)
+  prepare(track)
+  track['lanes'] = {key: _lane(track, key) for key in lanes}
+  return track
+
+
+def prepare(track):
+  """Add the prefix sums and cycled keys that are derived from the states."""
+  track['steps'] = [_steps(state) for state in track['states']]
+  track['cycled'] = [_cycled(state) for state in track['states']]
+  for change in track['periodic']:
+    change['steps'] = _steps(change['state'])
+    change['cycled'] = _cycled(change['state'])
+  return track
+
+
+def state(track, time):
+  """Get the state at the given time.
+
+  Returns the state, the start time of each state key, the prefix sums of the
+  durations, and the keys with more than one value.
+  """
+  segment = bisect.bisect_right(track['times'], time) - 1
+  if segment < 0:
+    return {}, {}, None, []
+  state = dict(track['states'][segment])
+  since = dict(track['since'][segment])
+  steps = track['steps'][segment]
+  cycled = track['cycled'][segment]
+  for ident, keys in track['layers'][segment]:
+    change = track['periodic'][ident]
+    if (time - change['start']) % change['every'] >= change['over']:
+      continue
+    for key in keys:
+      state[key] = change['state'][key]
+      since[key] = change['start']
+    if 'dur' in keys:
+      steps = change['steps']
+    cycled = [key for key in cycled if key not in keys]
+    cycled += [key for key in change['cycled'] if key in keys]
+  return state, since, steps, cycled
+
+
+def query(track, start, stop):
+  """Get the notes within [start, stop) as a list of times and states."""
+  notes = []
+  times = sorted({start, stop, *events(track, start, stop)})
+  for lhs, rhs in zip(times[:-1], times[1:]):
+    values, since, steps, cycled = state(track, lhs)
+    if not steps or steps['total'] <= 0:
+      continue
+    base = {key: cycle(value, 0) for key, value in values.items()}
+    offsets, total = steps['offsets'], steps['total']
+    # Find the first note of the interval by binary search in the prefix sums
+    # of the durations instead of stepping through the loop.
+    elapsed = lhs - EPSILON - since['dur']
+    completed = math.floor(elapsed / total)
+    index = bisect.bisect_left(offsets, elapsed - completed * total)
+    index += completed * len(offsets)
+    time = _time(since['dur'], offsets, total, index)
+    while time < rhs - EPSILON:
+      note = base.copy()
+      for key in cycled:
+        note[key] = cycle(values[key], index)
+      if note['act'] and note['cho']:
+        notes.append((time, note))
+      index += 1
+      time = _time(since['dur'], offsets, total, index)
+  return notes
+
+
+def pitches(note):
+  """Get the MIDI numbers of the chord of a note returned by `query()`."""
+  # Mirrors Instrument._scale() in engine.js.
+  scale = note['sca']
+  output = []
+  for degree, shift in note['cho']:
+    octave = note['oct'] + degree // len(scale)
+    output.append(scale[degree % len(scale)] + 12 * octave + shift)
+  return output
+
+
+def cycle(value, index):
+  """Get the value of a property at a step of the loop.
+
+  Values are lists that are cycled through or compiled patterns.
+  """
+  if isinstance(value, list):
+    return value[index % len(value)]
+  if value['length'] is not None:
+    index %= value['length']
+  return value['items'][patterns.expand(value['pattern'], index)]
+
+
+def automation(track, start, stop):
+  """Get the automation points within [start, stop) as times and values.
+
+  The first point is at the start and holds the value of every lane, so that
+  effects are in the right state after seeking. Later points only hold the
+  values that change.
+  """
+  points = {start: {}}
+  for key, lane in track['lanes'].items():
+    lhs = bisect.bisect_right(lane['times'], start)
+    if lhs:
+      points[start][key] = lane['values'][lhs - 1]
+    rhs = bisect.bisect_left(lane['times'], stop)
+    for time, value in zip(lane['times'][lhs:rhs], lane['values'][lhs:rhs]):
+      points.setdefault(time, {})[key] = value
+  return sorted(points.items(), key=lambda point: point[0])
+
+
+def events(track, start, stop):
+  """Get the sorted times within [start, stop) at which the state changes."""
+  times = track['times']
+  lhs = bisect.bisect_left(times, start)
+  rhs = bisect.bisect_left(times, stop)
+  events = set(times[lhs:rhs])
+  first = max(lhs - 1, 0)
+  idents = set()
+  for layers in track['layers'][first: max(rhs, first + 1)]:
+    idents.update(ident for ident, _ in layers)
+  for ident in idents:
+    change = track['periodic'][ident]
+    begin = max(start, change['start'])
+    end = stop if change['stop'] is None else min(stop, change['stop'])
+    if begin >= end:
+      continue
+    # Jump directly to the first period that can still contribute a time
+    # instead of stepping from the start of the change.
+    period = int((begin - change['start']) // change['every'])
+    period = max(period - 1, 0)
+    time = change['start'] + period * change['every']
+    while time < end:
+      for event in (time, time + change['over']):
+        if begin <= event < end:
+          events.add(event)
+      time += change['every']
+  return sorted(events)
+
+
+def _periodic(change):
+  over = change['every'] if change['over'] is None else change['over']
+  return dict(
+      start=change['start'], stop=change['stop'], every=change['every'],
+      over=over, state=change['state'])
+
+
+def _steps(state):
+  if 'dur' not in state:
+    return None
+  offsets = []
+  total = 0
+  for index in range(_length(state['dur'])):
+    offsets.append(total)
+    total += cycle(state['dur'], index)
+  return dict(offsets=offsets, total=total)
+
+
+def _lane(track, key):
+  lane = dict(times=[], values=[])
+  for time, state, layers in zip(
+      track['times'], track['states'], track['layers']):
+    if key not in state:
+      continue
+    value = cycle(state[key], 0) if _length(state[key]) == 1 else None
+    if any(key in keys for _, keys in layers):
+      value = None
+    if lane['times'] and lane['values'][-1] == value:
+      continue
+    lane['times'].append(time)
+    lane['values'].append(value)
+  return lane
+
+
+def _cycled(state):
+  return [key for key, value in state.items() if _length(value) != 1]
+
+
+def _length(value):
+  # Number of steps before a value repeats, or None for endless patterns.
+  return len(value) if isinstance(value, list) else value['length']
+
+
+def _time(since, offsets, total, index):
+  # Computing the time from the index avoids accumulating rounding errors.
+  completed, step = divmod(index, len(offsets))
+  return since + completed * total + offsets[step]
+
+
+def _covers(change, time):
+  if time < change['start']:
+    return False
+  if change['stop'] is not None and time >= change['stop']:
+    return False
+  return True
@@ -0,0 +1,49 @@
+"""Helpers shared by the tests."""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS)
+sys.path.insert(0, ROOT)
+
+# The tests run songs the same way as the benchmarks.
+from benchmarks.common import compile
+from benchmarks.common import example
+
+
+# Recording of the scheduler in engine.js for the example song.
+FIXTURE = os.path.join(TESTS, 'fixtures', 'example_events.json')
+
+# Marks tests that run engine.js under Node.js.
+needs_node = pytest.mark.skipif(
+    shutil.which('node') is None, reason='Needs Node.js.')
+
+# Bars of the example song that are recorded, which covers all its changes.
+BARS = 32
+
+
+def engine(expression, **values):
+  """Evaluate a JavaScript expression with the functions of engine.js.
+
+  The values are passed in as JSON under their names, and the result of the
+  expression is returned as JSON. Needs Node.js.
+  """
+  script = (
+      "const vm = require('vm');"
+      "const context = vm.createContext({window: {Tone: {}}});"
+      "vm.runInContext(require('fs').readFileSync(process.argv[1], 'utf8'),"
+      " context);"
+      "Object.assign(context, JSON.parse(process.argv[2]));"
+      "process.stdout.write(JSON.stringify("
+      " vm.runInContext(process.argv[3], context)));")
+  output = subprocess.run(
+      ['node', '-e', script, os.path.join(ROOT, 'engine.js'),
+       json.dumps(values), expression],
+      capture_output=True, text=True, check=True).stdout
+  return json.loads(output)
@@ -0,0 +1,49 @@
+// Records what the scheduler of engine.js queries for a compiled song, as the
+// reference for the parity tests of the Python scheduler. Reads the song from
+// stdin and writes the notes and the times of state changes that the engine
+// finds in the windows of the live mode. Notes refer to a list of distinct
+// states to keep the recording small. Run through tests/record.py.
+
+const fs = require('fs')
+const path = require('path')
+const vm = require('vm')
+
+const context = vm.createContext({window: {Tone: {}}, console: console})
+vm.runInContext(
+  fs.readFileSync(path.join(__dirname, '..', 'engine.js'), 'utf8'), context)
+const [Engine, Song, step] = vm.runInContext(
+  '[Engine, Song, JAMTYPER_MODES.live.window]', context)
+
+const bars = Number(process.argv[2])
+const engine = Object.create(Engine.prototype)
+engine._song = new Song(JSON.parse(fs.readFileSync(0, 'utf8')))
+
+const notes = []
+const states = []
+const indices = new Map()
+const events = []
+for (let window = 0; window * step < bars; window++) {
+  const start = window * step
+  const stop = start + step
+  for (let track = 0; track < engine._song.length; track++) {
+    for (let [time, prepared] of engine._query(track, start, stop)) {
+      // Notes inherit the values that don't cycle from a shared prototype.
+      const state = {}
+      for (let key in prepared)
+        state[key] = prepared[key]
+      const key = JSON.stringify(state)
+      if (!indices.has(key)) {
+        indices.set(key, states.length)
+        states.push(state)
+      }
+      notes.push([time, track, indices.get(key)])
+    }
+    const times = [...new Set(engine._get_events(track, start, stop))]
+    if (times.length)
+      events.push([track, start, stop, times.sort((a, b) => a - b)])
+  }
+}
+// The Python scheduler yields notes ordered by time and track.
+notes.sort((a, b) => a[0] - b[0] || a[1] - b[1])
+process.stdout.write(JSON.stringify(
+  {bars: bars, states: states, notes: notes, events: events}))
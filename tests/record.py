@@ -0,0 +1,48 @@
+"""Record the output of the scheduler in engine.js for the example song.
+
+The parity tests compare the Python scheduler with this recording. Record it
+again when the semantics of the scheduler change on purpose, after checking
+the changes of the notes. Also records the peak and loudness per bar of the
+example rendered by `render.py`, which the render tests compare with. Needs
+Node.js and NumPy. Run from the repository root:
+
+  python tests/record.py
+"""
+
+import json
+import os
+import subprocess
+
+import common
+import test_render
+
+
+def main():
+  song = common.compile(common.example())
+  output = subprocess.run(
+      ['node', os.path.join(common.TESTS, 'record.js'), str(common.BARS)],
+      input=song, capture_output=True, text=True, check=True).stdout
+  recording = json.loads(output)
+  with open(common.FIXTURE, 'w') as f:
+    json.dump(recording, f, separators=(',', ':'))
+    f.write('\n')
+  print(
+      f"Recorded {len(recording['notes'])} notes and "
+      f"{len(recording['events'])} state changes to {common.FIXTURE}.")
+  path = os.path.join(common.TESTS, 'fixtures', 'example.wav')
+  try:
+    report = test_render.render.render(
+        song, path, common.BARS, rate=test_render.RATE, jobs=1)
+    frames = test_render.read(path)
+  finally:
+    os.remove(path)
+  with open(test_render.RECORDING, 'w') as f:
+    json.dump(dict(
+        peak=round(report['peak'], 6),
+        loudness=test_render.loudness(frames, common.BARS)), f)
+    f.write('\n')
+  print(f'Recorded the rendered example to {test_render.RECORDING}.')
+
+
+if __name__ == '__main__':
+  main()
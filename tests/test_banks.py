@@ -0,0 +1,94 @@
+import json
+import os
+import wave
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import common  # Puts the repository on the path.
+import banks
+import jamtyper
+import wire
+
+
+def write_wav(path, data, rate, width=2):
+  """Write samples between minus one and one with one column per channel."""
+  if width == 1:
+    raw = np.round(data * 127 + 128).astype(np.uint8).tobytes()
+  else:
+    raw = np.round(data * 32767).astype('<i2').tobytes()
+  with wave.open(str(path), 'wb') as f:
+    f.setnchannels(data.shape[1])
+    f.setsampwidth(width)
+    f.setframerate(rate)
+    f.writeframes(raw)
+
+
+@pytest.fixture
+def kit(tmp_path):
+  """Paths of a short mono kick and a stereo 8 bit snare at other rates."""
+  time = np.arange(800) / 8000
+  kick = np.sin(2 * np.pi * 60 * time)[:, None] * np.exp(-20 * time)[:, None]
+  snare = np.stack([np.linspace(-1, 1, 400), np.linspace(1, -1, 400)], axis=1)
+  write_wav(tmp_path / 'kick.wav', kick * 0.9, 8000)
+  write_wav(tmp_path / 'snare.wav', snare * 0.5, 16000, width=1)
+  return dict(C4=str(tmp_path / 'kick.wav'), D4=str(tmp_path / 'snare.wav'))
+
+
+@pytest.mark.parametrize('channels', [1, 2])
+def test_built_banks_read_back_the_samples(kit, tmp_path, channels):
+  path = str(tmp_path / 'drums.bank')
+  index = banks.build(kit, path, rate=8000, channels=channels)
+  assert index['rate'] == 8000 and index['channels'] == channels
+  with open(path, 'rb') as f:
+    header = f.read(12)
+  assert header[:4] == banks.MAGIC
+  # The data starts at an aligned offset for the browser.
+  assert int.from_bytes(header[8:], 'little') % 4 == 0
+
+  read_index, samples = banks.read(path)
+  assert read_index == index
+  assert list(samples) == ['C4', 'D4']
+  for tone, source in kit.items():
+    data, rate = banks.wav(source)
+    data = banks._channels(banks._resample(data, rate, 8000), channels)
+    assert samples[tone].shape == (channels, len(data))
+    assert np.allclose(samples[tone], data.T, atol=1 / 32768)
+  # The snare was resampled to half as many frames.
+  assert samples['D4'].shape[1] == 200
+
+
+def test_reading_other_files_fails(kit, tmp_path):
+  with pytest.raises(ValueError, match='Not a sample bank'):
+    banks.read(kit['C4'])
+  path = str(tmp_path / 'drums.bank')
+  banks.build(kit, path)
+  with open(path, 'r+b') as f:
+    f.seek(4)
+    f.write((banks.VERSION + 1).to_bytes(4, 'little'))
+  with pytest.raises(ValueError, match='Unsupported sample bank version'):
+    banks.read(path)
+
+
+def test_players_resolve_registered_banks(kit, tmp_path, monkeypatch):
+  os.mkdir(tmp_path / banks.DIRECTORY)
+  path = str(tmp_path / banks.DIRECTORY / 'drums.bank')
+  index = banks.build(kit, path, rate=8000)
+  banks.register('drums', path, index['samples'], root=str(tmp_path))
+  with open(tmp_path / banks.DIRECTORY / banks.LISTING) as f:
+    listing = json.load(f)
+  assert listing == {
+      'drums': dict(url='banks/drums.bank', tones=['C4', 'D4'])}
+
+  monkeypatch.setattr(jamtyper, 'banks', jamtyper.AttrDict(listing))
+  jamtyper.clear()
+  jamtyper.Player(sam='drums')
+  jamtyper.Player(sam=['drums', {'C4': 'kick.ogg'}])
+  song = wire.decode(json.loads(jamtyper.compile()))
+  sam = [track['states'][0]['sam'] for track in song['tracks']]
+  assert sam[0] == [{'C4': 'banks/drums.bank#C4', 'D4': 'banks/drums.bank#D4'}]
+  assert sam[1] == [sam[0][0], {'C4': 'kick.ogg'}]
+
+  with pytest.raises(AssertionError, match='Unknown sample bank: kit'):
+    jamtyper.Player(sam='kit')
@@ -0,0 +1,97 @@
+import os
+import re
+import subprocess
+
+import pytest
+
+# Puts the repository on the path.
+import common
+import deploy
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+  <link rel="stylesheet" href="style.css">
+  <script src="app.js"></script>
+</head>
+<body onload="start()"><a href="#top">Top</a></body>
+</html>
+"""
+
+
+def git(directory, *args):
+  return subprocess.run(
+      ['git', '-C', str(directory), *args], check=True, capture_output=True,
+      text=True).stdout.strip()
+
+
+def write(directory, name, content):
+  with open(os.path.join(directory, name), 'w') as f:
+    f.write(content)
+
+
+def deploy_site(source, tmp_path, checkout, remote):
+  directory = tmp_path / f'build{len(list(tmp_path.glob("build*")))}'
+  directory.mkdir()
+  manifest = deploy.build(str(source), str(directory))
+  return deploy.publish(
+      str(directory), manifest, str(checkout), str(remote), 'Update.')
+
+
+@pytest.fixture
+def site(tmp_path, monkeypatch):
+  for key in ('AUTHOR', 'COMMITTER'):
+    monkeypatch.setenv(f'GIT_{key}_NAME', 'Test')
+    monkeypatch.setenv(f'GIT_{key}_EMAIL', 'test@example.com')
+  source = tmp_path / 'source'
+  source.mkdir()
+  git(source, 'init', '-q')
+  write(source, 'index.html', PAGE)
+  write(source, 'style.css', 'body { margin: 0; }\n' * 20)
+  write(source, 'app.js', 'function start() {}\n')
+  write(source, 'main.py', 'print(1)\n')
+  git(source, 'add', '-A')
+  git(source, 'commit', '-q', '-m', 'Site.')
+  remote = tmp_path / 'site.git'
+  git(tmp_path, 'init', '-q', '--bare', str(remote))
+  return source, tmp_path / 'checkout', remote
+
+
+def published(remote):
+  return sorted(git(remote, 'ls-tree', '-r', '--name-only', 'HEAD').split())
+
+
+def test_publish_hashes_assets_and_only_commits_changes(site, tmp_path):
+  source, checkout, remote = site
+  copied, removed = deploy_site(source, tmp_path, checkout, remote)
+  assert removed == []
+  names = published(remote)
+  assert names == sorted(copied + [deploy.MANIFEST])
+  page = git(remote, 'show', 'HEAD:index.html')
+  assets = re.findall(r'(?:src|href)="([^"]+)"', page)
+  assert [re.sub(r'\.[0-9a-f]{10}\.', '.', name) for name in assets] == [
+      'style.css', 'app.js', '#top']
+  for name in assets[:2]:
+    assert name != re.sub(r'\.[0-9a-f]{10}\.', '.', name)
+    assert name in names
+  # Large text files get compressed variants, small ones and modules that
+  # Python opens by name keep their names.
+  assert assets[0] + '.gz' in names
+  assert 'app.js' not in names and 'main.py' in names
+
+  commits = git(remote, 'rev-list', '--count', 'HEAD')
+  assert deploy_site(source, tmp_path, checkout, remote) == ([], [])
+  assert git(remote, 'rev-list', '--count', 'HEAD') == commits
+
+  write(source, 'app.js', 'function start() { return 1 }\n')
+  git(source, 'commit', '-q', '-am', 'Change.')
+  copied, removed = deploy_site(source, tmp_path, checkout, remote)
+  page = git(remote, 'show', 'HEAD:index.html')
+  script = re.search(r'src="([^"]+)"', page).group(1)
+  assert script != assets[1] and assets[0] in page
+  assert removed == [assets[1]]
+  assert sorted(copied) == sorted(['index.html', script])
+  assert assets[1] not in published(remote)
+  assert not os.path.exists(checkout / assets[1])
+  assert int(git(remote, 'rev-list', '--count', 'HEAD')) == int(commits) + 1
@@ -0,0 +1,122 @@
+"""Tests of the jam session server in jamserver.py."""
+
+import asyncio
+import json
+
+import common
+import jamserver
+
+
+async def receive(connection, kind):
+  while True:
+    message = json.loads(await connection.receive())
+    if message['type'] == kind:
+      return message
+
+
+async def session(messages, join=False):
+  # Sends the messages from one client and collects the answers to each.
+  # Another client joins afterwards if asked to, and its first song is
+  # returned as well.
+  server = jamserver.Server()
+  listener = await asyncio.start_server(server.handle, 'localhost', 0)
+  url = f'ws://localhost:{listener.sockets[0].getsockname()[1]}/test'
+  connections = [await jamserver.connect(url)]
+  answers = []
+  try:
+    for message, kind in messages:
+      await connections[0].send(message)
+      answers.append(await receive(connections[0], kind))
+    if join:
+      connections.append(await jamserver.connect(url))
+      answers.append(await asyncio.wait_for(
+          receive(connections[1], 'batch'), 5))
+  finally:
+    for connection in connections:
+      await connection.close()
+    listener.close()
+    await listener.wait_closed()
+  return answers
+
+
+def update(source, song):
+  return json.dumps(dict(type='update', source=source, song=song))
+
+
+def test_bad_messages_are_answered_and_keep_the_connection():
+  song = common.compile('import jamtyper as jt\njt.Player()')
+  old = json.dumps(dict(json.loads(song), version=1))
+  answers = asyncio.run(session([
+      ('not json', 'error'),
+      ('[1, 2]', 'error'),
+      (json.dumps(dict(type='dance')), 'error'),
+      (json.dumps(dict(type='update', source='')), 'error'),
+      (json.dumps(dict(type='update', source='', song=old)), 'error'),
+      (json.dumps(dict(type='update', source='', song='{"version": 2}')),
+       'error'),
+      (json.dumps(dict(type='seek', time='soon')), 'error'),
+      (json.dumps(dict(type='update', source='x', song=song)), 'batch'),
+  ]))
+  reasons = [answer['message'] for answer in answers[:-1]]
+  assert reasons[1] == 'Messages must be JSON objects.'
+  assert reasons[2] == 'Unknown message type dance.'
+  assert reasons[3] == "Message lacks 'song'."
+  assert reasons[4] == 'Unsupported song format version 1.'
+  assert reasons[5].startswith('Song lacks bpm, keys')
+  assert answers[-1]['edit'] == [0, 0, 'x']
+
+
+def test_bad_tracks_are_rejected_before_they_reach_the_session():
+  song = common.compile('import jamtyper as jt\njt.Player()')
+  bad = json.dumps(dict(json.loads(song), tracks=[dict(hash='x')]))
+  answers = asyncio.run(session([
+      (update('x', song), 'batch'),
+      (update('y', bad), 'error'),
+  ], join=True))
+  assert answers[1]['message'].startswith('Song has malformed tracks')
+  # The client that joins later gets the last good song.
+  assert answers[2]['edit'] == [0, 0, 'x']
+  assert answers[2]['order'] == answers[0]['order']
+
+
+class Connection:
+
+  # Records the messages sent to a client.
+
+  def __init__(self):
+    self.messages = []
+
+  async def send(self, text):
+    self.messages.append(json.loads(text))
+
+  async def write(self, frame):
+    # Frames from the server are not masked, so the payload follows the
+    # length.
+    start = {126: 4, 127: 10}.get(frame[1], 2)
+    self.messages.append(json.loads(frame[start:]))
+
+
+def test_failed_updates_start_the_table_over(monkeypatch):
+  song = common.compile('import jamtyper as jt\njt.Player()')
+  other = common.compile('import jamtyper as jt\njt.Player(vol=0.5)')
+  def fail(self, track):
+    raise RuntimeError('broken')
+  async def run():
+    session = jamserver.Session('test')
+    sender, joiner = Connection(), Connection()
+    await session.join(1, sender)
+    session.submit(1, 'x', song)
+    await session.flush()
+    with monkeypatch.context() as patch:
+      patch.setattr(jamserver.wire.Encoder, 'track', fail)
+      session.submit(1, 'y', other)
+      await session.flush()
+    await session.join(2, joiner)
+    session.submit(1, 'y', other)
+    await session.flush()
+    return sender.messages, joiner.messages
+  sent, joined = asyncio.run(run())
+  assert sent[-2] == dict(type='error', message='The update failed: RuntimeError.')
+  assert [message['type'] for message in joined] == [
+      'welcome', 'transport', 'batch']
+  assert joined[-1]['reset'] and joined[-1]['edit'] == [0, 0, 'y']
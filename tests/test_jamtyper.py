@@ -0,0 +1,35 @@
+"""Tests of creating players and compiling songs in jamtyper.py."""
+
+import json
+
+import pytest
+
+import common  # Puts the repository on the path.
+import jamtyper
+
+
+@pytest.fixture(autouse=True)
+def clear():
+  jamtyper.clear()
+
+
+@pytest.mark.parametrize('sca', [('H',), ('C', 'Hb'), ('C4', 'Dx5')])
+def test_unknown_notes_in_scales_are_rejected(sca):
+  with pytest.raises(AssertionError, match='Unknown note in scale'):
+    jamtyper.Player(sca=sca)
+  with pytest.raises(AssertionError, match='Unknown note in scale'):
+    jamtyper.Player().at(4, sca=[jamtyper.scales.c_major, sca])
+
+
+def test_scales_ascend_in_octaves():
+  jamtyper.Player(cho=[0, 1, 2, 3], sca=('A', 'C', 'E', 'G3'))
+  song = json.loads(jamtyper.compile())
+  notes = [note for _, _, note in jamtyper.events(song, 0, 1)]
+  assert notes[0]['sca'] == [21, 24, 28, 55]
+
+
+def test_command_line_is_not_bundled():
+  import deploy
+  with open(jamtyper.__file__) as f:
+    imported = deploy._imports(f.read())
+  assert not {'argparse', 'concurrent.futures', 'headless'} & imported
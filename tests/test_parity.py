@@ -0,0 +1,78 @@
+"""Compare the Python scheduler with the recorded output of engine.js."""
+
+import json
+
+import pytest
+
+import common
+import jamtyper
+import schedule
+import wire
+
+
+@pytest.fixture(scope='module')
+def recording():
+  with open(common.FIXTURE) as f:
+    return json.load(f)
+
+
+@pytest.fixture(scope='module')
+def song():
+  return json.loads(common.compile(common.example()))
+
+
+def _notes(recording):
+  return [
+      (time, track, recording['states'][state])
+      for time, track, state in recording['notes']]
+
+
+def _normalized(notes):
+  # Tuples and lists of the states are the same in JSON.
+  return [
+      (time, track, json.loads(json.dumps(state)))
+      for time, track, state in notes]
+
+
+def _assert_notes(actual, expected):
+  assert len(actual) == len(expected)
+  for (time, track, state), (time_, track_, state_) in zip(actual, expected):
+    assert (track, time) == (track_, pytest.approx(time_))
+    assert state == state_
+
+
+def test_events_match_engine(recording, song):
+  actual = _normalized(jamtyper.events(song, 0, recording['bars']))
+  _assert_notes(actual, _notes(recording))
+
+
+def test_events_of_json_match_engine(recording, song):
+  actual = _normalized(
+      jamtyper.events(json.dumps(song), 0, recording['bars']))
+  _assert_notes(actual, _notes(recording))
+
+
+def test_query_in_engine_windows(recording, song):
+  # The engine queries short windows, which must not change the notes.
+  tracks = [wire.decode_track(song, track) for track in song['tracks']]
+  step = recording['events'][0][2] - recording['events'][0][1]
+  actual = []
+  for window in range(round(recording['bars'] / step)):
+    for index, track in enumerate(tracks):
+      for time, note in schedule.query(
+          track, window * step, (window + 1) * step):
+        actual.append((time, index, note))
+  actual.sort(key=lambda note: note[:2])
+  _assert_notes(_normalized(actual), _notes(recording))
+
+
+def test_state_changes_match_engine(recording, song):
+  tracks = [wire.decode_track(song, track) for track in song['tracks']]
+  expected = {
+      (track, start): times for track, start, _, times in recording['events']}
+  step = recording['events'][0][2] - recording['events'][0][1]
+  for window in range(round(recording['bars'] / step)):
+    start, stop = window * step, (window + 1) * step
+    for index, track in enumerate(tracks):
+      times = schedule.events(track, start, stop)
+      assert times == expected.get((index, start), []), (index, start)
@@ -0,0 +1,117 @@
+"""Tests of the lazy patterns in patterns.py."""
+
+import pytest
+
+import common
+import patterns
+from patterns import cat, euclid, mix, rand, rep, seq
+
+
+def steps(pattern, count):
+  return [pattern[step] for step in range(count)]
+
+
+def test_seq():
+  assert steps(seq(3), 7) == [0, 1, 2, 0, 1, 2, 0]
+  assert list(seq(2, 8, 2)) == [2, 4, 6]
+  assert len(seq(5)) == 5
+
+
+def test_rand_is_deterministic():
+  pattern = rand(range(100), seed=7)
+  assert steps(pattern, 50) == steps(rand(range(100), seed=7), 50)
+  assert steps(pattern, 50) != steps(rand(range(100), seed=8), 50)
+  assert set(steps(pattern, 1000)) <= set(range(100))
+  with pytest.raises(TypeError):
+    len(pattern)
+
+
+def test_rand_repeats_after_its_length():
+  pattern = rand([10, 20, 30, 40], length=3, seed=1)
+  values = steps(pattern, 9)
+  assert values[:3] * 3 == values
+  assert list(pattern) == values[:3]
+
+
+def test_rand_seeds_are_numbered():
+  patterns.reset()
+  first = rand(range(100))
+  patterns.reset()
+  assert steps(rand(range(100)), 20) == steps(first, 20)
+
+
+def test_euclid():
+  assert list(euclid(3, 8)) == [1, 0, 0, 1, 0, 0, 1, 0]
+  assert list(euclid(3, 8, rotate=1)) == [0, 0, 1, 0, 0, 1, 0, 1]
+  assert list(euclid(2, 4, off='-', on='x')) == ['x', '-', 'x', '-']
+  assert list(euclid(0, 3)) == [0, 0, 0]
+
+
+def test_rep():
+  pattern = rep([1, 2], 3)
+  assert len(pattern) == 6
+  assert steps(pattern, 8) == [1, 1, 1, 2, 2, 2, 1, 1]
+
+
+def test_cat():
+  pattern = cat([1, 2], seq(3), 'x')
+  assert len(pattern) == 6
+  assert steps(pattern, 8) == [1, 2, 0, 1, 2, 'x', 1, 2]
+  with pytest.raises(AssertionError):
+    cat(rand([1, 2]))
+
+
+def test_mix():
+  pattern = mix([1, 2], ['a', 'b', 'c'])
+  assert len(pattern) == 12
+  assert list(pattern) == [1, 'a', 2, 'b', 1, 'c', 2, 'a', 1, 'b', 2, 'c']
+  assert mix([1], rand([1, 2])).length is None
+
+
+def test_finite_rand_repeats_inside_other_patterns():
+  rand_ = rand([10, 20, 30, 40], length=3, seed=1)
+  once = steps(rand_, 3)
+  assert steps(mix(rand_, [0]), 12)[::2] == once * 2
+  assert steps(cat(rand_, [0]), 8) == once + [0] + once + [0]
+  assert steps(rep(rand_, 2), 12) == [value for value in once for _ in 'ab'] * 2
+
+
+def test_map_keeps_the_shape():
+  pattern = cat(rep([1, 2], 2), rand([3, 4], length=5, seed=3))
+  mapped = pattern.map(lambda item: item * 10)
+  assert list(mapped) == [value * 10 for value in pattern]
+  assert mapped.describe() == pattern.describe()
+
+
+def test_compile():
+  pattern = cat([1, 2], rand([3, 4], length=2, seed=5))
+  assert pattern.compile() == dict(
+      items=[1, 2, 3, 4], length=4,
+      pattern=['cat', [['seq', 0, 2], ['rand', 2, 2, 5, 2]], [2, 2]])
+
+
+def test_rand_without_length_in_saved_descriptors():
+  # Descriptors of songs saved before the length was part of them.
+  assert [
+      patterns.expand(['rand', 0, 10, 2], step) for step in range(8)
+  ] == steps(rand(range(10), seed=2), 8)
+
+
+@common.needs_node
+def test_engine_expands_like_python():
+  cases = [
+      seq(5), rand(range(7), seed=3), rand(range(7), length=3, seed=3),
+      euclid(5, 13, rotate=2), rep(seq(3), 4),
+      cat(seq(2), rand(range(4), length=5, seed=9), euclid(3, 8)),
+      mix(seq(3), rand(range(4), length=2, seed=1)),
+      mix(rep(cat([1, 2], rand([3, 4], length=3, seed=4)), 2), euclid(2, 5)),
+  ]
+  descriptors = [pattern.describe() for pattern in cases]
+  expected = [
+      [patterns.expand(descriptor, step) for step in range(200)]
+      for descriptor in descriptors]
+  actual = common.engine(
+      'descriptors.map(d => [...Array(200).keys()].map('
+      'step => expandPattern(d, step)))',
+      descriptors=descriptors)
+  assert actual == expected
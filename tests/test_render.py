@@ -0,0 +1,71 @@
+import json
+import os
+import wave
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import common
+import render
+
+
+RECORDING = os.path.join(common.TESTS, 'fixtures', 'example_render.json')
+
+# Low enough to keep the tests fast, high enough for every tone of the song.
+RATE = 8000
+
+
+def read(path):
+  with wave.open(path) as f:
+    assert (f.getnchannels(), f.getsampwidth()) == (2, 2)
+    assert f.getframerate() == RATE
+    data = f.readframes(f.getnframes())
+  return np.frombuffer(data, np.int16).reshape(-1, 2)
+
+
+def loudness(frames, bars):
+  """Get the RMS level of each channel per bar, scaled to 1."""
+  signal = frames.astype(np.float64) / 32768
+  return [
+      [round(float(x), 6) for x in np.sqrt((bar ** 2).mean(axis=0))]
+      for bar in np.split(signal, bars)]
+
+
+@pytest.fixture(scope='module')
+def song():
+  return common.compile(common.example())
+
+
+@pytest.fixture(scope='module')
+def full(song, tmp_path_factory):
+  path = str(tmp_path_factory.mktemp('render') / 'full.wav')
+  report = render.render(
+      song, path, common.BARS, rate=RATE, jobs=1, chunk=common.BARS)
+  return report, read(path)
+
+
+def test_example_sounds_like_the_recording(full):
+  with open(RECORDING) as f:
+    recording = json.load(f)
+  report, frames = full
+  assert report['peak'] == pytest.approx(recording['peak'], rel=1e-3)
+  for levels, recorded in zip(
+      loudness(frames, common.BARS), recording['loudness'], strict=True):
+    assert levels == pytest.approx(recorded, rel=1e-3, abs=1e-5)
+
+
+@pytest.mark.parametrize('chunk', [1, 1.5, render.CHUNK])
+def test_chunks_match_a_single_pass(song, full, tmp_path, chunk):
+  path = str(tmp_path / 'chunks.wav')
+  render.render(song, path, common.BARS, rate=RATE, jobs=1, chunk=chunk)
+  assert np.array_equal(read(path), full[1])
+
+
+def test_processes_and_offsets_match_a_single_pass(song, full, tmp_path):
+  # Notes that started before the first bar still ring into it.
+  path = str(tmp_path / 'part.wav')
+  render.render(song, path, 8, start=8, rate=RATE, jobs=2)
+  frames = full[1]
+  bar = len(frames) // common.BARS
+  assert np.array_equal(read(path), frames[8 * bar:16 * bar])
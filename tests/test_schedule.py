@@ -0,0 +1,109 @@
+"""Tests of the time index of the scheduler in schedule.py."""
+
+import pytest
+
+import common  # Puts the repository on the path.
+import schedule
+
+
+def change(start, stop=None, every=None, over=None, **state):
+  return dict(start=start, stop=stop, every=every, over=over, state=state)
+
+
+def note(**state):
+  # The properties that query() needs to produce a note.
+  return dict(dict(act=[True], cho=[[[0, 0]]], dur=[0.25]), **state)
+
+
+def test_state_at_breakpoints():
+  track = schedule.index([
+      change(0, **note(vol=[1])),
+      change(2, stop=4, vol=[0.5]),
+      change(3, dur=[0.5]),
+  ])
+  assert track['times'] == [0, 2, 3, 4]
+  assert schedule.state(track, -1) == ({}, {}, None, [])
+  for time, vol, dur in [
+      (0, 1, 0.25), (1.99, 1, 0.25), (2, 0.5, 0.25), (3.5, 0.5, 0.5),
+      (4, 1, 0.5), (100, 1, 0.5)]:
+    state, since, steps, _ = schedule.state(track, time)
+    assert (state['vol'], state['dur']) == ([vol], [dur]), time
+    assert steps['total'] == dur
+  _, since, _, _ = schedule.state(track, 3.5)
+  assert since == dict(act=0, cho=0, dur=3, vol=2)
+
+
+def test_later_static_change_masks_periodic_one():
+  track = schedule.index([
+      change(0, **note(vol=[1])),
+      change(0, every=4, over=1, vol=[0], lpf=[100]),
+      change(8, vol=[0.5]),
+  ])
+  assert track['layers'] == [[[0, ['vol', 'lpf']]], [[0, ['lpf']]]]
+  assert schedule.state(track, 4.5)[0]['vol'] == [0]
+  assert schedule.state(track, 5)[0]['vol'] == [1]
+  assert schedule.state(track, 8.5)[0] == dict(
+      note(vol=[0.5]), lpf=[100])
+
+
+@pytest.mark.parametrize('start, stop, expected', [
+    (0, 16, [0, 1, 4, 5, 8, 9, 12, 13]),
+    (4.5, 9, [5, 8]),
+    (99, 106, [100, 102, 103, 105]),
+])
+def test_events_of_periodic_changes(start, stop, expected):
+  track = schedule.index([
+      change(0, **note()),
+      change(0, stop=13, every=4, over=1, vol=[0]),
+      change(100, every=3, over=2, vol=[0.5]),
+  ])
+  assert schedule.events(track, start, stop) == expected
+
+
+def test_query_plays_periodic_dur():
+  track = schedule.index([
+      change(0, **note(dur=[0.5])),
+      change(0, every=2, over=1, dur=[0.25]),
+  ])
+  times = [time for time, _ in schedule.query(track, 0, 4)]
+  assert times == [0, 0.25, 0.5, 0.75, 1, 1.5, 2, 2.25, 2.5, 2.75, 3, 3.5]
+
+
+def test_cycled_keys():
+  track = schedule.index([
+      change(0, **note(vol=[1, 0.5], pan=[0])),
+      change(2, every=2, over=1, pan=[-1, 1]),
+  ])
+  assert track['cycled'] == [['vol'], ['vol']]
+  assert schedule.state(track, 0)[3] == ['vol']
+  assert schedule.state(track, 2)[3] == ['vol', 'pan']
+  assert schedule.state(track, 3)[3] == ['vol']
+  notes = schedule.query(track, 1.5, 2.5)
+  assert [(note['vol'], note['pan']) for _, note in notes] == [
+      (1, 0), (0.5, 0), (1, -1), (0.5, 1)]
+
+
+def test_query_steps_through_long_loops():
+  # The first note of a window is found by binary search at any time.
+  track = schedule.index([change(0, **note(dur=[0.25, 0.125, 0.125]))])
+  times = [time for time, _ in schedule.query(track, 1000.25, 1001)]
+  assert times == [1000.25, 1000.375, 1000.5, 1000.75, 1000.875]
+
+
+def test_automation_lanes():
+  track = schedule.index([
+      change(0, **note(lpf=[1000], hpf=[0, 100])),
+      change(2.1, lpf=[500]),
+      change(3, lpf=[500]),
+      change(4, every=2, over=1, lpf=[200]),
+  ], lanes=('lpf', 'hpf'))
+  assert track['lanes']['lpf'] == dict(times=[0, 2.1, 4], values=[1000, 500, None])
+  # Values that cycle between notes are taken from the notes.
+  assert track['lanes']['hpf'] == dict(times=[0], values=[None])
+  # The change in the middle of the window is a point of its own.
+  assert schedule.automation(track, 2, 2.5) == [
+      (2, dict(lpf=1000, hpf=None)), (2.1, dict(lpf=500))]
+  assert schedule.automation(track, 2.1, 2.5) == [
+      (2.1, dict(lpf=500, hpf=None))]
+  assert schedule.automation(track, 3, 5) == [
+      (3, dict(lpf=500, hpf=None)), (4, dict(lpf=None))]
@@ -0,0 +1,149 @@
+"""Tests of the browser independent helpers in tools.py."""
+
+import json
+
+import common  # Puts the repository on the path.
+import tools
+
+
+SOURCE = """
+def twice(x):
+  return 2 * x
+
+values = [
+  1,
+2]
+
+def fail():
+  raise ValueError(twice(None))
+""".strip()
+
+
+def test_insert_line_only_misses_changed_block():
+  cache = tools.CodeCache()
+  cache.compile(SOURCE)
+  cache.compile('import math\n' + SOURCE)
+  # The list is split into a truncated block and the rest.
+  assert cache.report['hits'] == 4
+  assert cache.report['misses'] == 1
+
+
+def test_moved_blocks_report_their_lines():
+  cache = tools.CodeCache()
+  tools.execute(SOURCE + '\nfail()', cache)
+  success, output = tools.execute('\n\n' + SOURCE + '\nfail()', cache)
+  assert not success
+  assert 'line 12, in <module>' in output
+  assert 'line 11, in fail' in output
+  assert 'line 4, in twice' in output
+  assert '<editor:' not in output
+  assert cache.report['misses'] == 1
+
+
+def test_moved_blocks_keep_their_code():
+  # Moving a block neither compiles it again nor changes its code object,
+  # so it works the same where code objects can't be changed, like under
+  # Brython.
+  cache = tools.CodeCache()
+  before = cache.compile(SOURCE)
+  after = cache.compile('import math\n\n' + SOURCE)
+  assert all(old is new for old, new in zip(before, after[1:]))
+
+
+def test_repeated_blocks_report_their_lines():
+  cache = tools.CodeCache()
+  source = 'x = 1 / 0\ny = 2\nx = 1 / 0'
+  cache.compile(source)
+  success, output = tools.execute(source.replace('1 / 0', '1', 1), cache)
+  assert not success
+  assert 'line 3, in <module>' in output
+
+
+def test_blocks_are_joined_until_they_compile():
+  namespace = {}
+  for code in tools.CodeCache().compile(SOURCE):
+    exec(code, namespace)
+  assert namespace['values'] == [1, 2]
+
+
+def test_syntax_error_stops_joining():
+  cache = tools.CodeCache()
+  source = 'a = 1\nx = = 1\n' + '\n'.join(f'y{i} = {i}' for i in range(100))
+  success, output = tools.execute(source, cache)
+  assert not success
+  assert 'line 2' in output and 'SyntaxError' in output
+  assert list(cache._entries) == [('a = 1', 0)]
+
+
+def test_unclosed_bracket_reports_its_line():
+  success, output = tools.execute('x = 1\ny = [\n', tools.CodeCache())
+  assert not success
+  assert 'line 2' in output and 'never closed' in output
+
+
+class Storage:
+
+  # Local storage of the browser in memory.
+
+  def __init__(self):
+    self.items = {}
+
+  def getItem(self, key):
+    return self.items.get(key)
+
+  def setItem(self, key, value):
+    self.items[key] = value
+
+  def removeItem(self, key):
+    self.items.pop(key, None)
+
+
+def record(content):
+  return dict(content=content, hash=tools.content_hash(content), version=2)
+
+
+def test_song_cache_evicts_least_recently_used():
+  storage = Storage()
+  size = len(json.dumps(record('a' * 100)))
+  cache = tools.SongCache(storage, limit=3 * size)
+  for key in 'abc':
+    cache.put(key, record(key * 100))
+  assert cache.get('a') == record('a' * 100)
+  cache.put('d', record('d' * 100))
+  assert cache.size <= cache.limit
+  assert cache.get('b') is None
+  assert [cache.get(key)['content'][0] for key in 'acd'] == list('acd')
+  assert f"songs:{tools.content_hash('b' * 100)}" not in storage.items
+
+
+def test_song_cache_skips_records_over_the_limit():
+  cache = tools.SongCache(Storage(), limit=100)
+  cache.put('a', record('a' * 100))
+  assert cache.get('a') is None
+  assert cache.size == 0
+
+
+def test_song_cache_finds_records_by_hash():
+  storage = Storage()
+  cache = tools.SongCache(storage)
+  cache.put('key', record('song'))
+  assert cache.find(tools.content_hash('song')) == 'key'
+  assert cache.find(tools.content_hash('other')) is None
+  # The index is kept in the storage as well.
+  cache = tools.SongCache(storage)
+  assert cache.find(tools.content_hash('song')) == 'key'
+  assert cache.get('key') == record('song')
+
+
+def test_song_cache_drops_records_that_dont_match_their_hash():
+  storage = Storage()
+  cache = tools.SongCache(storage)
+  cache.put('key', record('song'))
+  digest = tools.content_hash('song')
+  storage.items[f'songs:{digest}'] = json.dumps(
+      dict(record('song'), content='changed'))
+  assert cache.get('key') is None
+  assert cache.find(digest) is None
+  assert f'songs:{digest}' not in storage.items
+  assert json.loads(storage.items['songs:index']) == dict(
+      keys={}, sizes={})
@@ -1,12 +1,20 @@
 import collections
+import hashlib
 import io
 import json
+import re
 import sys
+import time
 import traceback
 
-from browser import document
-from browser import html
-from browser import window
+# Outside of Brython, only the browser independent helpers like execute()
+# can be used.
+try:
+  from browser import document
+  from browser import html
+  from browser import window
+except ImportError:
+  document = html = window = None
 
 
 class Settings:
@@ -44,6 +52,96 @@ class Settings:
     self._callbacks[key].append(callback)
 
 
+class SongCache:
+
+  # Saved songs by content hash in a storage with the interface of the local
+  # storage of the browser. Records are immutable once saved, so a song that
+  # was opened before can be served from the cache. The index maps database
+  # keys to content hashes and holds the size of every record, ordered from
+  # least to most recently used. Least recently used records are evicted
+  # when the total size exceeds the limit, and records whose content doesn't
+  # match their hash are dropped when they are read.
+
+  def __init__(self, storage, limit=2 ** 21, prefix='songs'):
+    self.limit = limit
+    self._storage = storage
+    self._prefix = prefix
+    index = json.loads(storage.getItem(f'{prefix}:index') or '{}')
+    self._keys = index.get('keys', {})
+    self._sizes = index.get('sizes', {})
+
+  @property
+  def size(self):
+    return sum(self._sizes.values())
+
+  def get(self, key):
+    """Get the record saved under a database key or None."""
+    digest = self._keys.get(key)
+    if digest is None:
+      return None
+    string = self._storage.getItem(f'{self._prefix}:{digest}')
+    if string is None:
+      self._forget(digest)
+      self._save_index()
+      return None
+    record = json.loads(string)
+    if content_hash(record['content']) != digest:
+      self._forget(digest)
+      self._save_index()
+      return None
+    self._touch(digest)
+    self._save_index()
+    return record
+
+  def find(self, digest):
+    """Get the database key of a record with the given content hash."""
+    if digest not in self._sizes:
+      return None
+    for key, value in self._keys.items():
+      if value == digest:
+        return key
+    return None
+
+  def put(self, key, record):
+    """Store a record under its database key and content hash."""
+    digest = record['hash']
+    string = json.dumps(record)
+    if len(string) > self.limit:
+      return
+    self._storage.setItem(f'{self._prefix}:{digest}', string)
+    self._keys[key] = digest
+    self._sizes[digest] = len(string)
+    self._touch(digest)
+    while self.size > self.limit:
+      self._forget(next(iter(self._sizes)))
+    self._save_index()
+
+  def clear(self):
+    for digest in list(self._sizes):
+      self._forget(digest)
+    self._save_index()
+
+  def _touch(self, digest):
+    # Dicts keep insertion order, so moving the entry to the end keeps the
+    # least recently used entry first.
+    self._sizes[digest] = self._sizes.pop(digest)
+
+  def _forget(self, digest):
+    self._storage.removeItem(f'{self._prefix}:{digest}')
+    self._sizes.pop(digest, None)
+    self._keys = {
+        key: value for key, value in self._keys.items() if value != digest}
+
+  def _save_index(self):
+    index = dict(keys=self._keys, sizes=self._sizes)
+    self._storage.setItem(f'{self._prefix}:index', json.dumps(index))
+
+
+def content_hash(content):
+  """Get the hash that saved songs are identified by in the cache."""
+  return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+
 class Actions:
 
   def __init__(self, editor):
@@ -104,14 +202,100 @@ class Keybind:
     self._down = False
 
 
-class Logger:
+class Console:
+
+  # Output that is shown in an element line by line. Only the most recent
+  # lines are kept in a ring buffer, and a marker at the top tells how many
+  # were dropped. Writes are collected and only the new lines are appended to
+  # the element once per animation frame, so a song that prints in a loop
+  # doesn't lay out the page for every line.
 
-  def __init__(self, element):
+  def __init__(self, element=None, limit=1000, tag='div', markup=False):
+    self.limit = limit
+    self.dropped = 0
     self._element = element
+    self._tag = tag
+    self._markup = markup
+    self._lines = collections.deque(maxlen=limit)
+    self._pending = collections.deque(maxlen=limit)
+    self._nodes = collections.deque()
+    self._partial = ''
+    self._marker = None
+    self._scheduled = False
+
+  def write(self, text):
+    """Write text like a file does and return the number of characters."""
+    lines = (self._partial + text).split('\n')
+    self._partial = lines.pop()
+    for line in lines:
+      self.append(line)
+    return len(text)
+
+  def append(self, line):
+    """Add a whole line, which is HTML if the console shows markup."""
+    if len(self._lines) == self._lines.maxlen:
+      self.dropped += 1
+    self._lines.append(line)
+    self._pending.append(line)
+    if self._element is not None and not self._scheduled:
+      self._scheduled = True
+      window.requestAnimationFrame(self._render)
+
+  def flush(self):
+    # Ends the current line so that prints without a newline are shown.
+    if self._partial:
+      self.append(self._partial)
+      self._partial = ''
+
+  def clear(self):
+    self.dropped = 0
+    self._lines.clear()
+    self._pending.clear()
+    self._partial = ''
+    if self._element is not None:
+      self._element.html = ''
+    self._nodes.clear()
+    self._marker = None
+
+  def resize(self, limit):
+    self.limit = limit
+    self._lines = collections.deque(self._lines, maxlen=limit)
+    self._pending = collections.deque(self._pending, maxlen=limit)
+
+  def getvalue(self):
+    """Get the text of the lines that are kept."""
+    return ''.join(line + '\n' for line in self._lines) + self._partial
+
+  def _render(self, *_):
+    self._scheduled = False
+    for line in self._pending:
+      node = getattr(html, self._tag.upper())()
+      if self._markup:
+        node.html = line
+      else:
+        # Empty elements would collapse, so empty lines hold a space.
+        node.text = line or ' '
+      self._element <= node
+      self._nodes.append(node)
+    self._pending.clear()
+    while len(self._nodes) > self.limit:
+      self._element.removeChild(self._nodes.popleft())
+    if self.dropped:
+      if self._marker is None:
+        self._marker = getattr(html, self._tag.upper())(Class='dropped')
+        self._element.insertBefore(self._marker, self._element.firstChild)
+      self._marker.text = f'{self.dropped} lines dropped'
+    self._element.scrollTop = self._element.scrollHeight
+
+
+class Logger:
+
+  def __init__(self, element, limit=100):
+    self._console = Console(element, limit, tag='p', markup=True)
     self._error = False
 
   def info(self, message):
-    self._element.html += f'<p>{message}</p>'
+    self._console.append(message)
 
   def error(self, message):
     window.console.log(message)
@@ -125,25 +309,238 @@ class Logger:
 
   def clear(self):
     self._error = False
-    self._element.html = ''
+    self._console.clear()
 
 
-def execute(source):
-  orig_out = sys.stdout
-  orig_err = sys.stderr
-  stream = io.StringIO()
-  sys.stdout = stream
-  sys.stderr = stream
+def execute(source, cache=None, console=None):
+  """Run the source and get whether it succeeded and what it printed.
+
+  With a code cache, only the top-level blocks that changed since earlier
+  runs are compiled again. With a console, the output is written to it and
+  only its most recent lines are returned.
+  """
+  for result in execute_steps(source, cache, console):
+    pass
+  return result
+
+
+def execute_steps(source, cache=None, console=None):
+  """Run the source in steps, see execute().
+
+  Yields None after compiling or running each top-level block and the result
+  of execute() last. The output is only redirected while a step runs, so that
+  other code can run between the steps.
+  """
+  stream = io.StringIO() if console is None else console
   success = None
   try:
-    exec(source)
+    if cache:
+      steps = cache.compile_steps(source)
+      codes = None
+      while codes is None:
+        codes = _redirected(stream, next, steps)
+        yield None
+    else:
+      codes = [compile(source, '<editor>', 'exec')]
+    namespace = {'__name__': '__main__'}
+    for code in codes:
+      start = time.perf_counter()
+      _redirected(stream, exec, code, namespace)
+      if cache:
+        cache.report['run'] += 1000 * (time.perf_counter() - start)
+      yield None
     success = True
   except Exception:
-    traceback.print_exc()
+    output = traceback.format_exc()
+    stream.write(cache.locate(output) if cache else output)
     success = False
-  sys.stdout = orig_out
-  sys.stderr = orig_err
-  return success, stream.getvalue()
+  stream.flush()
+  yield success, stream.getvalue()
+
+
+def _redirected(stream, function, *args):
+  # Calls the function with the standard output and error written to the
+  # stream.
+  orig_out = sys.stdout
+  orig_err = sys.stderr
+  sys.stdout = stream
+  sys.stderr = stream
+  try:
+    return function(*args)
+  finally:
+    sys.stdout = orig_out
+    sys.stderr = orig_err
+
+
+class Background:
+
+  # Runs a generator in slices between frames, so that the editor stays
+  # responsive while it works. The generator yields None after each step and
+  # its result last. Each slice runs steps until the budget in milliseconds
+  # is used up. Starting a job cancels the previous one, so stale work is
+  # dropped instead of finished.
+
+  def __init__(self, budget=8):
+    self.budget = budget
+    self._job = None
+    self._timeout = None
+
+  @property
+  def busy(self):
+    return self._job is not None
+
+  def start(self, steps, done):
+    """Run the steps and call done with their result."""
+    self.cancel()
+    self._job = steps, done
+    self._timeout = window.setTimeout(self._slice, 0)
+
+  def cancel(self):
+    if self._job is None:
+      return
+    window.clearTimeout(self._timeout)
+    self._job[0].close()
+    self._job = None
+
+  def _slice(self):
+    steps, done = self._job
+    start = time.perf_counter()
+    result = None
+    while result is None and 1000 * (time.perf_counter() - start) < self.budget:
+      result = next(steps)
+    if result is None:
+      self._timeout = window.setTimeout(self._slice, 0)
+      return
+    self._job = None
+    done(result)
+
+
+class CodeCache:
+
+  # Under Brython, compiling transpiles the source to JavaScript, which takes
+  # most of the time of an update for long songs. The source is split into
+  # top-level blocks that are compiled separately, and the code of the most
+  # recently used blocks is kept. Blocks are keyed by their text alone and
+  # compiled as if they started at the first line, so that moving a block by
+  # inserting lines above it doesn't compile it again. Every block gets a
+  # file name of its own instead, and locate() maps the lines of those files
+  # in tracebacks to the lines of the source. Blocks with the same text are
+  # told apart by how many came before them.
+
+  INCOMPLETE = object()
+
+  # Syntax errors of blocks that end within a bracket, a string, or a line
+  # continuation, which the next block may complete.
+  TRUNCATED = re.compile(r'was never closed|EOF|unterminated triple-quoted')
+
+  LOCATION = re.compile(r'"<editor:([0-9]+)>", line ([0-9]+)')
+
+  def __init__(self, limit=256):
+    self.limit = limit
+    self.report = dict(hits=0, misses=0, compile=0.0, run=0.0)
+    self._entries = {}
+    # Line of the source that each block starts at, by the number in its
+    # file name.
+    self._lines = {}
+    self._count = 0
+
+  def compile(self, source):
+    """Get the code objects of the top-level blocks of the source."""
+    for codes in self.compile_steps(source):
+      pass
+    return codes
+
+  def compile_steps(self, source):
+    """Compile the source in steps, see compile().
+
+    Yields None after every block and the code objects last. The compile time
+    in the report only counts the time spent in the steps.
+    """
+    self.report = dict(hits=0, misses=0, compile=0.0, run=0.0)
+    self._lines = {}
+    start = time.perf_counter()
+    codes = []
+    pending = None
+    seen = collections.Counter()
+    for line, block in _blocks(source):
+      if pending:
+        line, block = pending[0], pending[1] + '\n' + block
+      code = self._lookup(line, (block, seen[block]))
+      seen[block] += 1
+      # Blocks are split at lines without indentation, which can also be the
+      # end of a multi-line string or bracket. Such blocks are joined with the
+      # next one until they compile. Other syntax errors are raised right
+      # away, since no later block can fix them.
+      pending = (line, block) if code is self.INCOMPLETE else None
+      if not pending:
+        codes.append(code)
+      self.report['compile'] += 1000 * (time.perf_counter() - start)
+      yield None
+      start = time.perf_counter()
+    if pending:
+      self._compile(self._number(pending[0]), pending[1], last=True)
+    while len(self._entries) > self.limit:
+      del self._entries[next(iter(self._entries))]
+    self.report['compile'] += 1000 * (time.perf_counter() - start)
+    yield codes
+
+  def locate(self, text):
+    """Map the blocks and lines in a traceback to the lines of the source."""
+    def replace(match):
+      number, line = int(match.group(1)), int(match.group(2))
+      if number not in self._lines:
+        return match.group(0)
+      return f'"<editor>", line {self._lines[number] + line - 1}'
+    return self.LOCATION.sub(replace, text)
+
+  def clear(self):
+    self._entries.clear()
+
+  def _lookup(self, line, key):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      number = self._number(line)
+      entry = (number, self._compile(number, key[0]))
+      self.report['misses'] += 1
+    else:
+      # Dicts keep insertion order, so moving the entry to the end keeps the
+      # least recently used entry first.
+      self.report['hits'] += 1
+      self._lines[entry[0]] = line
+    self._entries[key] = entry
+    return entry[1]
+
+  def _number(self, line):
+    self._count += 1
+    self._lines[self._count] = line
+    return self._count
+
+  def _compile(self, number, block, last=False):
+    try:
+      return compile(block, f'<editor:{number}>', 'exec')
+    except SyntaxError as e:
+      if last or not self.TRUNCATED.search(str(e.msg)):
+        raise
+      return self.INCOMPLETE
+
+
+def _blocks(source):
+  # Split the source before every line that starts a top-level statement.
+  # Indented lines, comments, closing brackets, and the clauses and decorated
+  # definitions of compound statements stay with the block before them.
+  lines = source.split('\n')
+  clauses = ('else', 'elif', 'except', 'finally', 'case')
+  first = 0
+  for index, line in enumerate(lines):
+    if index == first or not line.strip() or line[0] in ' \t#)]}':
+      continue
+    if line.split()[0].rstrip(':') in clauses:
+      continue
+    if lines[index - 1].startswith('@'):
+      continue
+    yield first + 1, '\n'.join(lines[first:index])
+    first = index
+  yield first + 1, '\n'.join(lines[first:])
 
 
 def hsl_to_hex(h, s, l):
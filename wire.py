@@ -0,0 +1,234 @@
+"""Compact wire format of compiled songs.
+
+The time index of a track repeats the same values many times: every segment
+holds the full state of the player, including the sample map and the scale,
+and the key names are spelled out everywhere. The wire format interns all
+distinct values in one table, stores states as the keys that differ from the
+player defaults, and stores the periodic changes in parallel arrays. Values
+that can be derived from the states, like the prefix sums of the durations,
+are left out and recomputed when a track is decoded.
+
+Layout of version 2:
+
+  version   Format version.
+  keys      Names of the state keys.
+  values    Table of distinct values that states refer to by position.
+  defaults  Value of every key in the player defaults.
+  tracks    Encoded tracks with the fields below.
+
+  hash      Content hash of the decoded track.
+  times     Times of the segments.
+  states    Per segment, flat pairs of key and value that differ from the
+            defaults. A value of null means the key is not set.
+  since     Per segment, flat pairs of key and time that differ from the
+            previous segment.
+  layers    Per segment, the periodic changes and the keys they may set.
+  periodic  Parallel arrays start, stop, every, over, and state, with states
+            stored as flat pairs of key and value.
+  lanes     Triples of key, times, and values of the automation lanes.
+
+Decoding is implemented in `engine.js` as well, where it happens lazily for
+each track the first time the scheduler needs it.
+"""
+
+import json
+
+import schedule
+
+
+VERSION = 2
+
+
+def encode(song, keys, defaults):
+  """Encode a compiled song with the given state keys and default state."""
+  encoder = Encoder(keys, defaults)
+  tracks = [encoder.track(track) for track in song['tracks']]
+  output = dict(song, tracks=tracks)
+  output.update(
+      version=VERSION, keys=encoder.keys, values=encoder.values,
+      defaults=encoder.defaults)
+  return output
+
+
+def decode(data):
+  """Decode all tracks of a song into the format of `schedule.index()`."""
+  if data.get('version', 1) == 1:
+    return data
+  assert data['version'] == VERSION, data['version']
+  tracks = [decode_track(data, track) for track in data['tracks']]
+  output = {
+      key: value for key, value in data.items()
+      if key not in ('version', 'keys', 'values', 'defaults')}
+  output['tracks'] = tracks
+  return output
+
+
+def decode_track(data, encoded):
+  """Decode a single track of a song in the wire format."""
+  keys = data['keys']
+  values = data['values']
+  defaults = {key: values[value] for key, value in zip(keys, data['defaults'])}
+  states = []
+  for pairs in encoded['states']:
+    state = defaults.copy()
+    for key, value in _pairs(pairs):
+      if value is None:
+        del state[keys[key]]
+      else:
+        state[keys[key]] = values[value]
+    states.append(state)
+  since = []
+  current = {}
+  for pairs in encoded['since']:
+    current = current.copy()
+    for key, time in _pairs(pairs):
+      if time is None:
+        del current[keys[key]]
+      else:
+        current[keys[key]] = time
+    since.append(current)
+  periodic = []
+  columns = encoded['periodic']
+  for start, stop, every, over, pairs in zip(
+      columns['start'], columns['stop'], columns['every'], columns['over'],
+      columns['state']):
+    state = {keys[key]: values[value] for key, value in _pairs(pairs)}
+    periodic.append(dict(
+        start=start, stop=stop, every=every, over=over, state=state))
+  track = dict(
+      hash=encoded['hash'], times=encoded['times'], states=states,
+      since=since, periodic=periodic,
+      layers=[
+          [[ident, [keys[key] for key in layer]] for ident, layer in layers]
+          for layers in encoded['layers']],
+      lanes={
+          keys[key]: dict(times=times, values=lane_values)
+          for key, times, lane_values in encoded['lanes']})
+  return schedule.prepare(track)
+
+
+class Encoder:
+
+  # Encodes tracks into a table of values that can be shared between songs.
+  # Values are only ever appended, so a track that was encoded once stays
+  # valid for later songs, and a client that has the earlier tracks and values
+  # only needs the new ones.
+
+  def __init__(self, keys, defaults):
+    self.keys = list(keys)
+    self._table = _Table()
+    self._ids = {key: index for index, key in enumerate(self.keys)}
+    self._default_ids = {
+        key: self._table.add(defaults[key]) for key in self.keys}
+    self.defaults = [self._default_ids[key] for key in self.keys]
+
+  @property
+  def values(self):
+    return self._table.values
+
+  @property
+  def size(self):
+    """Number of objects that the table refers to."""
+    return len(self._table._objects)
+
+  def track(self, track):
+    """Encode a track in the format of `schedule.index()`."""
+    return _encode_track(track, self._table, self._ids, self._default_ids)
+
+
+class Replica:
+
+  # Song put together from the batches of a jam session, see `jamserver.py`.
+  # Batches only hold the values and tracks that were not sent before, and
+  # the edit of the source.
+
+  def __init__(self):
+    self.source = ''
+    self.keys = None
+    self.defaults = None
+    self.values = []
+    self.tracks = {}
+
+  def apply(self, batch):
+    """Add the contents of a batch and get the song in the wire format."""
+    if batch['reset']:
+      self.keys, self.defaults = batch['keys'], batch['defaults']
+      self.values, self.tracks = [], {}
+      self.source = ''
+    start, stop, text = batch['edit']
+    self.source = self.source[:start] + text + self.source[stop:]
+    self.values[batch['offset']:] = batch['values']
+    self.tracks.update(batch['tracks'])
+    output = dict(batch['song'])
+    output.update(
+        version=VERSION, keys=self.keys, values=self.values,
+        defaults=self.defaults,
+        tracks=[self.tracks[hash_] for hash_ in batch['order']])
+    return output
+
+
+class _Table:
+
+  def __init__(self):
+    self.values = []
+    self._ids = {}
+    # States of the same track share most value objects, so looking them up
+    # by identity first avoids serializing them again.
+    self._objects = {}
+
+  def add(self, value):
+    if id(value) in self._objects:
+      return self._objects[id(value)][1]
+    key = json.dumps(value, sort_keys=True)
+    if key not in self._ids:
+      self._ids[key] = len(self.values)
+      self.values.append(value)
+    self._objects[id(value)] = (value, self._ids[key])
+    return self._ids[key]
+
+
+def _encode_track(track, table, ids, default_ids):
+  states = []
+  for state in track['states']:
+    pairs = []
+    for key, default in default_ids.items():
+      if key not in state:
+        pairs += [ids[key], None]
+    for key, value in state.items():
+      value = table.add(value)
+      if value != default_ids.get(key):
+        pairs += [ids[key], value]
+    states.append(pairs)
+  since = []
+  previous = {}
+  for current in track['since']:
+    pairs = []
+    for key in previous:
+      if key not in current:
+        pairs += [ids[key], None]
+    for key, time in current.items():
+      if previous.get(key) != time:
+        pairs += [ids[key], time]
+    since.append(pairs)
+    previous = current
+  periodic = dict(start=[], stop=[], every=[], over=[], state=[])
+  for change in track['periodic']:
+    for column in ('start', 'stop', 'every', 'over'):
+      periodic[column].append(change[column])
+    pairs = []
+    for key, value in change['state'].items():
+      pairs += [ids[key], table.add(value)]
+    periodic['state'].append(pairs)
+  layers = [
+      [[ident, [ids[key] for key in keys]] for ident, keys in segment]
+      for segment in track['layers']]
+  lanes = [
+      [ids[key], lane['times'], lane['values']]
+      for key, lane in track['lanes'].items()]
+  return dict(
+      hash=track['hash'], times=track['times'], states=states, since=since,
+      layers=layers, periodic=periodic, lanes=lanes)
+
+
+def _pairs(flat):
+  return zip(flat[::2], flat[1::2])